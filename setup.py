@@ -208,6 +208,7 @@ if __name__ == "__main__":
         python_requires=">=3.11",
         install_requires=get_requirements(),
         extras_require={
+            "orjson": ["orjson"],
             #   "rst": ["docutils>=0.11"],
             #   ":python_version=='3.8'": ["backports.zoneinfo"],
         },
@@ -1,20 +1,36 @@
 import re
+import time
 from re import Match
+from typing import Callable
+from typing import Optional
 
 from ...utils.log import logger
 
 REVERSE_BOLDED_LISTS = re.compile(r"""\*\*(\d+)\.\s(.+)\*\*""")
-CONJOINED_TABLE_PATTERN = re.compile(
-    r"""(?:\|[^\|\n]*)+\|\n(?:\|:?-+:?)+\|\n(?:(?:(?:\|[^\|\n]*)+\|\n)+(?=(?:\|[^\|\n]*)+\|\n(?:\|:?-+:?)+\|\n))"""
-)  # WARNING POSSIBLE CATASTROPHIC BACKTRACKING (until someone tests it more...)
-TABLE_PATTERN = re.compile(r"((?:\|.*){1}\n(?:(?:\|\w*:?\w*-+\w*:?\w*)+\|)(?:\n\|.*)+)")
-HTML_TABLE_PATTERN = re.compile(r"""<table>.*?</table>""")
+HTML_TABLE_OPEN = "<table>"
+HTML_TABLE_CLOSE = "</table>"
 
 IMAGE_PATTERN = re.compile(r"""<img src="((?:\w+\/)*(\w+).(\w+))"\s*alt="(.*?)"\s*\/>""")
 PPTX_PATTERN = re.compile(r"""<a\s+href\s*=\s*"(\w+?\.pptx)"\s*>(.*?)<\/a>""")
 PDF_PATTERN = re.compile(r"""<a\s+href\s*=\s*"(\w+?\.pdf)"\s*>(.*?)<\/a>""")
 XLS_PATTERN = re.compile(r"""<a\s+href\s*=\s*"(\w+?\.(?:xls|xlsx))"\s*>(.*?)<\/a>""")
 DOCX_PATTERN = re.compile(r"""<a\s+href\s*=\s*"(\w+?\.(?:docx|doc))"\s*>(.*?)<\/a>""")
+ATTACHMENT_LINK_PATTERN = re.compile(r"""<a\s+href\s*=\s*"(\w+?\.(\w+?))"\s*>(.*?)<\/a>""")
+# IMAGE_PATTERN and ATTACHMENT_LINK_PATTERN as one alternation so cf_post_process only scans the html once
+POST_PROCESS_PATTERN = re.compile(
+    r"""<(?:img src="(?:\w+\/)*(\w+).(\w+)"\s*alt="(.*?)"\s*\/>"""
+    r"""|a\s+href\s*=\s*"(\w+?\.(\w+?))"\s*>(.*?)<\/a>)"""
+)
+
+# Attachment file extension to the confluence macro that previews it
+VIEW_MACROS = {
+    "pptx": "viewppt",
+    "pdf": "viewpdf",
+    "xls": "viewxls",
+    "xlsx": "viewxls",
+    "docx": "viewdoc",
+    "doc": "viewdoc",
+}
 
 LINK_IN_BRACKET = re.compile(r"""<(?:\bhttps?://([^>]+)\b)>""")
 INVALID_HTML_TAGS = [LINK_IN_BRACKET]
@@ -36,20 +52,125 @@ def reverse_bolded_lists(markdown: str) -> str:
     return re.sub(REVERSE_BOLDED_LISTS, repl, markdown)
 
 
+def is_table_delimiter_row(line: str) -> bool:
+    """Checks if a line is the row under a markdown table header, like "|---|:---:|".
+
+    Args:
+        line (str): A single line without its newline.
+
+    Returns:
+        bool: True if every cell is made of dashes with optional alignment colons.
+    """
+    line = line.rstrip()
+    if len(line) < 3 or line[0] != "|" or line[-1] != "|":
+        return False
+
+    for cell in line[1:-1].split("|"):
+        cell = cell.strip()
+        if cell.startswith(":"):
+            cell = cell[1:]
+        if cell.endswith(":"):
+            cell = cell[:-1]
+        if not cell or cell.strip("-"):
+            return False
+    return True
+
+
+def space_out_html_tables(markdown: str) -> str:
+    """Puts blank lines around single line html tables. Runs in linear time.
+
+    Args:
+        markdown (str): Markdown string to check.
+
+    Returns:
+        str: Markdown with "<table>...</table>" spans surrounded by blank lines.
+    """
+    pieces = []
+    copied = 0
+    pos = 0
+    line_end = -1
+    while (start := markdown.find(HTML_TABLE_OPEN, pos)) != -1:
+        if start > line_end:  # Only look for the end of a line once per line
+            line_end = markdown.find("\n", start)
+            if line_end == -1:
+                line_end = len(markdown)
+
+        end = markdown.find(HTML_TABLE_CLOSE, start + len(HTML_TABLE_OPEN), line_end)
+        if end == -1:  # Nothing closes this table so nothing after it on the same line can be closed either
+            pos = line_end
+            continue
+
+        end += len(HTML_TABLE_CLOSE)
+        pieces.append(markdown[copied:start])
+        pieces.append(f"""\n\n{markdown[start:end]}\n\n""")
+        copied = pos = end
+
+    pieces.append(markdown[copied:])
+    return "".join(pieces)
+
+
+def space_out_markdown_tables(markdown: str) -> str:
+    """Puts blank lines around markdown tables and splits tables that are stuck together. Each line is looked at a constant number of times, so this runs in linear time.
+
+    A table starts at the first "|" of a line that is followed by a delimiter row and runs until the first line that does not start with "|". A row that is followed by another delimiter row starts a new table.
+
+    Args:
+        markdown (str): Markdown string to check.
+
+    Returns:
+        str: Markdown with blank lines around each table.
+    """
+    lines = markdown.split("\n")
+    is_delimiter = [is_table_delimiter_row(line) for line in lines]
+    is_delimiter.append(False)
+
+    i = 0
+    while i < len(lines) - 1:
+        if not is_delimiter[i + 1] or "|" not in lines[i]:
+            i += 1
+            continue
+
+        head = lines[i].index("|")
+        lines[i] = f"""{lines[i][:head]}\n\n{lines[i][head:]}"""
+
+        last = i + 1
+        while last + 1 < len(lines) and lines[last + 1].startswith("|") and not is_delimiter[last + 2]:
+            last += 1
+
+        lines[last] += "\n\n"
+        i = last + 1
+
+    return "\n".join(lines)
+
+
 def space_out_tables(markdown: str) -> str:
-    regx_todo = [HTML_TABLE_PATTERN, TABLE_PATTERN, CONJOINED_TABLE_PATTERN]
+    """Makes sure html and markdown tables are separated from the surrounding text by blank lines.
 
-    def repl(m: re.Match):
-        return f"""\n\n{m.group(0)}\n\n"""
+    Args:
+        markdown (str): Markdown string to check.
+
+    Returns:
+        str: Formatted string.
+    """
+    return space_out_markdown_tables(space_out_html_tables(markdown))
+
+
+def cf_image_xml(filename: str, alt: str) -> str:
+    return f"""<ac:image ac:alt="{alt}"><ri:attachment ri:filename="{filename}" /></ac:image>\n"""
 
-    for regx in regx_todo:
-        markdown = re.sub(regx, repl, markdown)
-    return markdown
+
+def cf_view_xml(macro: str, filename: str, text: str) -> str:
+    return f"""<p>{text}</p><ac:structured-macro ac:name="{macro}"><ac:parameter ac:name="name"><ri:attachment ri:filename="{filename}" /></ac:parameter></ac:structured-macro>"""
+
+
+def cf_attachment_link_xml(filename: str, text: str) -> str:
+    """Links to an attachment of the page by file name, so the page can be written before the attachment is uploaded."""
+    return f"""<ac:link><ri:attachment ri:filename="{filename}" /><ac:link-body>{text}</ac:link-body></ac:link>"""
 
 
 def html_image_2_cf_image(html_string: str) -> str:
     def repl(m: Match):
-        return f"""<ac:image ac:alt="{m.group(4)}"><ri:attachment ri:filename="{m.group(2)}.{m.group(3)}" /></ac:image>\n"""
+        return cf_image_xml(f"{m.group(2)}.{m.group(3)}", m.group(4))
 
     result = re.sub(IMAGE_PATTERN, repl, html_string)
     return result
@@ -57,34 +178,60 @@ def html_image_2_cf_image(html_string: str) -> str:
 
 def html_pdf_link_2_cf_pdf(html_string: str) -> str:
     def repl(m: Match):
-        return f"""<p>{m.group(2)}</p><ac:structured-macro ac:name="viewpdf"><ac:parameter ac:name="name"><ri:attachment ri:filename="{m.group(1)}" /></ac:parameter></ac:structured-macro>"""
+        return cf_view_xml("viewpdf", m.group(1), m.group(2))
 
     return re.sub(PDF_PATTERN, repl, html_string)
 
 
 def html_pptx_link_2_cf_pptx(html_string: str) -> str:
     def repl(m: Match):
-        return f"""<p>{m.group(2)}</p><ac:structured-macro ac:name="viewppt"><ac:parameter ac:name="name"><ri:attachment ri:filename="{m.group(1)}" /></ac:parameter></ac:structured-macro>"""
+        return cf_view_xml("viewppt", m.group(1), m.group(2))
 
     return re.sub(PPTX_PATTERN, repl, html_string)
 
 
 def html_xls_link_2_cf_xls(html_string: str) -> str:
     def repl(m: Match):
-        return f"""<p>{m.group(2)}</p><ac:structured-macro ac:name="viewxls"><ac:parameter ac:name="name"><ri:attachment ri:filename="{m.group(1)}" /></ac:parameter></ac:structured-macro>"""
+        return cf_view_xml("viewxls", m.group(1), m.group(2))
 
     return re.sub(XLS_PATTERN, repl, html_string)
 
 
 def html_docx_link_2_cf_docx(html_string: str) -> str:
     def repl(m: Match):
-        return f"""<p>{m.group(2)}</p><ac:structured-macro ac:name="viewdoc"><ac:parameter ac:name="name"><ri:attachment ri:filename="{m.group(1)}" /></ac:parameter></ac:structured-macro>"""
+        return cf_view_xml("viewdoc", m.group(1), m.group(2))
 
     return re.sub(DOCX_PATTERN, repl, html_string)
 
 
+def html_attachment_links_2_cf(html_string: str, misc_link: Optional[Callable[[str, str], str]] = None) -> str:
+    """Rewrites every link to an attachment in one pass. Office documents and pdfs become preview macros.
+
+    Args:
+        html_string (str): Html string to rewrite.
+        misc_link (Optional[Callable[[str, str], str]], optional): Called with the file name and link text of any other attachment link and returns its replacement. Those links are left alone if None. Defaults to None.
+
+    Returns:
+        str: Rewritten html string.
+    """
+
+    def repl(m: Match):
+        filename, extension, text = m.groups()
+        macro = VIEW_MACROS.get(extension)
+        if macro is not None:
+            return cf_view_xml(macro, filename, text)
+        if misc_link is not None:
+            return misc_link(filename, text)
+        return m.group(0)
+
+    return ATTACHMENT_LINK_PATTERN.sub(repl, html_string)
+
+
+ATTACHMENTS_MACRO = r"""<p><ac:structured-macro ac:name="attachments" /></p>"""
+
+
 def add_attachments_macro(html_string: str) -> str:
-    return html_string + r"""<p><ac:structured-macro ac:name="attachments" /></p>"""
+    return html_string + ATTACHMENTS_MACRO
 
 
 PRE_PROCESS_FUNCS = [find_invalid_html, reverse_bolded_lists, space_out_tables]
@@ -106,27 +253,44 @@ def cf_pre_process(markdown: str) -> str:
     return markdown
 
 
-POST_PROCESS_FUNCS = [
-    html_image_2_cf_image,
-    html_pptx_link_2_cf_pptx,
-    html_xls_link_2_cf_xls,
-    html_pdf_link_2_cf_pdf,
-    html_docx_link_2_cf_docx,
-    add_attachments_macro,
-]
-
+def cf_post_process(html_string: str, misc_link: Optional[Callable[[str, str], str]] = None) -> str:
+    """Formats html strings into confluence style xml. Images and attachment links are rewritten in a single pass over the string (POST_PROCESS_PATTERN) and the attachments macro is added at the end.
 
-def cf_post_process(html_string: str) -> str:
-    """Runs post processing hooks to check html strings and format them for confluence style xml
+    Gives the same result as running html_image_2_cf_image, html_attachment_links_2_cf and add_attachments_macro one after the other.
 
     Args:
         html_string (str): Original html string to be uploaded to confluence.
+        misc_link (Optional[Callable[[str, str], str]], optional): Rewrites attachment links that have no preview macro. See html_attachment_links_2_cf. Defaults to None.
 
     Returns:
         str: Confluence compatible html string.
     """
-    for func in POST_PROCESS_FUNCS:
-        logger.info(f"\t\t\tBegin Post_Process... ({func.__name__})")
-        html_string = func(html_string)
-        logger.info("\t\t\tFinished Post-Processing")
-    return html_string
+    start = time.perf_counter()
+    counts = {"image": 0, "view": 0, "misc": 0}
+
+    def repl(m: Match):
+        image_base, image_ext, alt, filename, extension, text = m.groups()
+        if image_base is not None:
+            counts["image"] += 1
+            return cf_image_xml(f"{image_base}.{image_ext}", alt)
+
+        if "<img" in text and IMAGE_PATTERN.search(text):
+            # Separate passes turn the image into multi line xml first, which stops this link from matching
+            counts["image"] += 1
+            return html_attachment_links_2_cf(html_image_2_cf_image(m.group(0)), misc_link)
+
+        macro = VIEW_MACROS.get(extension)
+        if macro is not None:
+            counts["view"] += 1
+            return cf_view_xml(macro, filename, text)
+        if misc_link is not None:
+            counts["misc"] += 1
+            return misc_link(filename, text)
+        return m.group(0)
+
+    result = POST_PROCESS_PATTERN.sub(repl, html_string) + ATTACHMENTS_MACRO
+    logger.debug(
+        f"Post-processed {len(html_string)} characters in {(time.perf_counter() - start) * 1000:.2f} ms "
+        f"(images: {counts['image']}, previews: {counts['view']}, attachment links: {counts['misc']})"
+    )
+    return result
@@ -1,26 +1,155 @@
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Dict
 from typing import List
 from typing import Optional
 from typing import Union
+from urllib.parse import urlsplit
 
 from atlassian.confluence import Confluence
+from atlassian.errors import ApiError
+from requests import PreparedRequest
+from requests import Response
 from requests import Session
 from requests.adapters import HTTPAdapter
-from urllib3.util import Retry
+from requests.exceptions import ConnectionError as RequestsConnectionError
+from requests.exceptions import Timeout
 
 from ...utils.log import logger
+from ...utils.rate_limit import CircuitBreaker
+from ...utils.rate_limit import RequestStats
+from ...utils.rate_limit import TokenBucket
+from ...utils.rate_limit import parse_retry_after
+
+ID_SEGMENT = re.compile(r"/\d+(?=/|$)")
+
+
+class ThrottledHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that sends every request through a shared token bucket and circuit breaker, retries with backoff and records per endpoint stats.
+
+    429 and 503 responses with a Retry-After header pause the token bucket, so every request sharing it waits, not only the one that was throttled.
+    """
+
+    RETRY_STATUSES = (429, 502, 503, 504)
+
+    def __init__(
+        self,
+        limiter: TokenBucket,
+        breaker: CircuitBreaker,
+        stats: RequestStats,
+        retries: int = 5,
+        backoff_factor: float = 0.5,
+        backoff_max: float = 60.0,
+        **kwargs,
+    ):
+        self.limiter = limiter
+        self.breaker = breaker
+        self.stats = stats
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        super().__init__(**kwargs)
+
+    @staticmethod
+    def endpoint(request: PreparedRequest) -> str:
+        """Names the endpoint of a request with numeric ids replaced, e.g. "GET /rest/api/content/{id}/child/page"."""
+        return f"{request.method} {ID_SEGMENT.sub('/{id}', urlsplit(request.url).path)}"
+
+    def backoff(self, retry: int) -> float:
+        return min(self.backoff_max, self.backoff_factor * 2 ** (retry - 1))
+
+    def send(self, request: PreparedRequest, **kwargs) -> Response:
+        endpoint = self.endpoint(request)
+        start = time.perf_counter()
+        retry = 0
+        while True:
+            self.breaker.before_request()
+            self.limiter.acquire()
+            try:
+                response = super().send(request, **kwargs)
+            except (RequestsConnectionError, Timeout):
+                self.breaker.record_failure()
+                if retry >= self.retries:
+                    self.stats.record(endpoint, time.perf_counter() - start, retry, error=True)
+                    raise
+                retry += 1
+                time.sleep(self.backoff(retry))
+                continue
+            except Exception:  # Not retried, but must not leave a half open breaker waiting for an outcome forever
+                self.breaker.record_failure()
+                self.stats.record(endpoint, time.perf_counter() - start, retry, error=True)
+                raise
+
+            if response.status_code >= 500:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+
+            if response.status_code not in self.RETRY_STATUSES or retry >= self.retries:
+                self.stats.record(endpoint, time.perf_counter() - start, retry, error=response.status_code >= 400)
+                return response
+
+            retry += 1
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            response.close()
+            if retry_after is not None and response.status_code in (429, 503):
+                logger.debug(f"{endpoint} throttled, pausing requests for {retry_after}s")
+                self.limiter.pause(retry_after)
+            else:
+                time.sleep(self.backoff(retry))
 
 
 class ConfluenceManager:
-    def __init__(self, confluence_url: str, confluence_space_key: str, confluence_username: str, confluence_api_token: str):
+    def __init__(
+        self,
+        confluence_url: str,
+        confluence_space_key: str,
+        confluence_username: str,
+        confluence_api_token: str,
+        pool_connections: int = 10,
+        pool_maxsize: int = 16,
+        retries: int = 5,
+        requests_per_second: float = 10.0,
+        limiter: Optional[TokenBucket] = None,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+    ):
+        """Connects to a confluence space.
+
+        Args:
+            confluence_url (str): Base url of the confluence instance.
+            confluence_space_key (str): Key of the space pages are made in.
+            confluence_username (str): User name to log in with.
+            confluence_api_token (str): Api token to log in with.
+            pool_connections (int, optional): Number of connection pools to cache. Defaults to 10.
+            pool_maxsize (int, optional): Most connections kept open per host. Should be at least the number of threads making calls. Defaults to 16.
+            retries (int, optional): Retries for connection errors and 429, 502, 503 and 504 responses. Defaults to 5.
+            requests_per_second (float, optional): Rate of the token bucket made when no limiter is given. Defaults to 10.0.
+            limiter (Optional[TokenBucket], optional): Token bucket to share with other managers. Defaults to None.
+            failure_threshold (int, optional): Failures in a row before calls are rejected. Defaults to 5.
+            reset_timeout (float, optional): Seconds calls are rejected before a trial call is let through. Defaults to 30.0.
+        """
+        self.limiter = limiter if limiter is not None else TokenBucket(requests_per_second)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.stats = RequestStats()
+        adapter = ThrottledHTTPAdapter(
+            self.limiter, self.breaker, self.stats, retries, pool_connections=pool_connections, pool_maxsize=pool_maxsize
+        )
         session = Session()
-        retries = Retry(total=1000, backoff_factor=0.1, status_forcelist=[502, 503, 504], allowed_methods=False)
-        session.mount("https://", HTTPAdapter(max_retries=retries))
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
         self.confluence_client = Confluence(
             url=confluence_url, username=confluence_username, password=confluence_api_token, timeout=600, session=session
         )
         self.space_key = confluence_space_key
 
+    @property
+    def request_stats(self) -> Dict[str, Dict[str, float]]:
+        """Per endpoint request, retry, error and latency counters of every call made through this manager."""
+        return self.stats.snapshot()
+
     def alias_name(self, title: str):
         numba = 1
         new_title = title.rstrip()
@@ -70,23 +199,77 @@ class ConfluenceManager:
         resource_dir = Path(resource_dir)
         return self.confluence_client.attach_file(filename=resource_dir, page_id=page_id)
 
-    def clean_space(self, protect_pages: Union[List[str], str]):
-        if isinstance(protect_pages, str):
-            protect_pages = [protect_pages]
+    def get_descendant_ids(self, page_id: str, page_size: int = 200) -> List[str]:
+        """Finds the ids of every page under a page with a paginated CQL ancestor search.
+
+        Args:
+            page_id (str): Id of the top page.
+            page_size (int, optional): Results fetched per request. Defaults to 200.
+
+        Returns:
+            List[str]: Ids of all descendant pages, not including the top page.
+        """
+        ids = []
+        start = 0
+        while True:
+            response = self.confluence_client.cql(f"ancestor={page_id} and type=page", start=start, limit=page_size)
+            results = response.get("results", [])
+            ids.extend(result["content"]["id"] for result in results)
+            start += len(results)
+            if not results or ("next" not in response.get("_links", {}) and start >= response.get("totalSize", 0)):
+                return ids
+
+    def remove_pages_from_parent(self, parent_id: str, dry_run: bool = False, max_workers: int = 8) -> List[str]:
+        """Deletes every page under a page. The page itself is kept.
+
+        All descendants are listed before anything is deleted, then deleted concurrently. The deletes go through the same rate limiter as every other call.
+
+        Args:
+            parent_id (str): Id of the page to empty.
+            dry_run (bool, optional): If True, only lists the pages that would be deleted. Defaults to False.
+            max_workers (int, optional): Maximum number of deletes in flight. Defaults to 8.
 
-        def get_ids(page_id: str) -> List[str]:
-            id_list = [page_id]
-            child_ids = [child["id"] for child in self.confluence_client.get_child_pages(page_id)]
+        Returns:
+            List[str]: Ids of the deleted pages, or the pages that would be deleted in a dry run.
+        """
+        page_ids = self.get_descendant_ids(parent_id)
+        if dry_run:
+            logger.info(f"Dry run: would delete {len(page_ids)} pages under page {parent_id}")
+            return page_ids
 
-            for child_id in child_ids:
-                id_list.extend(get_ids(child_id))
+        def delete(page_id: str):
+            try:
+                self.delete_page(page_id)
+            except ApiError as e:  # Already gone, e.g. the search index was behind
+                logger.warning(f"Could not delete page {page_id}: {e}")
 
-            return id_list
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(delete, page_ids))
+        logger.info(f"Deleted {len(page_ids)} pages under page {parent_id}")
+        return page_ids
+
+    def clean_space(self, protect_pages: Union[List[str], str], dry_run: bool = False, max_workers: int = 8) -> List[str]:
+        """Deletes every page under the pages with the given titles. The pages with those titles are kept.
+
+        Args:
+            protect_pages (Union[List[str], str]): Titles of the pages to empty.
+            dry_run (bool, optional): If True, only lists the pages that would be deleted. Defaults to False.
+            max_workers (int, optional): Maximum number of deletes in flight. Defaults to 8.
+
+        Raises:
+            KeyError: If there is no page with one of the titles in the space.
+
+        Returns:
+            List[str]: Ids of the deleted pages, or the pages that would be deleted in a dry run.
+        """
+        if isinstance(protect_pages, str):
+            protect_pages = [protect_pages]
 
         page_ids = []
         for page_title in protect_pages:
             page_id = self.get_confluence_page_id(page_title)
-            page_ids.extend(get_ids(page_id))
-        # UNFINISHED
+            if page_id is None:
+                raise KeyError(f"No page titled {page_title} in space {self.space_key}")
+            page_ids.extend(self.remove_pages_from_parent(page_id, dry_run, max_workers))
 
         return page_ids
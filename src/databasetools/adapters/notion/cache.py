@@ -0,0 +1,293 @@
+"""
+On disk cache of Notion api responses.
+
+Classes:
+    NotionCache: SQLite store of responses and last_edited_times, validated by last_edited_time and a ttl, with least recently used eviction.
+    CachingTransport: httpx transport that answers GET requests, database queries and searches from a NotionCache before sending them on.
+"""
+
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+import httpx
+
+from .utils import NOTION_ID
+from .utils import normalize_id
+
+VERSIONED_OBJECTS = ("page", "block", "database")
+CACHED_POSTS = re.compile(r"/v1/(databases/[^/]+/query|search)$")
+LISTINGS = re.compile(r"/v1/(blocks/[^/]+/children|databases/[^/]+/query)$")
+
+
+class NotionCache:
+    """SQLite store of Notion responses keyed by request.
+
+    Every response of a block, page or database is stored with the last_edited_time it had when it was stored. Such an entry is fresh if
+    that is still the newest last_edited_time seen in any response, e.g. of a database query. Listings, i.e. the children of a block and
+    the rows of a database, are stored with the last_edited_time of their parent. They are stale once the parent's moves, and otherwise
+    fresh while younger than the ttl, as an item can change without moving its parent's. Entries without a resource, and ones whose
+    resource has no last_edited_time seen yet, are fresh while they are younger than the ttl. The last_edited_times seen are kept in the
+    same file, so they still validate entries after a restart. Offline, every stored entry is served.
+
+    Attributes:
+        path (Path): SQLite database file.
+        ttl (float): Seconds an entry that cannot be validated is served for.
+        max_size (int): Most bytes of response bodies kept. The least recently used entries are evicted past it.
+        offline (bool): Serve every stored entry and never send requests.
+        hits (int): Lookups answered from the cache.
+        misses (int): Lookups that were not, including stale entries.
+        stale (int): Entries found but out of date.
+        evictions (int): Entries evicted to stay under max_size.
+    """
+
+    def __init__(self, path: Union[str, Path], ttl: float = 24 * 3600, max_size: int = 256 * 2**20, offline: bool = False):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self._versions: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    resource_id TEXT,
+                    version TEXT,
+                    stored_at REAL,
+                    accessed_at REAL,
+                    status INTEGER,
+                    body BLOB,
+                    size INTEGER
+                )"""
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS versions (resource_id TEXT PRIMARY KEY, version TEXT)")
+        self._size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        self._versions.update(self._connection.execute("SELECT resource_id, version FROM versions"))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    @property
+    def size(self) -> int:
+        """Bytes of response bodies stored."""
+        return self._size
+
+    @property
+    def bypassed(self) -> bool:
+        """Whether requests of the current thread skip the cache, see bypass."""
+        return getattr(self._local, "bypassed", False)
+
+    @contextmanager
+    def bypass(self) -> Iterator[None]:
+        """Sends the requests of the current thread inside the block instead of answering them from the cache. Their responses are still
+        stored and observed.
+        """
+        previous = self.bypassed
+        self._local.bypassed = True
+        try:
+            yield
+        finally:
+            self._local.bypassed = previous
+
+    def observe(self, body: bytes) -> None:
+        """Records the last_edited_time of every block, page and database in a response body that is newer than the one known.
+
+        Args:
+            body (bytes): Json response body.
+        """
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return
+        if not isinstance(data, dict):
+            return
+        objects = data.get("results", []) if data.get("object") == "list" else [data]
+        with self._lock:
+            newer = {}
+            for obj in objects:
+                if isinstance(obj, dict) and obj.get("object") in VERSIONED_OBJECTS and obj.get("last_edited_time"):
+                    resource_id = normalize_id(obj["id"])
+                    if obj["last_edited_time"] > self._versions.get(resource_id, ""):  # Same iso format, so strings order like times
+                        self._versions[resource_id] = newer[resource_id] = obj["last_edited_time"]
+            if newer:
+                with self._connection:
+                    self._connection.executemany("INSERT OR REPLACE INTO versions VALUES (?, ?)", newer.items())
+
+    def get(self, key: str, resource_id: Optional[str] = None, listing: bool = False) -> Optional[Tuple[int, bytes]]:
+        """Looks up a response.
+
+        Args:
+            key (str): Method, url and credentials of the request, see CachingTransport.key.
+            resource_id (Optional[str], optional): Normalized id of the block, page or database the response belongs to, None to only
+                validate it by the ttl. Defaults to None.
+            listing (bool, optional): The response lists the children of resource_id, so it must also be younger than the ttl.
+                Defaults to False.
+
+        Returns:
+            Optional[Tuple[int, bytes]]: Status code and body, or None if there is no fresh entry.
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT version, stored_at, status, body FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            version, stored_at, status, body = row
+            if not self.offline:
+                known = self._versions.get(resource_id) if resource_id else None
+                validated = known is not None and version is not None
+                if listing:
+                    fresh = (not validated or known == version) and time.time() - stored_at < self.ttl
+                else:
+                    fresh = known == version if validated else time.time() - stored_at < self.ttl
+                if not fresh:
+                    self.stale += 1
+                    self.misses += 1
+                    return None
+
+            with self._connection:
+                self._connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+            return status, body
+
+    def put(self, key: str, status: int, body: bytes, resource_id: Optional[str] = None) -> None:
+        """Stores a response with the last_edited_time last seen for its resource, evicting the least recently used entries past max_size.
+
+        Args:
+            key (str): Method, url and credentials of the request, see CachingTransport.key.
+            status (int): Status code.
+            body (bytes): Response body.
+            resource_id (Optional[str], optional): Normalized id of the block, page or database the response belongs to, None to only
+                validate it by the ttl. Defaults to None.
+        """
+        if len(body) > self.max_size:
+            return
+        now = time.time()
+        with self._lock, self._connection:
+            old = self._connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._size -= old[0] if old else 0
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, resource_id, self._versions.get(resource_id) if resource_id else None, now, now, status, body, len(body)),
+            )
+            self._size += len(body)
+            while self._size > self.max_size:
+                oldest_key, size = self._connection.execute("SELECT key, size FROM responses ORDER BY accessed_at LIMIT 1").fetchone()
+                self._connection.execute("DELETE FROM responses WHERE key = ?", (oldest_key,))
+                self._size -= size
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """Deletes every entry. The last_edited_times seen are kept, as they are still true."""
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM responses")
+            self._size = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Copies the counters.
+
+        Returns:
+            Dict[str, Any]: "hits", "misses", "stale", "evictions", "entries", "size" in bytes and "hit_rate".
+        """
+        entries = len(self)
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "evictions": self.evictions,
+                "entries": entries,
+                "size": self._size,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+class CachingTransport(httpx.BaseTransport):
+    """httpx transport that answers GET requests, database queries and searches from a NotionCache and stores the successful ones it
+    sends on.
+
+    The bodies of every response, cached or not, update the last_edited_times the cache validates entries with. Children listings and
+    database queries are validated by the last_edited_time of their block or database and the ttl, searches only by the ttl. Requests
+    sent inside NotionCache.bypass skip the lookup unless offline. Offline, requests that are not cached raise httpx.ConnectError.
+    """
+
+    def __init__(self, cache: NotionCache, transport: httpx.BaseTransport):
+        self.cache = cache
+        self.transport = transport
+
+    @staticmethod
+    def cacheable(request: httpx.Request) -> bool:
+        """Whether a request only reads, i.e. is a GET request, a database query or a search."""
+        return request.method == "GET" or (request.method == "POST" and CACHED_POSTS.search(request.url.path) is not None)
+
+    @staticmethod
+    def key(request: httpx.Request) -> str:
+        """Method, path and query of a request, a hash of its body, and one of its credentials so integrations do not share entries."""
+        credentials = hashlib.sha256(request.headers.get("Authorization", "").encode()).hexdigest()[:16]
+        key = f"{request.method} {request.url.raw_path.decode()} {credentials}"
+        body = request.read()
+        return f"{key} {hashlib.sha256(body).hexdigest()[:16]}" if body else key
+
+    @staticmethod
+    def resource_id(request: httpx.Request) -> Optional[str]:
+        """Normalized id of the block, page or database a request reads or lists, None for searches."""
+        match = NOTION_ID.search(request.url.path)
+        return normalize_id(match.group()[1:]) if match else None
+
+    @staticmethod
+    def listing(request: httpx.Request) -> bool:
+        """Whether a request lists the children of a block or the rows of a database."""
+        return LISTINGS.search(request.url.path) is not None
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        cacheable = self.cacheable(request)
+        if cacheable:
+            key = self.key(request)
+            resource_id = self.resource_id(request)
+            cached = self.cache.get(key, resource_id, self.listing(request)) if self.cache.offline or not self.cache.bypassed else None
+            if cached is not None:
+                status, body = cached
+                self.cache.observe(body)
+                return httpx.Response(status, headers={"Content-Type": "application/json"}, content=body, request=request)
+
+        if self.cache.offline:
+            raise httpx.ConnectError(f"Not in the cache while offline: {request.method} {request.url}", request=request)
+
+        response = self.transport.handle_request(request)
+        if response.status_code != 200:
+            return response
+        body = response.read()
+        self.cache.observe(body)
+        if cacheable:
+            self.cache.put(key, response.status_code, body, resource_id)
+        return response
+
+    def close(self) -> None:
+        self.transport.close()
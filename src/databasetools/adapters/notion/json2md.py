@@ -1,16 +1,26 @@
-import json
+import math
+import os
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from datetime import timezone
 from pathlib import Path
 from types import MappingProxyType
 from typing import Any
+from typing import Callable
 from typing import Dict
+from typing import Generator
+from typing import Iterable
 from typing import List
 from typing import Optional
+from typing import TextIO
+from typing import Tuple
 from typing import Union
 
+from .utils import DATABASE_JSON
+from .utils import find_database_file
 from .utils import get_whitespace
+from .utils import iter_json_file
 from .utils import normalize_id
 
 ANNOTATION_TO_MARK_MAPPING = MappingProxyType(
@@ -22,6 +32,7 @@ ANNOTATION_TO_MARK_MAPPING = MappingProxyType(
         "code": "`",
     }
 )
+WRITE_BUFFER_SIZE = 2**16  # Characters of markdown JsonToMd.write_page joins before each write
 
 
 class Noop:
@@ -32,17 +43,79 @@ noop = Noop()
 
 
 rules = []
+dispatch: Dict[Tuple[type, Optional[str]], List[Callable]] = {}  # Rules that can match a python type and notion type, in rule order
 
 
-def rule(func):
-    rules.append(func)
-    return func
+def rule(func: Optional[Callable] = None, *, types: Tuple[type, ...] = (object,), notion_types: Optional[Tuple[str, ...]] = None):
+    """Registers a conversion rule.
+
+    Args:
+        func (Optional[Callable], optional): The rule, when used as a bare decorator.
+        types (Tuple[type, ...], optional): Python types of the values the rule can convert. Defaults to every type.
+        notion_types (Optional[Tuple[str, ...]], optional): "type"s of the dicts the rule can convert. Defaults to None, any dict.
+    """
+
+    def register(func: Callable) -> Callable:
+        func.types = types
+        func.notion_types = notion_types
+        rules.append(func)
+        dispatch.clear()
+        return func
+
+    return register(func) if func is not None else register
+
+
+def rules_for(cls: type, notion_type: Optional[str] = None) -> List[Callable]:
+    """The rules that can convert values of a python type and notion type, in the order they were registered.
+
+    >>> [rule.__name__ for rule in rules_for(str)]
+    ['apply_string']
+    >>> [rule.__name__ for rule in rules_for(dict, "paragraph")]
+    ['apply_href', 'apply_annotation', 'apply_dates', 'block_paragraph', 'unpack_type', 'apply_misc', 'apply_text']
+    """
+    candidates = dispatch.get((cls, notion_type))
+    if candidates is None:
+        candidates = dispatch[cls, notion_type] = [
+            rule for rule in rules if issubclass(cls, rule.types) and (rule.notion_types is None or notion_type in rule.notion_types)
+        ]
+    return candidates
+
+
+def convert_pages(pages: List[Tuple[Path, Path, Dict[str, Any]]]) -> List[Path]:
+    """Converts pages of blocks to markdown files. Module level, so a process pool can run it on chunks of pages.
+
+    Args:
+        pages (List[Tuple[Path, Path, Dict[str, Any]]]): Json path, markdown path and metadata of every page.
+
+    Returns:
+        List[Path]: The markdown files written.
+    """
+    for json_path, md_path, metadata in pages:
+        partial = md_path.with_name(f"{md_path.name}.partial")  # So a page that fails does not leave a truncated file that looks up to date
+        try:
+            with Path.open(partial, "w", encoding="utf-8") as f:
+                JsonToMd(metadata).write_page(iter_json_file(json_path), f)  # Reads a top level block at a time
+            partial.replace(md_path)
+        finally:
+            partial.unlink(missing_ok=True)
+    return [md_path for _, md_path, _ in pages]
 
 
 class JsonToMdConverter:
-    def __init__(self, strip_meta_chars=None, extension="md"):
+    """Converts a directory of downloaded Notion pages to markdown files.
+
+    Attributes:
+        stripchars (Optional[str]): Characters stripped from both ends of every metadata value.
+        extention (str): Extension of the markdown files.
+        max_workers (Optional[int]): Processes converting pages. Defaults to None, one per core. 1 converts in this process.
+        chunksize (Optional[int]): Pages sent to a process at a time. Defaults to None, about four chunks per process.
+    """
+
+    def __init__(self, strip_meta_chars=None, extension="md", max_workers: Optional[int] = None, chunksize: Optional[int] = None):
         self.stripchars = strip_meta_chars
         self.extention = extension
+        self.max_workers = max_workers
+        self.chunksize = chunksize
 
     def get_key(self, value):
         if self.stripchars is None:
@@ -54,8 +127,20 @@ class JsonToMdConverter:
         converter = JsonToMd(config={"apply_list": {"delimiter": ","}})
         return {key: self.get_key(converter.json2md(value)) for key, value in post["properties"].items() if converter.json2md(value)}
 
-    def convert(self, json_dir: Union[str, Path], md_dir: Union[str, Path]):
-        """Convert Notion JSON to markdown."""
+    def convert(self, json_dir: Union[str, Path], md_dir: Union[str, Path], force: bool = False):
+        """Convert Notion JSON to markdown.
+
+        Pages whose markdown file is newer than their json file are skipped. The rest are converted in a process pool, in chunks,
+        unless there are too few of them to outweigh starting the pool.
+
+        Args:
+            json_dir (Union[str, Path]): Directory of database.json, or database.ndjson, and a json file of blocks per page.
+            md_dir (Union[str, Path]): Directory the markdown files are written to.
+            force (bool, optional): Convert pages whose markdown file is up to date too. Defaults to False.
+
+        Returns:
+            Path: The markdown file if the directory holds a single page, otherwise md_dir.
+        """
         try:
             json_dir = Path(json_dir)
             json_dir.mkdir(parents=True, exist_ok=True)
@@ -67,25 +152,28 @@ class JsonToMdConverter:
             if not json_dir.exists() and not md_dir.exists():
                 raise e
 
-        with Path.open(json_dir / "database.json") as f:
-            page_id_to_metadata = {page["id"]: self.get_post_metadata(page) for page in json.load(f)}
-
-        paths = [path for path in Path.glob(json_dir, "*.json") if Path(path).name != "database.json"]
-        for path in paths:
-            with Path.open(path) as f:
-                blocks = json.load(f)
-                page_id = Path(path).stem
-                path = md_dir / f"{page_id}.{self.extention}"
-                if page_id not in page_id_to_metadata:  # page has been deleted
-                    continue
-                metadata = page_id_to_metadata[page_id]
-                markdown = JsonToMd(metadata).page2md(blocks)
-                with Path.open(path, "w", encoding="utf-8") as f:
-                    f.write(markdown)
-
-                if len(paths) == 1:
-                    return path
-
+        page_id_to_metadata = {page["id"]: self.get_post_metadata(page) for page in iter_json_file(find_database_file(json_dir))}
+
+        paths = [path for path in Path.glob(json_dir, "*.json") if Path(path).name != DATABASE_JSON]
+        pages = [
+            (path, md_dir / f"{path.stem}.{self.extention}", page_id_to_metadata[path.stem])
+            for path in paths
+            if path.stem in page_id_to_metadata  # Otherwise the page has been deleted
+        ]
+        pending = [page for page in pages if force or not page[1].exists() or page[1].stat().st_mtime < page[0].stat().st_mtime]
+
+        max_workers = self.max_workers or os.cpu_count() or 1
+        chunksize = self.chunksize or max(1, math.ceil(len(pending) / (max_workers * 4)))
+        chunks = [pending[i : i + chunksize] for i in range(0, len(pending), chunksize)]
+        if max_workers == 1 or len(chunks) <= 1:
+            for chunk in chunks:
+                convert_pages(chunk)
+        else:
+            with ProcessPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+                list(executor.map(convert_pages, chunks))
+
+        if len(paths) == 1 and pages:
+            return pages[0][1]
         return md_dir
 
 
@@ -148,7 +236,7 @@ class JsonToMd:
         self.config = config or {}
         self.state = defaultdict(dict)
 
-    @rule
+    @rule(types=(list,))
     def apply_list(self, value, prv=None, nxt=None):
         delimiter = (self.config or {}).get("apply_list", {}).get("delimiter", {}) or ""
         if isinstance(value, list):
@@ -165,13 +253,13 @@ class JsonToMd:
             return delimiter.join(filter(lambda s: s is not noop, pieces))
         return noop
 
-    @rule
+    @rule(types=(dict,))
     def apply_href(self, value, prv=None, nxt=None):
         if isinstance(value, dict) and value.get("href"):
             return f"[{value['plain_text']}]({value['href']})"  # TODO: href and annotations are not exclusive
         return noop
 
-    @rule
+    @rule(types=(dict,))
     def apply_annotation(
         self,
         value,
@@ -255,7 +343,7 @@ class JsonToMd:
             return text
         return noop
 
-    @rule
+    @rule(types=(dict,))
     def apply_dates(self, value, prv=None, nxt=None):
         if isinstance(value, dict):
             if value.get("start") and not value.get("end"):
@@ -263,7 +351,7 @@ class JsonToMd:
         # TODO: catch any other dates?
         return noop
 
-    @rule
+    @rule(types=(dict,), notion_types=tuple(f"heading_{i + 1}" for i in range(6)))
     def block_heading(self, value, prv=None, nxt=None):
         if isinstance(value, dict) and value.get("type", "").startswith("heading"):
             for i in range(6):
@@ -271,13 +359,13 @@ class JsonToMd:
                     return f"{'#' * (i + 1)} {self.json2md(value['heading_' + str(i + 1)]['rich_text'])}\n"
         return noop
 
-    @rule
+    @rule(types=(dict,), notion_types=("paragraph",))
     def block_paragraph(self, value, prv=None, nxt=None):
         if isinstance(value, dict) and value.get("type", "") == "paragraph":
             return f"{self.json2md(value['paragraph']['rich_text'])}\n"
         return noop
 
-    @rule
+    @rule(types=(dict,), notion_types=("callout",))
     def block_callout(self, value, prv=None, nxt=None):
         # Following this convention: https://docs.readme.com/rdmd/docs/callouts (callouts denoted by leading emoji)
         if isinstance(value, dict) and value.get("type", "") == "callout":
@@ -289,7 +377,7 @@ class JsonToMd:
             )
         return noop
 
-    @rule
+    @rule(types=(dict,), notion_types=("bookmark",))
     def block_bookmark(self, value, prv=None, nxt=None):
         """
         >>> c = JsonToMd()
@@ -303,7 +391,7 @@ class JsonToMd:
             return f"[External Link]({url})"
         return noop
 
-    @rule
+    @rule(types=(dict,), notion_types=("divider",))
     def block_divider(self, value, prv=None, nxt=None):
         """
         >>> c = JsonToMd()
@@ -315,7 +403,7 @@ class JsonToMd:
             return "<div></div>"
         return noop
 
-    @rule
+    @rule(types=(dict,), notion_types=("bulleted_list_item", "numbered_list_item"))
     def block_item(self, value, prv=None, nxt=None):
         """
         >>> c = JsonToMd()
@@ -339,7 +427,7 @@ class JsonToMd:
             return "\n".join(lines)
         return noop
 
-    @rule
+    @rule(types=(dict,), notion_types=("external",))
     def apply_file(self, value, prv=None, nxt=None):
         """
         >>> c = JsonToMd()
@@ -354,7 +442,7 @@ class JsonToMd:
                 return f"![{caption}]({url})"
         return noop
 
-    @rule
+    @rule(types=(dict,), notion_types=("quote",))
     def block_quote(self, value, prv=None, nxt=None):
         """
         >>> c = JsonToMd()
@@ -367,19 +455,19 @@ class JsonToMd:
             return "\n> ".join(out.splitlines())
         return noop
 
-    @rule
+    @rule(types=(dict,), notion_types=("to_do",))
     def block_to_do(self, value, prv=None, nxt=None):
         if isinstance(value, dict) and value.get("type", "") == "to_do":
             return f"- [ ] {self.json2md(value['to_do']['rich_text'])}{self.jsons2md(value['children'])}"
         return noop
 
-    @rule
+    @rule(types=(dict,), notion_types=("code",))
     def block_code(self, value, prv=None, nxt=None):
         if isinstance(value, dict) and value.get("type", "") == "code":
             return f"```{value['code']['language']}\n{self.json2md(value['code']['rich_text'])}\n```"
         return noop
 
-    @rule
+    @rule(types=(dict,), notion_types=("table",))
     def block_table(self, value, prv=None, nxt=None):
         if isinstance(value, dict) and value.get("type", "") == "table":
             lines = []
@@ -394,7 +482,7 @@ class JsonToMd:
             return "\n".join(lines)
         return noop
 
-    @rule
+    @rule(types=(dict,), notion_types=("image",))
     def block_image(self, value, prv=None, nxt=None):
         """
         Options:
@@ -420,7 +508,7 @@ class JsonToMd:
                 return f"![]({url})"
         return noop
 
-    @rule
+    @rule(types=(dict,), notion_types=("toggle",))
     def block_toggle(self, value, prv=None, nxt=None):
         if isinstance(value, dict) and value.get("type", "") == "toggle":
             return (
@@ -428,7 +516,7 @@ class JsonToMd:
             )
         return noop
 
-    @rule
+    @rule(types=(dict,), notion_types=("equation",))
     def block_math(self, value, prv=None, nxt=None):
         """
         After including this in your markdown or HTML, you can then render the math using [MathJax](https://github.com/mathjax/MathJax).
@@ -440,13 +528,13 @@ class JsonToMd:
             return f"${expression}$"
         return noop
 
-    @rule
+    @rule(types=(dict,))
     def unpack_type(self, value, prv=None, nxt=None):
         if isinstance(value, dict) and "type" in value:
             return self.json2md(value[value["type"]])
         return noop
 
-    @rule
+    @rule(types=(dict,))
     def apply_misc(self, value, prv=None, nxt=None):
         if isinstance(value, dict):
             for key in (
@@ -459,19 +547,19 @@ class JsonToMd:
                 return normalize_id(value["id"])
         return noop
 
-    @rule
+    @rule(types=(dict,))
     def apply_text(self, value, prv=None, nxt=None):
         if isinstance(value, dict) and "text" in value:
             return value["text"]["content"]
         return noop
 
-    @rule
+    @rule(types=(str,))
     def apply_string(self, value, prv=None, nxt=None):
         if isinstance(value, str):
             return value
         return noop
 
-    @rule
+    @rule(types=(type(None),))
     def apply_none(self, value, prv=None, nxt=None):
         if value is None:
             return ""
@@ -480,44 +568,72 @@ class JsonToMd:
     def json2md(self, value: Union[str, List, dict], prv=None, nxt=None) -> str:
         """
         Lower-level conversion from notion JSON to markdown. This is the core of
-        the conversion logic.
+        the conversion logic. Only the rules that can match the python type of
+        the value, and the "type" of a dict, are tried, in rule order.
         """
-        for rule in rules:
+        for rule in rules_for(type(value), value.get("type") if isinstance(value, dict) else None):
             if (md := rule(self, value, prv, nxt)) is not noop:
                 return md
 
         return noop
 
-    def jsons2md(self, blocks: List) -> str:
+    def iter_jsons2md(self, blocks: Iterable[dict]) -> Generator[str, None, None]:
         """
-        Top-level conversion from notion JSON to markdown. In this top-level, we
-        add line breaks in between block types.
+        Top-level conversion from notion JSON to markdown, as fragments. In this
+        top-level, we add line breaks in between block types. Blocks can be any
+        iterable, e.g. one reading them from a file, only the previous and next
+        ones are kept.
         """
-        result, cur = "", None
-        for i in range(len(blocks)):
-            cur = blocks[i]
-            prv = blocks[i - 1] if i > 0 else None
-            nxt = blocks[i + 1] if i + 1 < len(blocks) else None
-            if (md := self.json2md(cur, prv, nxt)) is not noop:
-                result += "\n" + md
-            else:
+        blocks = iter(blocks)
+        prv, cur = None, next(blocks, None)
+        while cur is not None:
+            nxt = next(blocks, None)
+            if (md := self.json2md(cur, prv, nxt)) is noop:
                 raise NotImplementedError(f"Unsupported block type: {cur['type']}")
+            yield "\n"
+            yield md
 
             if cur["type"] != (nxt and nxt["type"]):
-                result += "\n"
+                yield "\n"
 
             if cur["type"] == "callout" and (nxt and nxt["type"] == "callout"):
-                result += "\n<div></div>\n"  # weird property of blockquote parsing: https://stackoverflow.com/a/13066620/4855984
-        return result
+                yield "\n<div></div>\n"  # weird property of blockquote parsing: https://stackoverflow.com/a/13066620/4855984
+            prv, cur = cur, nxt
 
-    def page2md(self, blocks: List[dict]) -> str:
-        """Converts a notion page to markdown."""
-        markdown = "---\n"
+    def jsons2md(self, blocks: List) -> str:
+        """
+        Top-level conversion from notion JSON to markdown. In this top-level, we
+        add line breaks in between block types.
+        """
+        return "".join(self.iter_jsons2md(blocks))
+
+    def iter_page2md(self, blocks: Iterable[dict]) -> Generator[str, None, None]:
+        """Converts a notion page to markdown, as fragments."""
+        yield "---\n"
         for key, value in self.metadata.items():
             if value:
-                markdown += f"{key}: {value}\n"
-        markdown += "---\n\n"
+                yield f"{key}: {value}\n"
+        yield "---\n\n"
         if title := self.metadata.get("Name") or self.metadata.get("title"):
-            markdown += f"# {title}\n\n"
-        markdown += self.jsons2md(blocks)
-        return markdown
+            yield f"# {title}\n\n"
+        yield from self.iter_jsons2md(blocks)
+
+    def page2md(self, blocks: List[dict]) -> str:
+        """Converts a notion page to markdown."""
+        return "".join(self.iter_page2md(blocks))
+
+    def write_page(self, blocks: Iterable[dict], f: TextIO) -> None:
+        """Writes a notion page as markdown, in batches of about WRITE_BUFFER_SIZE characters, without holding the whole page in memory.
+
+        Args:
+            blocks (Iterable[dict]): Top level blocks of the page.
+            f (TextIO): File to write to.
+        """
+        buffer, size = [], 0
+        for fragment in self.iter_page2md(blocks):
+            buffer.append(fragment)
+            size += len(fragment)
+            if size >= WRITE_BUFFER_SIZE:
+                f.write("".join(buffer))
+                buffer, size = [], 0
+        f.write("".join(buffer))
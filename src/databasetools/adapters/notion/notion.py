@@ -25,10 +25,19 @@ This module provides tools to interact with the Notion API, enabling data manage
 
 6. **NotionIO**:
    - Handles loading and saving Notion pages and blocks to/from JSON files.
+   - Reads files an item at a time, writes compact JSON (with orjson if installed) and newline delimited JSON (.ndjson).
 
 7. **LastEditedToDateTime**:
    - Helper class for converting 'last_edited_time' values to datetime objects.
 
+8. **ThrottledTransport**:
+   - Sends the requests of every NotionClient through one shared RequestScheduler (see shared_scheduler).
+   - Rate limits to Notion's ~3 requests per second, serves metadata requests before bulk block fetches and honors Retry-After.
+
+9. **NotionCache** (see cache.py):
+   - Optional SQLite cache of GET responses, database queries and searches in front of the ThrottledTransport, so cache hits use no request budget.
+   - Entries are validated by the last_edited_time seen in newer responses, e.g. database queries, which is kept across restarts, or by a ttl, and can be served offline.
+
 ### Usage Examples
 - **Downloading Pages**:
     ```python
@@ -44,17 +53,25 @@ This module provides tools to interact with the Notion API, enabling data manage
 
 import json
 import os
+import threading
+import time
 from abc import ABC
 from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
 from pathlib import Path
 from typing import Any
 from typing import Dict
+from typing import Generator
 from typing import List
 from typing import Optional
 from typing import Tuple
 from typing import Union
 
+import httpx
 from fuzzywuzzy import fuzz
 from notion_client import Client
 from notion_client.helpers import iterate_paginated_api as paginate
@@ -62,17 +79,122 @@ from notion_objects import Database
 from notion_objects import NotionObject
 from notion_objects import Page
 
+from databasetools.utils.rate_limit import RequestScheduler
+from databasetools.utils.rate_limit import RequestStats
+from databasetools.utils.rate_limit import TokenBucket
+from databasetools.utils.rate_limit import parse_retry_after
+
 # import networkx as nx
 # import matplotlib.pyplot as plt
 # G = nx.DiGraph()
+from .cache import CachingTransport
+from .cache import NotionCache
 from .json2md import JsonToMdConverter
+from .utils import DATABASE_JSON
+from .utils import DATABASE_NDJSON
+from .utils import NDJSON_SUFFIXES
+from .utils import NOTION_ID
+from .utils import find_database_file
 from .utils import find_title_prop
 from .utils import get_title_content
+from .utils import iter_json_file
 from .utils import logger
 from .utils import normalize_id
 from .utils import slugify
 
+try:
+    import orjson
+except ImportError:  # Optional, compact NotionIO files are written with json without it
+    orjson = None
+
 NOTION_API_KEY = os.getenv("NOTION_API_KEY", None)
+NOTION_REQUESTS_PER_SECOND = 3.0  # Average rate Notion allows per integration
+
+METADATA_PRIORITY = 0
+BULK_PRIORITY = 1
+
+_shared_scheduler: Optional[RequestScheduler] = None
+_shared_scheduler_lock = threading.Lock()
+
+
+def shared_scheduler() -> RequestScheduler:
+    """The request scheduler every Notion client in the process uses unless it is given its own."""
+    global _shared_scheduler
+    with _shared_scheduler_lock:
+        if _shared_scheduler is None:
+            _shared_scheduler = RequestScheduler(TokenBucket(NOTION_REQUESTS_PER_SECOND))
+        return _shared_scheduler
+
+
+class ThrottledTransport(httpx.BaseTransport):
+    """httpx transport that sends every request through a shared request scheduler, retries with backoff and records per endpoint stats.
+
+    Block children listings, the bulk of a download, wait behind every other request. 429 and 503 responses with a Retry-After header
+    pause the scheduler's token bucket, so every request sharing it waits, not only the one that was throttled.
+    """
+
+    RETRY_STATUSES = (429, 502, 503, 504)
+    BULK_ENDPOINTS = ("GET /v1/blocks/{id}/children",)
+
+    def __init__(
+        self,
+        scheduler: RequestScheduler,
+        stats: RequestStats,
+        retries: int = 5,
+        backoff_factor: float = 0.5,
+        backoff_max: float = 60.0,
+        transport: Optional[httpx.BaseTransport] = None,
+    ):
+        self.scheduler = scheduler
+        self.stats = stats
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.transport = transport if transport is not None else httpx.HTTPTransport()
+
+    @staticmethod
+    def endpoint(request: httpx.Request) -> str:
+        """Names the endpoint of a request with ids replaced, e.g. "GET /v1/blocks/{id}/children"."""
+        return f"{request.method} {NOTION_ID.sub('/{id}', request.url.path)}"
+
+    def priority(self, endpoint: str) -> int:
+        return BULK_PRIORITY if endpoint in self.BULK_ENDPOINTS else METADATA_PRIORITY
+
+    def backoff(self, retry: int) -> float:
+        return min(self.backoff_max, self.backoff_factor * 2 ** (retry - 1))
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        endpoint = self.endpoint(request)
+        priority = self.priority(endpoint)
+        start = time.perf_counter()
+        retry = 0
+        while True:
+            self.scheduler.acquire(priority)
+            try:
+                response = self.transport.handle_request(request)
+            except httpx.TransportError:
+                if retry >= self.retries:
+                    self.stats.record(endpoint, time.perf_counter() - start, retry, error=True)
+                    raise
+                retry += 1
+                time.sleep(self.backoff(retry))
+                continue
+
+            if response.status_code not in self.RETRY_STATUSES or retry >= self.retries:
+                self.stats.record(endpoint, time.perf_counter() - start, retry, error=response.status_code >= 400)
+                return response
+
+            retry += 1
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            response.close()
+            if retry_after is not None and response.status_code in (429, 503):
+                logger.debug(f"{endpoint} throttled, pausing requests for {retry_after}s")
+                self.scheduler.limiter.pause(retry_after)
+            else:
+                time.sleep(self.backoff(retry))
+
+    def close(self) -> None:
+        self.transport.close()
 
 
 class BaseTransformer(ABC):
@@ -119,15 +241,47 @@ class LastEditedToDateTime(BaseTransformer):
 
 
 class NotionIO:
-    def __init__(self, transformer: BaseTransformer):
+    """Loads and saves lists of blocks or pages as json files.
+
+    Files are read an item at a time, so only the transformed items are held in memory. Files whose suffix is one of NDJSON_SUFFIXES
+    hold one item per line.
+
+    Attributes:
+        transformer (BaseTransformer): Applied to every item loaded, and serializes what json cannot.
+        compact (bool): Write without indentation, with orjson if it is installed. Defaults to False.
+    """
+
+    def __init__(self, transformer: BaseTransformer, compact: bool = False):
         self.transformer = transformer
+        self.compact = compact
+
+    def iter_load(self, path: Union[str, Path]) -> Generator[dict, None, None]:
+        """Load blocks from json file one at a time."""
+        if Path(path).exists():
+            for item in iter_json_file(path):
+                yield self.transformer.forward([item])[0]
 
     def load(self, path: Union[str, Path]) -> List[dict]:
         """Load blocks from json file."""
-        if Path(path).exists():
-            with Path.open(path) as f:
-                return self.transformer.forward(json.load(f))
-        return []
+        return list(self.iter_load(path))
+
+    def json_options(self, compact: bool) -> Dict[str, Any]:
+        return {"default": self.transformer.reverse, **({"separators": (",", ":")} if compact else {"indent": 4})}
+
+    def dumps(self, obj: Any, compact: Optional[bool] = None) -> bytes:
+        """Serializes to json, with orjson if it is compact and orjson is installed.
+
+        Args:
+            obj (Any): What to serialize.
+            compact (Optional[bool], optional): Overrides the compact attribute. Defaults to None.
+
+        Returns:
+            bytes: Utf-8 encoded json.
+        """
+        compact = self.compact if compact is None else compact
+        if compact and orjson is not None:
+            return orjson.dumps(obj, default=self.transformer.reverse, option=orjson.OPT_PASSTHROUGH_DATETIME)
+        return json.dumps(obj, **self.json_options(compact)).encode()
 
     def save(self, blocks: List[dict], path: Union[str, Path], overwrite: bool = False):
         """Dump blocks to json file."""
@@ -143,8 +297,66 @@ class NotionIO:
         if path.exists() and not overwrite:
             raise FileExistsError(f"File already exists: {path}")
 
-        with Path.open(path, "w") as f:
-            json.dump(blocks, f, default=self.transformer.reverse, indent=4)
+        if path.suffix in NDJSON_SUFFIXES:
+            with Path.open(path, "wb") as f:
+                f.writelines(self.dumps(block, compact=True) + b"\n" for block in blocks)
+        elif self.compact and orjson is not None:
+            path.write_bytes(self.dumps(blocks))
+        else:
+            with Path.open(path, "w", encoding="utf-8") as f:
+                json.dump(blocks, f, **self.json_options(self.compact))
+
+
+def walk_blocks(blocks: List[dict], parent_id: Optional[str] = None) -> Generator[Tuple[dict, Optional[str]], None, None]:
+    """Yields every block of a tree depth first, with the id of its parent.
+
+    Args:
+        blocks (List[dict]): Top level blocks, each with its own "children".
+        parent_id (Optional[str], optional): Parent id given for the top level blocks. Defaults to None.
+
+    Yields:
+        Generator[Tuple[dict, Optional[str]], None, None]: Each block and the id of its parent.
+    """
+    stack = [(block, parent_id) for block in reversed(blocks)]
+    while stack:
+        block, parent = stack.pop()
+        yield block, parent
+        stack.extend((child, block["id"]) for child in reversed(block.get("children") or []))
+
+
+def diff_blocks(old: List[dict], new: List[dict]) -> List[Dict[str, Any]]:
+    """Lists the changes between two versions of a block tree.
+
+    Args:
+        old (List[dict]): Previous tree.
+        new (List[dict]): Current tree.
+
+    Returns:
+        List[Dict[str, Any]]: One patch per changed block, in the order of the current tree then the removed blocks. Each has the
+            "op" ("add", "update" or "remove"), the block "id" and its "parent". Added and updated blocks also have "last_edited_time"
+            and the "block" without its children.
+    """
+    old_blocks = {block["id"]: (block, parent) for block, parent in walk_blocks(old)}
+    patches = []
+    seen = set()
+    for block, parent in walk_blocks(new):
+        seen.add(block["id"])
+        previous = old_blocks.get(block["id"])
+        if previous is not None and previous[0]["last_edited_time"] == block["last_edited_time"] and previous[1] == parent:
+            continue
+        patches.append(
+            {
+                "op": "add" if previous is None else "update",
+                "id": block["id"],
+                "parent": parent,
+                "last_edited_time": block["last_edited_time"],
+                "block": {key: value for key, value in block.items() if key != "children"},
+            }
+        )
+    patches.extend(
+        {"op": "remove", "id": block_id, "parent": parent} for block_id, (_, parent) in old_blocks.items() if block_id not in seen
+    )
+    return patches
 
 
 class NotionClient:
@@ -156,7 +368,11 @@ class NotionClient:
     Attributes:
         token (str): The authentication token for accessing the Notion API.
         filter (Optional[dict]): Optional filter for database queries.
-        client (Client): The Notion client object.
+        max_workers (int): Most requests a single call keeps in flight. Notion allows about 3 requests per second.
+        scheduler (RequestScheduler): Rate limits every request. Shared by all clients in the process unless one is given.
+        stats (RequestStats): Per endpoint request, retry, error and latency counters of this client.
+        cache (Optional[NotionCache]): Answers repeated GET requests, database queries and searches without sending them. Defaults to None.
+        client (Client): The Notion client object. Its requests go through the cache, then the scheduler.
         transformer (LastEditedToDateTime): Utility for transforming date-time fields.
 
     Methods:
@@ -172,7 +388,7 @@ class NotionClient:
         get_blocks(block_id: int) -> List:
             Fetches all page blocks and their descendants recursively.
 
-        get_database(database_id: str) -> List:
+        get_database(database_id: str, refresh: bool = False) -> List:
             Fetches pages within a specified database as JSON.
 
     Example Usage:
@@ -197,10 +413,26 @@ class NotionClient:
     ```
     """
 
-    def __init__(self, token: str, transformer: LastEditedToDateTime = None, filter: Optional[dict] = None):
+    def __init__(
+        self,
+        token: str,
+        transformer: LastEditedToDateTime = None,
+        filter: Optional[dict] = None,
+        max_workers: int = 3,
+        scheduler: Optional[RequestScheduler] = None,
+        retries: int = 5,
+        transport: Optional[httpx.BaseTransport] = None,
+        cache: Optional[NotionCache] = None,
+    ):
         self.token = token
         self.filter = filter
-        self.client = Client(auth=token)
+        self.max_workers = max_workers
+        self.scheduler = scheduler if scheduler is not None else shared_scheduler()
+        self.stats = RequestStats()
+        self.cache = cache
+        throttled = ThrottledTransport(self.scheduler, self.stats, retries, transport=transport)
+        transport = CachingTransport(cache, throttled) if cache is not None else throttled
+        self.client = Client(auth=token, client=httpx.Client(transport=transport))
         self.transformer = transformer if transformer else LastEditedToDateTime()
 
     def get_metadata(self, page_id: str) -> Dict[str, Any]:
@@ -214,6 +446,11 @@ class NotionClient:
         """
         return self.transformer.forward([self.client.pages.retrieve(page_id=page_id)])[0]
 
+    @property
+    def request_stats(self) -> Dict[str, Dict[str, float]]:
+        """Per endpoint request, retry, error and latency counters of every call made through this client."""
+        return self.stats.snapshot()
+
     def get_recent_pages(self, query: Optional[str] = None) -> List[Dict[str, Any]]:
         """Get Recent Pages via Search Query.
 
@@ -235,42 +472,106 @@ class NotionClient:
 
         return self.client.search(**payload).get("results")
 
-    def get_blocks(self, block_id: int) -> List:
+    def get_blocks(self, block_id: int, previous: Optional[List[dict]] = None) -> List:
         """Get all page blocks as json. Recursively fetches descendants.
 
+        The tree is fetched a level at a time, listing the children of every block on a level concurrently with at most max_workers
+        requests in flight. The result is in the same order as fetching the tree depth first. A block whose children fail to
+        download is logged and left out of the result.
+
         Args:
             block_id (int): Block ID
+            previous (Optional[List[dict]], optional): Earlier result for the same block, with datetime last_edited_times. The
+                children of a block whose last_edited_time has not moved are taken from it instead of fetched again. Notion does not
+                always move a block's last_edited_time when only its descendants change, so pass None to fetch everything. Defaults
+                to None.
 
         Returns:
             List: List of page blocks
         """
-        blocks = []
-        results = paginate(self.client.blocks.children.list, block_id=block_id)
-        for child in results:
-            try:
-                child["children"] = list(self.get_blocks(child["id"])) if child["has_children"] else []
-                blocks.append(child)
-            except Exception as e:
-                logger.error(f"Error: {e}")
+        previous_blocks = {block["id"]: block for block, _ in walk_blocks(previous)} if previous else {}
+        blocks, raw_ids = self._list_children(block_id)
+        level = [(child, raw_id, blocks) for child, raw_id in zip(blocks, raw_ids)]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while level:
+                parents = []
+                for child, raw_id, siblings in level:
+                    old = previous_blocks.get(child["id"])
+                    if not child["has_children"]:
+                        child["children"] = []
+                    elif old is not None and old["last_edited_time"] == child["last_edited_time"] and "children" in old:
+                        child["children"] = old["children"]
+                    else:
+                        parents.append((child, siblings, executor.submit(self._list_children, raw_id)))
+
+                level = []
+                for parent, siblings, future in parents:
+                    try:
+                        children, raw_ids = future.result()
+                    except Exception as e:
+                        logger.error(f"Error: {e}")
+                        siblings[:] = [sibling for sibling in siblings if sibling is not parent]
+                        continue
+                    parent["children"] = children
+                    level.extend((child, raw_id, children) for child, raw_id in zip(children, raw_ids))
+
+        return blocks
+
+    def _list_children(self, block_id: str) -> Tuple[List[Dict[str, Any]], List[str]]:
+        """Lists the direct children of a block, and their ids as the api returned them."""
+        results = list(paginate(self.client.blocks.children.list, block_id=block_id))
+        return list(self.transformer.forward(results)), [child["id"] for child in results]
+
+    def get_database(self, database_id: str, refresh: bool = False, edited_since: Optional[datetime] = None) -> List:
+        """Fetch pages in database as json.
+
+        Args:
+            database_id (str): Database ID
+            refresh (bool, optional): Retrieve every page again after the query, concurrently with at most max_workers requests in
+                flight. The query already returns the same page objects, so this is only needed to get changes made while paging
+                through a large database. Defaults to False.
+            edited_since (Optional[datetime], optional): Only fetch pages last edited on or after this UTC time. Defaults to None.
 
-        return list(self.transformer.forward(blocks))
+        Returns:
+            List: List of pages
+        """
+        query_filter = self.filter
+        if edited_since is not None:
+            since = {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": self.transformer.reverse(edited_since)}}
+            query_filter = {"and": [query_filter, since]} if query_filter else since
 
-    def get_database(self, database_id: str) -> List:
-        """Fetch pages in database as json."""
-        if self.filter:
+        if query_filter:
             results = paginate(
                 self.client.databases.query,
                 database_id=database_id,
-                filter=self.filter,
+                filter=query_filter,
             )
         else:
             results = paginate(
                 self.client.databases.query,
                 database_id=database_id,
             )
-        pages = [self.client.pages.retrieve(page_id=pg["id"]) for pg in results]
+        pages = list(results)
+        if refresh:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                pages = list(executor.map(lambda pg: self.client.pages.retrieve(page_id=pg["id"]), pages))
         return list(self.transformer.forward(pages))
 
+    def get_database_ids(self, database_id: str) -> List[str]:
+        """Fetch the ids of the pages in a database, with only the title property of each page to keep the responses small. The ids
+        are used to detect deleted pages, so they are never answered from the cache.
+
+        Args:
+            database_id (str): Database ID
+
+        Returns:
+            List[str]: Normalized page ids
+        """
+        kwargs = {"filter": self.filter} if self.filter else {}
+        results = paginate(self.client.databases.query, database_id=database_id, filter_properties=["title"], page_size=100, **kwargs)
+        with self.cache.bypass() if self.cache is not None else nullcontext():
+            return [normalize_id(page["id"]) for page in results]
+
 
 class NotionDownloader:
     """
@@ -287,11 +588,11 @@ class NotionDownloader:
         download_url(url: str, out_dir: Union[str, Path] = "./json"):
             Downloads the Notion page or database from a URL and saves it as JSON.
 
-        download_page(page_id: str, out_path: Union[str, Path] = "./json", fetch_metadata: bool = True):
-            Downloads a specific Notion page and its blocks. Metadata is optionally fetched and saved.
+        download_page(page_id: str, out_path: Union[str, Path] = "./json", fetch_metadata: bool = True, overwrite: bool = False, delta: bool = False):
+            Downloads a specific Notion page and its blocks. Metadata is optionally fetched and saved. Unchanged subtrees are optionally reused.
 
-        download_database(database_id: str, out_dir: Union[str, Path] = "./json"):
-            Downloads all pages and data from a specified Notion database.
+        download_database(database_id: str, out_dir: Union[str, Path] = "./json", incremental: bool = True, detect_deletions: bool = True, delta: bool = False):
+            Downloads the pages of a specified Notion database that changed since the last download, and removes deleted ones.
 
     Example Usage:
     --------------
@@ -310,10 +611,15 @@ class NotionDownloader:
     ```
     """
 
-    def __init__(self, token: str, filter: Optional[str] = None):
+    SYNC_STATE = "sync_state.json"
+    PATCH_LOG_SUFFIX = ".patches.jsonl"
+    WATERMARK_OVERLAP = timedelta(minutes=2)
+
+    def __init__(self, token: str, filter: Optional[str] = None, compact: bool = False, ndjson: bool = False):
         self.transformer = LastEditedToDateTime()
-        self.io = NotionIO(self.transformer)
+        self.io = NotionIO(self.transformer, compact=compact)
         self.notion = NotionClient(token=token, transformer=self.transformer, filter=filter)
+        self.database_file = DATABASE_NDJSON if ndjson else DATABASE_JSON
 
     def download_url(self, url: str, out_dir: Union[str, Path] = "./json"):
         """Download the notion page or database."""
@@ -325,30 +631,142 @@ class NotionDownloader:
         else:
             self.download_database(slug, out_dir)
 
-    def download_page(self, page_id: str, out_path: Union[str, Path] = "./json", fetch_metadata: bool = True):
-        """Download the notion page."""
+    def download_page(
+        self,
+        page_id: str,
+        out_path: Union[str, Path] = "./json",
+        fetch_metadata: bool = True,
+        overwrite: bool = False,
+        delta: bool = False,
+    ) -> Optional[List[Dict[str, Any]]]:
+        """Download the notion page.
+
+        With delta, the blocks saved at out_path by an earlier download are reused for every subtree whose parent block's
+        last_edited_time has not moved, and the changes are appended to a patch log next to out_path (see NotionClient.get_blocks for
+        the limits of this).
+
+        Args:
+            page_id (str): Page ID
+            out_path (Union[str, Path], optional): Json file of the blocks. Defaults to "./json".
+            fetch_metadata (bool, optional): Also save the page metadata to database.json. Defaults to True.
+            overwrite (bool, optional): Replace existing files. Defaults to False.
+            delta (bool, optional): Only fetch changed subtrees and log the changes. Needs overwrite. Defaults to False.
+
+        Returns:
+            Optional[List[Dict[str, Any]]]: Changes since the earlier download (see diff_blocks), or None if there was none to compare to.
+
+        Raises:
+            ValueError: If delta is set without overwrite.
+        """
+        if delta and not overwrite:
+            raise ValueError("delta replaces the earlier download, pass overwrite=True")
         out_path = Path(out_path)
         out_path.parent.mkdir(parents=True, exist_ok=True)
-        blocks = self.notion.get_blocks(page_id)
-        self.io.save(blocks, out_path)
+        previous = self.load_blocks(out_path) if delta and out_path.exists() else None
+        blocks = self.notion.get_blocks(page_id, previous)
+        self.io.save(blocks, out_path, overwrite=overwrite)
+
+        patches = None
+        if previous is not None:
+            patches = diff_blocks(previous, blocks)
+            if patches:
+                entry = {"synced_at": datetime.now(timezone.utc).replace(tzinfo=None), "page_id": page_id, "patches": patches}
+                with Path.open(out_path.with_suffix(self.PATCH_LOG_SUFFIX), "a") as f:
+                    f.write(json.dumps(entry, default=self.transformer.reverse) + "\n")
 
         if fetch_metadata:
             metadata = self.notion.get_metadata(page_id)
-            self.io.save([metadata], out_path.parent / "database.json")
+            self.io.save([metadata], out_path.parent / self.database_file, overwrite=overwrite)
+        return patches
+
+    def load_blocks(self, path: Union[str, Path]) -> List[dict]:
+        """Loads a saved block tree with the transformer applied at every level, not only the top one like NotionIO.load."""
+        blocks = self.io.load(path)
+        stack = list(blocks)
+        while stack:
+            block = stack.pop()
+            if block.get("children"):
+                block["children"] = self.transformer.forward(block["children"])
+                stack.extend(block["children"])
+        return blocks
+
+    def download_database(
+        self,
+        database_id: str,
+        out_dir: Union[str, Path] = "./json",
+        incremental: bool = True,
+        detect_deletions: bool = True,
+        delta: bool = False,
+    ) -> Dict[str, List[str]]:
+        """Download the notion database and associated pages.
 
-    def download_database(self, database_id: str, out_dir: Union[str, Path] = "./json"):
-        """Download the notion database and associated pages."""
+        After the first download the time of each sync is kept in SYNC_STATE. Later syncs only query the pages edited since then,
+        minus WATERMARK_OVERLAP because Notion rounds last_edited_time down to the minute, and download the changed pages concurrently.
+        Deleted pages are found by listing the ids of the database, which takes one small request per 100 pages.
+
+        Args:
+            database_id (str): Database ID
+            out_dir (Union[str, Path], optional): Directory of database.json and a json file per page. Defaults to "./json".
+            incremental (bool, optional): Only query pages edited since the last sync. Defaults to True.
+            detect_deletions (bool, optional): List the ids of the database in incremental syncs to remove pages that are no longer in
+                it. Full downloads always remove them. Defaults to True.
+            delta (bool, optional): Only fetch the changed subtrees of changed pages, see download_page. Defaults to False.
+
+        Returns:
+            Dict[str, List[str]]: Ids of the "downloaded" and "deleted" pages.
+        """
         out_dir = Path(out_dir)
         out_dir.mkdir(parents=True, exist_ok=True)
-        path = out_dir / "database.json"
-        prev = {pg["id"]: pg["last_edited_time"] for pg in self.io.load(path)}
-        pages = self.notion.get_database(database_id)  # download database
-        self.io.save(pages, path)
-
-        for cur in pages:  # download individual pages in database IF updated
-            if prev.get(cur["id"], datetime(1, 1, 1, tzinfo=cur["last_edited_time"].tzinfo)) < cur["last_edited_time"]:
-                self.download_page(cur["id"], out_dir / f"{cur['id']}.json", False)
-                logger.info(f"Downloaded {cur['url']}")
+        path = out_dir / self.database_file
+        previous_path = find_database_file(out_dir)  # Differs from path when the format changed
+        state_path = out_dir / self.SYNC_STATE
+        synced_at = datetime.now(timezone.utc).replace(tzinfo=None)
+
+        rows = {pg["id"]: pg for pg in self.io.iter_load(previous_path)}
+        prev = {page_id: pg["last_edited_time"] for page_id, pg in rows.items()}
+        state = json.loads(state_path.read_text()) if state_path.exists() else {}
+        since = None
+        if incremental and rows and state.get("database_id") == database_id:
+            since = datetime.fromisoformat(state["synced_at"].removesuffix("Z")) - self.WATERMARK_OVERLAP
+
+        pages = self.notion.get_database(database_id, edited_since=since)  # download database
+        oldest = datetime(1, 1, 1)  # noqa: DTZ001 The transformer yields naive UTC times
+        changed = [
+            cur["id"]
+            for cur in pages
+            if prev.get(cur["id"], oldest) < cur["last_edited_time"] or (since is not None and cur["last_edited_time"] >= since)
+        ]
+        rows.update((pg["id"], pg) for pg in pages)
+
+        current_ids = None
+        if since is None:  # A full query has every page
+            current_ids = {pg["id"] for pg in pages}
+        elif detect_deletions:
+            current_ids = set(self.notion.get_database_ids(database_id))
+        deleted = [page_id for page_id in rows if page_id not in current_ids] if current_ids is not None else []
+
+        def download(page_id: str):  # download individual pages in database IF updated
+            self.download_page(page_id, out_dir / f"{page_id}.json", False, overwrite=True, delta=delta)
+            logger.info(f"Downloaded {rows[page_id]['url']}")
+
+        with ThreadPoolExecutor(max_workers=self.notion.max_workers) as executor:
+            list(executor.map(download, changed))
+
+        for page_id in deleted:
+            del rows[page_id]
+            (out_dir / f"{page_id}.json").unlink(missing_ok=True)
+            (out_dir / f"{page_id}{self.PATCH_LOG_SUFFIX}").unlink(missing_ok=True)
+            logger.info(f"Removed deleted page {page_id}")
+
+        # Written last, so pages that failed to download are queried again by the next sync
+        if rows:
+            self.io.save(list(rows.values()), path, overwrite=True)
+        else:
+            path.unlink(missing_ok=True)
+        if previous_path != path:
+            previous_path.unlink(missing_ok=True)
+        state_path.write_text(json.dumps({"database_id": database_id, "synced_at": self.transformer.reverse(synced_at)}))
+        return {"downloaded": changed, "deleted": deleted}
 
 
 class NotionExporter:
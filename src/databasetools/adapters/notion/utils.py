@@ -11,14 +11,18 @@ Modified By: Mathew Cosgrove
 -----
 """
 
+import json
 import logging
 import re
 import unicodedata
 import uuid
+from pathlib import Path
 from typing import Any
 from typing import Dict
+from typing import Generator
 from typing import List
 from typing import Optional
+from typing import TextIO
 from typing import Union
 from uuid import UUID
 
@@ -100,6 +104,15 @@ ISO8601_REGEX = r"^(-?(?:[1-9][0-9]*)?[0-9]{4})-(1[0-2]|0[1-9])-(3[01]|0[1-9]|[1
 
 
 BASE_URL = "https://www.notion.so/"
+# Id segment of an api path
+NOTION_ID = re.compile(r"/[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{12}(?=/|$)")
+
+DATABASE_JSON = "database.json"
+DATABASE_NDJSON = "database.ndjson"
+NDJSON_SUFFIXES = (".ndjson", ".jsonl")
+JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+JSON_NUMBER_CHARS = frozenset("0123456789.eE+-")
+JSON_DECODER = json.JSONDecoder()
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("databasetools")
@@ -113,6 +126,90 @@ def normalize_id(id: str) -> str:
     return id.replace("-", "")
 
 
+def iter_json_array(f: TextIO, chunk_size: int = 2**16) -> Generator[Any, None, None]:
+    """Yields the items of a top level json array one at a time, reading the file in chunks, so only one item is held in memory.
+
+    >>> import io
+    >>> list(iter_json_array(io.StringIO('[{"id": "a", "children": [1, 2]}, "b", 12345, null]'), chunk_size=4))
+    [{'id': 'a', 'children': [1, 2]}, 'b', 12345, None]
+    >>> list(iter_json_array(io.StringIO(" [ ] ")))
+    []
+
+    Args:
+        f (TextIO): File holding a json array.
+        chunk_size (int, optional): Characters read at a time. Reads grow with an item that does not fit. Defaults to 2**16.
+
+    Raises:
+        ValueError: If the file is not a json array.
+
+    Yields:
+        Generator[Any, None, None]: Each item of the array.
+    """
+    buffer, pos, eof = "", 0, False
+
+    def read() -> bool:
+        nonlocal buffer, pos, eof
+        chunk = f.read(max(chunk_size, len(buffer) - pos))  # Doubles the pending item, so a large one is decoded in linear time
+        buffer, pos, eof = buffer[pos:] + chunk, 0, not chunk
+        return not eof
+
+    def peek() -> str:
+        nonlocal pos
+        while True:
+            pos = JSON_WHITESPACE.match(buffer, pos).end()
+            if pos < len(buffer) or not read():
+                return buffer[pos : pos + 1]
+
+    if peek() != "[":
+        raise ValueError("Not a json array")
+    pos += 1
+    if peek() == "]":
+        return
+    while True:
+        peek()
+        while True:
+            try:
+                item, end = JSON_DECODER.raw_decode(buffer, pos)
+                if eof or (end < len(buffer) and buffer[end] not in JSON_NUMBER_CHARS):  # Otherwise a number may go on in the next chunk
+                    break
+            except json.JSONDecodeError as e:
+                if eof:
+                    raise ValueError(f"Invalid json array item: {e}") from e
+            read()
+        pos = end
+        yield item
+
+        char = peek()
+        if char == "]":
+            return
+        if char != ",":
+            raise ValueError(f"Expected ',' or ']' in a json array, got {char!r}")
+        pos += 1
+
+
+def iter_json_file(path: Union[str, Path]) -> Generator[Any, None, None]:
+    """Yields the items of a json array file, or of a newline delimited json file if its suffix is one of NDJSON_SUFFIXES.
+
+    Args:
+        path (Union[str, Path]): The file.
+
+    Yields:
+        Generator[Any, None, None]: Each item.
+    """
+    path = Path(path)
+    with Path.open(path, encoding="utf-8") as f:
+        if path.suffix in NDJSON_SUFFIXES:
+            yield from (json.loads(line) for line in f if line.strip())
+        else:
+            yield from iter_json_array(f)
+
+
+def find_database_file(directory: Union[str, Path]) -> Path:
+    """The database file of a download directory, database.ndjson if it exists, otherwise database.json."""
+    ndjson = Path(directory) / DATABASE_NDJSON
+    return ndjson if ndjson.exists() else Path(directory) / DATABASE_JSON
+
+
 def get_whitespace(line, leading=True):
     if leading:
         stripped = line.lstrip()
@@ -8,6 +8,7 @@ from typing import Type
 from typing import Union
 
 from pydantic import ValidationError
+from pymongo import UpdateOne
 from pymongo.collection import Collection
 from pymongo.errors import PyMongoError
 
@@ -26,10 +27,14 @@ class MongoCollectionController(DatabaseController[T]):
     Methods:
         create(document_data: Dict[str, Any]) -> T:
             Creates a new document in the collection.
+        create_items(items: List[T]) -> List[T]:
+            Creates many documents in one bulk write.
         read(query: Dict[str, Any]) -> List[T]:
             Reads documents from the collection.
         update(query: Dict[str, Any], update_data: Dict[str, Any]) -> bool:
             Updates documents in the collection.
+        update_items(items: List[T], key: str = "id") -> int:
+            Updates many documents in one bulk write.
         delete(query: Dict[str, Any]) -> bool:
             Deletes documents from the collection.
 
@@ -80,6 +85,23 @@ class MongoCollectionController(DatabaseController[T]):
             print(f"Database error: {e}")
             raise
 
+    def create_items(self, items: List[T]) -> List[T]:
+        """
+        Creates many documents in the collection with one bulk write.
+
+        Parameters:
+            items (List[T]): The documents to create.
+
+        Returns:
+            List[T]: The created documents.
+        """
+        if not items:
+            return items
+        result = self.collection.insert_many([item.model_dump(by_alias=True) for item in items], ordered=False)
+        if not result.acknowledged:
+            raise PyMongoError("Insert operation not acknowledged by MongoDB.")
+        return items
+
     def read(self, query: Dict[str, Any], limit: Optional[int] = None) -> List[T]:
         """
         Reads documents from the collection.
@@ -118,6 +140,23 @@ class MongoCollectionController(DatabaseController[T]):
         result = self.collection.update_many(query, {"$set": update_data})
         return result.modified_count > 0
 
+    def update_items(self, items: List[T], key: str = "id") -> int:
+        """
+        Updates many documents in the collection with one bulk write.
+
+        Parameters:
+            items (List[T]): The updated documents.
+            key (str): The field used to match each item to its document. Defaults to "id".
+
+        Returns:
+            int: The number of documents that were modified.
+        """
+        if not items:
+            return 0
+        requests = [UpdateOne({key: getattr(item, key)}, {"$set": item.model_dump()}) for item in items]
+        result = self.collection.bulk_write(requests, ordered=False)
+        return result.modified_count
+
     def delete(self, query: Dict[str, Any]) -> bool:
         """
         Deletes documents from the collection.
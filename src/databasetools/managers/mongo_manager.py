@@ -1,10 +1,11 @@
 import logging
 import os
-import re
 import tempfile
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict
+from typing import Iterable
 from typing import List
 from typing import Optional
 from typing import Tuple
@@ -17,15 +18,20 @@ from pymongo import MongoClient
 from pymongo.collection import Collection
 from pymongo.database import Database
 
+from ..adapters.confluence.cf_adapter import ATTACHMENT_LINK_PATTERN
+from ..adapters.confluence.cf_adapter import cf_attachment_link_xml
 from ..adapters.confluence.cf_adapter import cf_post_process
 from ..adapters.confluence.confluence import ConfluenceManager
 from ..adapters.oneNote.oneNote import OneNote_2_MongoBlocks
 from ..controller.base_controller import T
 from ..controller.mongo_controller import MongoCollectionController
 from ..models.docblock import DocBlockElement
+from ..models.docblock import DocBlockForest
 from ..models.docblock import PageElement
 from ..models.docblock import PageTypes
 from ..utils.docBlock.docBlock_utils import FromDocBlock
+from ..utils.docBlock.docBlock_utils import ToDocBlock
+from ..utils.docBlock.render_cache import RenderCache
 from ..utils.log import logger
 
 """
@@ -51,6 +57,10 @@ class MongoManager:
     DOC_BLOCKS = "doc_blocks"
     # Default, always initiated, collection name to store confluence data
     PAGE_DATA = "page_data"
+    # Collection name for storing pages as one DocBlockForest each, initiated with compact_blocks
+    DOC_FORESTS = "doc_forests"
+    # Collection name for rendered pages, used with persist_render_cache
+    RENDER_CACHE = "render_cache"
 
     def __init__(
         self,
@@ -62,12 +72,18 @@ class MongoManager:
         doc_block_db_name: Optional[str] = None,
         gridFS_db_names: Optional[Union[List[str], str]] = None,
         col_infos: Optional[Union[List[Tuple[str, T]], Tuple[str, T]]] = None,
+        compact_blocks: bool = False,
+        render_cache: Optional[RenderCache] = None,
+        persist_render_cache: bool = False,
     ) -> None:
         self.confluence_url = confluence_url
         self.confluence_space_key = confluence_space_key
         self.confluence_user_name = confluence_user_name
         self.confluence_api_token = confluence_api_token
+        self.compact_blocks = compact_blocks  # Upload each page's blocks as one DocBlockForest instead of a document per block
         self.con_ad = ConfluenceManager(confluence_url, confluence_space_key, confluence_user_name, confluence_api_token)
+        con_url = confluence_url if confluence_url.endswith("/") else confluence_url + "/"
+        self._display_url = f"{con_url}display/{urllib.parse.quote_plus(confluence_space_key)}/"
 
         if gridFS_db_names is None:
             gridFS_db_names = []
@@ -105,6 +121,15 @@ class MongoManager:
         # Will init default grids and collections. Also inits the active variables for easier referencing
         self.set_default_actives()
 
+        # Pages are rendered again on every upload retry and exports repeat a lot of blocks, so rendered html is cached by content hash
+        if render_cache is None:
+            render_cache = RenderCache(collection=self._db_db[MongoManager.RENDER_CACHE] if persist_render_cache else None)
+        self.render_cache = render_cache
+
+        if self.compact_blocks:
+            self.__set_active_collection_logic(MongoManager.DOC_FORESTS, DocBlockForest)
+            self._collections[MongoManager.DOC_FORESTS][0].create_index("page_id")
+
         if init_grid_name:
             self.active_grid = init_grid_name
 
@@ -270,6 +295,13 @@ class MongoManager:
         except Exception as e:
             raise Exception(f"Whilst uploading block: {block} to {collection_name}") from e
 
+    def bulk_upload_to_col(self, collection_name: str, blocks: List[T]) -> List[T]:
+        controller = self._collections[collection_name][1]
+        try:
+            return controller.create_items(blocks)
+        except Exception as e:
+            raise Exception(f"Whilst bulk uploading {len(blocks)} blocks to {collection_name}") from e
+
     def update_to_col(self, collection_name: str, block: T, **query):
         controller = self._collections[collection_name][1]
         try:
@@ -277,6 +309,13 @@ class MongoManager:
         except Exception as e:
             raise Exception(f"While trying to update block {block} to {collection_name}") from e
 
+    def bulk_update_to_col(self, collection_name: str, blocks: List[T], key: str = "id") -> int:
+        controller = self._collections[collection_name][1]
+        try:
+            return controller.update_items(blocks, key)
+        except Exception as e:
+            raise Exception(f"While trying to bulk update {len(blocks)} blocks to {collection_name}") from e
+
     def find_in_col(self, collection_name: str, **kwargs) -> List[T]:
         controller = self._collections[collection_name][1]  # collection controller is the second element of the collections tuple
         return controller.read(dict(kwargs))
@@ -333,8 +372,12 @@ class MongoManager:
     def _upload_OneNote_files(self, ON_adapter: OneNote_2_MongoBlocks) -> None:
         for page, block_list, required_resources_list in ON_adapter.file_page_gen():  # Upload page pages to mongo
             logger.info(f"Uploading page: {page.relative_path}")
-            for block in block_list:
-                self.upload_to_col(self.active_db_col, block)
+            if self.compact_blocks:
+                forest = DocBlockForest.from_blocks(block_list, page.children, page_id=page.id, export_id=ON_adapter.export_id)
+                self.upload_to_col(MongoManager.DOC_FORESTS, forest)
+            else:
+                for block in block_list:
+                    self.upload_to_col(self.active_db_col, block)
 
             for resource in required_resources_list:  # Upload resources for each page to gridFS
                 logger.info(f"\tUploading resource {resource.name}")
@@ -345,16 +388,44 @@ class MongoManager:
 
             self.upload_to_col(self.active_page_col, page)
 
+    def upload_md_blocks(
+        self, md: str, page: PageElement, mode: str = ToDocBlock.GENERIC_MODE, batch_size: int = 500
+    ) -> PageElement:
+        """Parses a Markdown page into the active docblock collection, writing each batch of blocks while the rest is parsed.
+
+        Args:
+            md (str): Markdown of the page.
+            page (PageElement): Page the blocks belong to. Its export id is copied to every block.
+            mode (str, optional): ToDocBlock parsing mode. Defaults to ToDocBlock.GENERIC_MODE.
+            batch_size (int, optional): Most blocks written per bulk write, also within one large top level tree. Defaults to 500.
+
+        Returns:
+            PageElement: The page with its children set to the top level blocks. The page itself is not uploaded.
+        """
+        root_ids: List[ObjectId] = []
+        for block_list, batch_root_ids in ToDocBlock.iter_md2docblock(md, mode, batch_size):
+            for block in block_list:
+                block.export_id = page.export_id
+            self.bulk_upload_to_col(self.active_db_col, block_list)
+            root_ids.extend(batch_root_ids)
+
+        page.children = root_ids
+        return page
+
     def _clean_incomplete_mongo_upload(self, export_id: ObjectId):
         logger.info("Begin cleaning export from Mongo")
         self.del_many_in_col(self.active_db_col, export_id=export_id)
+        if self.compact_blocks:
+            self.del_many_in_col(MongoManager.DOC_FORESTS, export_id=export_id)
         self.del_many_in_col(self.active_page_col, export_id=export_id)
         self.del_in_grid(self.active_grid, export_id=export_id)
         logger.info("Finished cleaning mongo")
         logger.critical("Failed to finish upload to mongo!")
 
     # Confluence Upload things
-    def upload_confluence(self, export_id: ObjectId, parent_id: Optional[str] = None, parent_title: Optional[str] = None) -> bool:
+    def upload_confluence(
+        self, export_id: ObjectId, parent_id: Optional[str] = None, parent_title: Optional[str] = None, single_write: bool = True
+    ) -> bool:
         if parent_id is None:  # Establish "root" page on confluence
             if parent_title:
                 parent_id = self.con_ad.get_confluence_page_id(parent_title)
@@ -406,7 +477,7 @@ class MongoManager:
 
                     try:
                         logger.info(f"Reconstructing page {file_block.name}")
-                        updated_block = self._construct_page(file_block, folder_element.confluence_page_id)
+                        updated_block = self._construct_page(file_block, folder_element.confluence_page_id, single_write)
                     except IncompleteUpload as e:
                         if len(e.args) == 2:
                             file_block.confluence_page_id = e.args[1]
@@ -416,10 +487,39 @@ class MongoManager:
 
                     self.update_to_col(self.active_page_col, updated_block, id=updated_block.id)
 
-    def _construct_page(self, file_block: PageElement, parent_id: str) -> PageElement:
-        block_list = self._get_block_tree(file_block.children)
+    def _construct_page(self, file_block: PageElement, parent_id: str, single_write: bool = True) -> PageElement:
+        """Makes a confluence page from a file PageElement.
+
+        Args:
+            file_block (PageElement): Page element of the file to upload.
+            parent_id (str): Confluence id of the page to upload under.
+            single_write (bool, optional): If True, every page is created with its final content in one request and its attachments are uploaded after it, since images, previews and attachment links only refer to attachments by file name. If False, every page is created with CONSTRUCTION_MESSAGE and updated with content that links to the attachment previews by id. Defaults to True.
 
-        content, required_resources = FromDocBlock.render_docBlock(block_list, file_block.children)
+        Raises:
+            IncompleteUpload: If any step of the upload fails. If a page was already made on confluence, its id is the second argument.
+
+        Returns:
+            PageElement: The file block updated with the confluence page info.
+        """
+        block_list, root_ids = self._get_page_blocks(file_block)
+
+        content, required_resources = FromDocBlock.render_docBlock(block_list, root_ids, cache=self.render_cache, per_subtree=True)
+
+        if single_write:
+            # Attachments are linked by file name, so the final content can go up with the page itself before they are uploaded
+            content = cf_post_process(content, cf_attachment_link_xml)
+            try:
+                new_page = self.con_ad.make_confluence_page(file_block.name, content, parent_id)
+            except Exception as e:
+                raise IncompleteUpload(
+                    f"Exception occurred while uploading page with file block: \n{file_block}\n\nWith content: \n{content}"
+                ) from e
+            if required_resources:
+                try:
+                    self._add_attachment(required_resources, new_page["id"])
+                except Exception as e:
+                    raise IncompleteUpload(f"Exception occurred during upload of page {new_page['id']}", new_page["id"]) from e
+            return self._set_confluence_info(file_block, new_page)
 
         try:  # Make an empty page
             new_page = self.con_ad.make_confluence_page(file_block.name, self.CONSTRUCTION_MESSAGE, parent_id)
@@ -431,51 +531,84 @@ class MongoManager:
             ) from e
 
         try:  # Upload attachments
-            self._add_attachment(required_resources, new_page_id)
+            attachment_ids = self._add_attachment(required_resources, new_page_id)
         except Exception as e:
             raise IncompleteUpload(f"Exception occurred during upload of page {new_page_id}", new_page_id) from e
 
         # Do final content formatting
-        content = self.format_final_html(content, new_page_name, new_page_id)
+        content = self.format_final_html(content, new_page_name, new_page_id, attachment_ids)
 
         try:  # Update the empty page with the formatted content
             self.con_ad.update_confluence_page(new_page_id, new_page_name, content)
         except Exception as e:
             raise IncompleteUpload(f"Exception occurred while trying to update page {new_page_id}", new_page_id) from e
 
-        # Update blocks to contain the correct info
-        file_block.confluence_page_id = new_page_id
-        file_block.confluence_page_name = new_page_name
-        file_block.confluence_space_key = new_page["space"]["key"]
+        return self._set_confluence_info(file_block, new_page)
+
+    @staticmethod
+    def _set_confluence_info(page_block: PageElement, confluence_page: dict) -> PageElement:
+        """Copies the id, title and space key of a page made on confluence into its PageElement."""
+        page_block.confluence_page_id = confluence_page["id"]
+        page_block.confluence_page_name = confluence_page["title"]
+        page_block.confluence_space_key = confluence_page["space"]["key"]
+        return page_block
 
-        return file_block
+    def format_final_html(
+        self, html_from_docblock: str, page_name: str, page_id: str, attachment_ids: Optional[Dict[str, str]] = None
+    ) -> str:
+        """Post processes rendered html and points the remaining attachment links to their confluence previews.
 
-    def format_final_html(self, html_from_docblock: str, page_name: str, page_id: str) -> str:
-        content = cf_post_process(html_from_docblock)  # POTENTIAL FOR CATASTROPHIC BACKTRACKING: WATCH FOR CONTINUOUS PRINTOUTS.
-        # Order matters! First use cf_post_process!
+        Args:
+            html_from_docblock (str): Html rendered from the page's docblocks.
+            page_name (str): Title of the page on confluence.
+            page_id (str): Id of the page on confluence.
+            attachment_ids (Optional[Dict[str, str]], optional): Resource name to confluence attachment id. If None, the ids of every linked resource are fetched from the active grid at once. Defaults to None.
+
+        Returns:
+            str: Confluence compatible html.
+        """
+        if attachment_ids is None:  # One query for every attachment linked on the page
+            attachment_ids = self.find_attachment_ids({m.group(1) for m in ATTACHMENT_LINK_PATTERN.finditer(html_from_docblock)})
 
-        # Find the rest of the attachment links and parse them to a coherent format that confluence can use
         # This is the url extension to preview an attachment
         # /display/{space_key}/{page_name}?preview=/{confluence_page_id}/{attachment_id}
-        MISC_ATTACHMENT_PATTERN = re.compile(r"""<a\s+href="(\w+?\.\w+?)">(.*?)</a>""")
+        preview_url = f"{self._display_url}{urllib.parse.quote_plus(page_name)}?preview=/{page_id}/"
 
-        def repl(m: re.Match):
-            attachment_grid_item = self.find_in_grid(self.active_grid, name=m.group(1))
-            attachment_confluence_id = attachment_grid_item.__getattr__("confluence_id")
-            if self.confluence_url.endswith("/"):
-                con_url = self.confluence_url
-            else:
-                con_url = self.confluence_url + "/"
+        def misc_link(filename: str, text: str) -> str:
+            attachment_confluence_id = attachment_ids.get(filename)
+            if attachment_confluence_id is None:
+                attachment_grid_item = self.find_in_grid(self.active_grid, name=filename)
+                attachment_confluence_id = attachment_grid_item.__getattr__("confluence_id")
+            return f"""<a href="{preview_url}{attachment_confluence_id}">{text}</a>"""
 
-            esc_con_space_key = urllib.parse.quote_plus(self.confluence_space_key)
-            esc_page_name = urllib.parse.quote_plus(page_name)
+        # Preview macros and the rest of the attachment links are rewritten in the same pass
+        return cf_post_process(html_from_docblock, misc_link)
 
-            return f"""<a href="{con_url}display/{esc_con_space_key}/{esc_page_name}?preview=/{page_id}/{attachment_confluence_id}">{m.group(2)}</a>"""
+    def find_attachment_ids(self, names: Iterable[str]) -> Dict[str, str]:
+        """Finds the confluence attachment ids of resources in the active grid with one query.
 
-        return re.sub(MISC_ATTACHMENT_PATTERN, repl, content)
+        Args:
+            names (Iterable[str]): Names of the resources.
+
+        Returns:
+            Dict[str, str]: Resource name to confluence attachment id. Resources that are not in the grid are left out.
+        """
+        fs_file_col = self._grids[self.active_grid][0].get_collection("fs.files")
+        docs = fs_file_col.find({"name": {"$in": list(names)}}, {"name": 1, "confluence_id": 1})
+        return {doc["name"]: doc.get("confluence_id") for doc in docs}
 
-    def _add_attachment(self, resources: List[str], page_id_to_add_attachments: str):
+    def _add_attachment(self, resources: List[str], page_id_to_add_attachments: str) -> Dict[str, str]:
+        """Uploads resources from the active grid as attachments to a confluence page.
+
+        Args:
+            resources (List[str]): Names of the resources in the active grid.
+            page_id_to_add_attachments (str): Id of the confluence page to attach to.
+
+        Returns:
+            Dict[str, str]: Resource name to the confluence id of its attachment.
+        """
         temp_dir = Path(tempfile.mkdtemp())
+        attachment_ids: Dict[str, str] = {}
 
         def remove_dir():
             for item in os.listdir(temp_dir):
@@ -520,6 +653,7 @@ class MongoManager:
                             raise KeyError(f"Unexpected response object: {response}")
 
                     fs_file_col.update_one(filter={"name": resource}, update={"$set": {"confluence_id": attachment_id}})
+                    attachment_ids[resource] = attachment_id
                     temp_file.unlink()
                 except Exception as e:
                     raise Exception(
@@ -528,25 +662,97 @@ class MongoManager:
         finally:
             remove_dir()
 
-    def _make_page_tree(self, folder_block: PageElement, parent_id: str):
-        if not folder_block.confluence_page_id:
-            new_page = self.con_ad.make_confluence_page_directory(folder_block.name, parent_id)
-            folder_block.confluence_page_id = new_page["id"]
-            folder_block.confluence_page_name = new_page["title"]
-            folder_block.confluence_space_key = new_page["space"]["key"]
+        return attachment_ids
 
-        self.update_to_col(self._active_page_col, folder_block, id=folder_block.id)
-        for child_id in folder_block.sub_folders:
-            child_block = self.find_one_in_col(self.active_page_col, id=child_id)
-            self._make_page_tree(child_block, folder_block.confluence_page_id)
+    def _make_page_tree(self, folder_block: PageElement, parent_id: str, max_workers: int = 8):
+        """Makes the folder pages of an export on confluence, one tree level at a time. Folders on the same level do not depend on each other so each level is made concurrently.
 
-    def _get_block_tree(self, block_ids: List[DocBlockElement]) -> List[DocBlockElement]:
-        block_list = []
+        All folder PageElements of the export are fetched with one query and the ones that were made on confluence are written back with one bulk update, even if making a later folder fails.
 
-        for block_id in block_ids:
-            this_block: DocBlockElement = self.find_one_in_col(self.active_db_col, id=block_id)
-            block_list.extend(self._get_block_tree(this_block.children))
-            block_list.append(this_block)
+        Args:
+            folder_block (PageElement): Root folder of the export.
+            parent_id (str): Confluence id of the page to make the tree under.
+            max_workers (int, optional): Maximum number of pages made at the same time. Defaults to 8.
+        """
+        folders: Dict[ObjectId, PageElement] = {
+            folder.id: folder for folder in self.find_in_col(self.active_page_col, export_id=folder_block.export_id, type=PageTypes.FOLDER)
+        }
+        folders[folder_block.id] = folder_block
+        made_folders: List[PageElement] = []
+
+        def make_directory(folder: PageElement, folder_parent_id: str) -> PageElement:
+            new_page = self.con_ad.make_confluence_page_directory(folder.name, folder_parent_id)
+            return self._set_confluence_info(folder, new_page)
+
+        def get_folder(folder_id: ObjectId) -> PageElement:
+            if folder_id not in folders:
+                folders[folder_id] = self.find_one_in_col(self.active_page_col, id=folder_id)
+            return folders[folder_id]
+
+        level: List[Tuple[PageElement, str]] = [(folder_block, parent_id)]
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                while level:
+                    to_make = [(folder, folder_parent_id) for folder, folder_parent_id in level if not folder.confluence_page_id]
+                    for batch in self._unique_title_batches(to_make):
+                        futures = [executor.submit(make_directory, *item) for item in batch]
+                        errors = []
+                        for future in futures:
+                            try:
+                                made_folders.append(future.result())
+                            except Exception as e:
+                                errors.append(e)
+                        if errors:
+                            raise errors[0]
+
+                    level = [
+                        (get_folder(child_id), folder.confluence_page_id) for folder, _ in level for child_id in folder.sub_folders
+                    ]
+        finally:
+            self.bulk_update_to_col(self.active_page_col, made_folders)
+
+    @staticmethod
+    def _unique_title_batches(items: List[Tuple[PageElement, str]]) -> List[List[Tuple[PageElement, str]]]:
+        """Splits folders into batches without repeated titles so concurrent title aliasing can not pick the same title twice."""
+        batches: List[List[Tuple[PageElement, str]]] = []
+        seen: Dict[str, int] = {}
+        for item in items:
+            title = (item[0].name or "").rstrip()
+            index = seen.get(title, 0)
+            seen[title] = index + 1
+            if index == len(batches):
+                batches.append([])
+            batches[index].append(item)
+        return batches
+
+    def _get_page_blocks(self, page_block: PageElement) -> Tuple[List[DocBlockElement], List[ObjectId]]:
+        """Loads the blocks of a page. With compact_blocks, pages stored as a DocBlockForest are loaded in one read.
+
+        Args:
+            page_block (PageElement): The page.
+
+        Returns:
+            Tuple[List[DocBlockElement], List[ObjectId]]: Every block of the page, and the ids of the top level blocks in page order.
+        """
+        if self.compact_blocks:
+            forests: List[DocBlockForest] = self.find_in_col(MongoManager.DOC_FORESTS, page_id=page_block.id)
+            if forests:
+                return forests[0].to_blocks()
+        return self._get_block_tree(page_block.children), page_block.children
+
+    def _get_block_tree(self, block_ids: List[ObjectId]) -> List[DocBlockElement]:
+        """Fetches the trees under a list of block ids, each block after its children. Walks the trees with an explicit stack so deep trees do not hit the recursion limit."""
+        block_list: List[DocBlockElement] = []
+        stack: List[Tuple[Union[ObjectId, DocBlockElement], bool]] = [(block_id, False) for block_id in reversed(block_ids)]
+
+        while stack:
+            item, fetched = stack.pop()
+            if fetched:
+                block_list.append(item)
+                continue
+            this_block: DocBlockElement = self.find_one_in_col(self.active_db_col, id=item)
+            stack.append((this_block, True))
+            stack.extend((child_id, False) for child_id in reversed(this_block.children))
 
         return block_list
 
@@ -559,24 +765,20 @@ class MongoManager:
         if not isinstance(page_element, PageElement):
             raise KeyError(f"Id provided to print correlates to an object that is not a page element! id: {page_element_id}")
 
-        def make_children_list(block_dict: Dict[ObjectId, DocBlockElement], block: DocBlockElement) -> List[str]:
-            if block.block_content is not None:
-                print_list = [f"Block Element id: {block.id!s}\tType: {block.type}\tRaw: {block.block_content}"]
-            else:
-                print_list = [f"Block Element id: {block.id!s}\tType: {block.type}"]
-            for cblock_id in block.children:
-                c_list = make_children_list(block_dict, block_dict[cblock_id])
-                for i in range(len(c_list)):
-                    c_list[i] = f"\t{c_list[i]}"
-                print_list.extend(c_list)
-            return print_list
-
         print_list = [f"\nPage Element id: {page_element.id}\tName: {page_element.name}\tExport id: {page_element.export_id}"]
-        block_list = self._get_block_tree(page_element.children)
+        block_list, root_ids = self._get_page_blocks(page_element)
         block_dict = {block.id: block for block in block_list}
-        for block_id in page_element.children:
-            new_list = make_children_list(block_dict, block_dict[block_id])
-            print_list.extend(new_list)
+
+        stack = [(block_id, 0) for block_id in reversed(root_ids)]
+        while stack:
+            block_id, depth = stack.pop()
+            block = block_dict[block_id]
+            tabs = "\t" * depth
+            if block.block_content is not None:
+                print_list.append(f"{tabs}Block Element id: {block.id!s}\tType: {block.type}\tRaw: {block.block_content}")
+            else:
+                print_list.append(f"{tabs}Block Element id: {block.id!s}\tType: {block.type}")
+            stack.extend((cblock_id, depth + 1) for cblock_id in reversed(block.children))
 
         for item in print_list:
             logging.debug(item)
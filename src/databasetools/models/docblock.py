@@ -3,6 +3,9 @@ from typing import Any
 from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from typing import Union
 
 from bson import ObjectId
 from pydantic import Field
@@ -53,6 +56,107 @@ class DocBlockElement(Element):
     export_id: Optional[ObjectId] = Field(None, description="For pages that are from an export which get assigned an ID.")
 
 
+class ForestBlock:
+    """One block of a DocBlockForest with only the fields FromDocBlock and ToDocBlock use, without Element's metadata or validation."""
+
+    __slots__ = ("id", "type", "block_content", "block_attr", "children")
+
+    def __init__(
+        self,
+        id: ObjectId,
+        type: DocBlockElementType,
+        block_content: Optional[str] = None,
+        block_attr: Optional[Dict[str, Any]] = None,
+        children: Optional[List[ObjectId]] = None,
+    ):
+        self.id = id
+        self.type = type
+        self.block_content = block_content
+        self.block_attr = block_attr
+        self.children = [] if children is None else children
+
+
+class DocBlockForest(Element):
+    """All the block trees of one page in a single document.
+
+    Block i is described by the i-th item of each block_* list. Blocks are kept in the order ToDocBlock makes them, each block after its children. The children of block i are the blocks at child_indexes[child_offsets[i]:child_offsets[i + 1]].
+    """
+
+    page_id: Optional[ObjectId] = Field(None, description="Id of the page element made up of these blocks")
+    export_id: Optional[ObjectId] = Field(None, description="For pages that are from an export which get assigned an ID.")
+    block_ids: List[ObjectId] = Field([], description="Id of each block")
+    block_types: List[DocBlockElementType] = Field([], description="Type of each block")
+    block_contents: List[Optional[str]] = Field([], description="Content of each block")
+    block_attrs: List[Optional[Dict[str, Any]]] = Field([], description="Attributes of each block")
+    child_offsets: List[int] = Field([0], description="Where the children of each block start in child_indexes, plus the end of the last block's children")
+    child_indexes: List[int] = Field([], description="Indexes of the children of every block, block by block")
+    root_indexes: List[int] = Field([], description="Indexes of the top level blocks in page order")
+
+    @classmethod
+    def from_blocks(cls, block_list: Sequence[Union[DocBlockElement, ForestBlock]], root_ids: List[ObjectId], **kwargs) -> "DocBlockForest":
+        """Packs per block documents, or ForestBlocks, into one forest.
+
+        Args:
+            block_list (Sequence[Union[DocBlockElement, ForestBlock]]): Every block of the page.
+            root_ids (List[ObjectId]): Ids of the top level blocks in page order.
+            **kwargs: Other fields of the forest, e.g. page_id and export_id.
+
+        Raises:
+            KeyError: If a child or root id is not in the block list.
+
+        Returns:
+            DocBlockForest: The packed forest.
+        """
+        index = {block.id: i for i, block in enumerate(block_list)}
+        child_offsets = [0]
+        child_indexes: List[int] = []
+        for block in block_list:
+            child_indexes.extend(index[child_id] for child_id in block.children or [])
+            child_offsets.append(len(child_indexes))
+
+        return cls(
+            block_ids=[block.id for block in block_list],
+            block_types=[block.type for block in block_list],
+            block_contents=[block.block_content for block in block_list],
+            block_attrs=[block.block_attr for block in block_list],
+            child_offsets=child_offsets,
+            child_indexes=child_indexes,
+            root_indexes=[index[root_id] for root_id in root_ids],
+            **kwargs,
+        )
+
+    def to_blocks(self) -> Tuple[List[DocBlockElement], List[ObjectId]]:
+        """Unpacks the forest into per block documents, all sharing the forest's export id and creation time.
+
+        Returns:
+            Tuple[List[DocBlockElement], List[ObjectId]]: Every block of the page, and the ids of the top level blocks in page order.
+        """
+        ids = self.block_ids
+        block_list = [
+            DocBlockElement(
+                id=ids[i],
+                type=self.block_types[i],
+                block_content=self.block_contents[i],
+                block_attr=self.block_attrs[i],
+                children=[ids[child] for child in self.get_children(i)],
+                export_id=self.export_id,
+                created_at=self.created_at,
+            )
+            for i in range(len(ids))
+        ]
+        return block_list, [ids[i] for i in self.root_indexes]
+
+    def get_children(self, index: int) -> List[int]:
+        """Indexes of the children of the block at index."""
+        return self.child_indexes[self.child_offsets[index] : self.child_offsets[index + 1]]
+
+    def get_block(self, index: int) -> ForestBlock:
+        """The block at index, read straight from the lists."""
+        ids = self.block_ids
+        children = [ids[child] for child in self.get_children(index)]
+        return ForestBlock(ids[index], self.block_types[index], self.block_contents[index], self.block_attrs[index], children)
+
+
 class PageTypes(str, Enum):
     PAGE = "page"
     FOLDER = "folder"
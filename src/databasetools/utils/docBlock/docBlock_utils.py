@@ -1,14 +1,23 @@
+import os
 import re
+import struct
+import time
 from builtins import Exception
+from datetime import datetime
 from pathlib import Path
 from pprint import pprint
 from textwrap import indent
 from typing import Any
 from typing import Callable
+from typing import ClassVar
 from typing import Dict
+from typing import Generator
+from typing import Iterator
 from typing import List
+from typing import MutableMapping
 from typing import Optional
 from typing import Tuple
+from typing import Type
 from typing import Union
 
 import mistune
@@ -22,6 +31,10 @@ from mistune.renderers.markdown import MarkdownRenderer
 
 from ...models.docblock import DocBlockElement
 from ...models.docblock import DocBlockElementType
+from ...models.docblock import DocBlockForest
+from ...models.docblock import ForestBlock
+from .render_cache import RenderCache
+from .render_cache import subtree_hashes
 
 DEBUG = False
 
@@ -84,59 +97,118 @@ class MdRenderer(MarkdownRenderer):
         return indent(text, "> ", lambda _: True) + "\n\n"
 
 
+def class_dispatch_table(cls: type, func_names: Dict[DocBlockElementType, str], key: Optional[str] = None) -> Dict[DocBlockElementType, Callable]:
+    """Looks up parse methods by name once per class and key, so instances share one table instead of building a dict of bound methods each.
+
+    Args:
+        cls (type): Class the methods are looked up on.
+        func_names (Dict[DocBlockElementType, str]): Element type to method name.
+        key (Optional[str], optional): Name of the table, e.g. a parsing mode. Defaults to None.
+
+    Returns:
+        Dict[DocBlockElementType, Callable]: Element type to unbound method, to be called with the instance as the first argument.
+    """
+    tables = cls.__dict__.get("_dispatch_tables")
+    if tables is None:
+        tables = {}
+        cls._dispatch_tables = tables
+    table = tables.get(key)
+    if table is None:
+        table = tables[key] = {element_type: getattr(cls, name) for element_type, name in func_names.items()}
+    return table
+
+
+class FuncListView(MutableMapping):
+    """Live view of the parse functions of a FromDocBlock or ToDocBlock instance, bound to it.
+
+    Setting an item calls the owner's override_func_list, deleting one drops the override and restores the class's function.
+    """
+
+    def __init__(self, owner: Union["FromDocBlock", "ToDocBlock"]):
+        self._owner = owner
+
+    def __getitem__(self, element_type: DocBlockElementType) -> Callable:
+        func = self._owner._overrides.get(element_type)
+        return func if func is not None else self._owner._dispatch[element_type].__get__(self._owner)
+
+    def __setitem__(self, element_type: DocBlockElementType, func: Callable):
+        self._owner.override_func_list(element_type, func)
+
+    def __delitem__(self, element_type: DocBlockElementType):
+        del self._owner._overrides[element_type]
+
+    def __iter__(self) -> Iterator[DocBlockElementType]:
+        return iter({**self._owner._dispatch, **self._owner._overrides})
+
+    def __len__(self) -> int:
+        return len(self._owner._dispatch.keys() | self._owner._overrides.keys())
+
+
 class FromDocBlock:
+    _converters: ClassVar[Dict[Optional[Type[BaseRenderer]], mistune.Markdown]] = {}
+
+    # Parse method for each block type. Looked up by name so subclasses can override the methods
+    FUNC_NAMES: ClassVar[Dict[DocBlockElementType, str]] = {
+        DocBlockElementType.TEXT: "_text",
+        DocBlockElementType.EMPHASIS: "_emphasis",
+        DocBlockElementType.STRONG: "_strong",
+        DocBlockElementType.LINK: "_link",
+        DocBlockElementType.IMAGE: "_image",
+        DocBlockElementType.CODESPAN: "_codespan",
+        DocBlockElementType.LINE_BREAK: "_line_break",
+        DocBlockElementType.SOFT_BREAK: "_soft_break",
+        DocBlockElementType.BLANK_LINE: "_blank_line",
+        DocBlockElementType.INLINE_HTML: "_inline_html",
+        DocBlockElementType.PARAGRAPH: "_paragraph",
+        DocBlockElementType.HEADING: "_heading",
+        DocBlockElementType.THEMATIC_BREAK: "_thematic_break",
+        DocBlockElementType.BLOCK_TEXT: "_block_text",
+        DocBlockElementType.BLOCK_CODE: "_block_code",
+        DocBlockElementType.BLOCK_QUOTE: "_block_quote",
+        DocBlockElementType.BLOCK_HTML: "_block_html",
+        DocBlockElementType.LIST_ITEM: "_list_item",
+        DocBlockElementType.LIST: "_list",
+        DocBlockElementType.TABLE: "_table",
+        DocBlockElementType.TABLE_HEAD: "_table_head",
+        DocBlockElementType.TABLE_BODY: "_table_body",
+        DocBlockElementType.TABLE_ROW: "_table_row",
+        DocBlockElementType.TABLE_CELL: "_table_cell",
+        DocBlockElementType.RESOURCE_REFERENCE: "_resource_reference",
+    }
+
     def __init__(self, block_list: List[DocBlockElement], resource_prefix: Optional[Union[Path, str]] = None):
-        self._default_func_list = {
-            DocBlockElementType.TEXT: self._text,
-            DocBlockElementType.EMPHASIS: self._emphasis,
-            DocBlockElementType.STRONG: self._strong,
-            DocBlockElementType.LINK: self._link,
-            DocBlockElementType.IMAGE: self._image,
-            DocBlockElementType.CODESPAN: self._codespan,
-            DocBlockElementType.LINE_BREAK: self._line_break,
-            DocBlockElementType.SOFT_BREAK: self._soft_break,
-            DocBlockElementType.BLANK_LINE: self._blank_line,
-            DocBlockElementType.INLINE_HTML: self._inline_html,
-            DocBlockElementType.PARAGRAPH: self._paragraph,
-            DocBlockElementType.HEADING: self._heading,
-            DocBlockElementType.THEMATIC_BREAK: self._thematic_break,
-            DocBlockElementType.BLOCK_TEXT: self._block_text,
-            DocBlockElementType.BLOCK_CODE: self._block_code,
-            DocBlockElementType.BLOCK_QUOTE: self._block_quote,
-            DocBlockElementType.BLOCK_HTML: self._block_html,
-            DocBlockElementType.LIST_ITEM: self._list_item,
-            DocBlockElementType.LIST: self._list,
-            DocBlockElementType.TABLE: self._table,
-            DocBlockElementType.TABLE_HEAD: self._table_head,
-            DocBlockElementType.TABLE_BODY: self._table_body,
-            DocBlockElementType.TABLE_ROW: self._table_row,
-            DocBlockElementType.TABLE_CELL: self._table_cell,
-            DocBlockElementType.RESOURCE_REFERENCE: self._resource_reference,
-        }
+        self._dispatch = self.dispatch_table()
+        self._overrides: Dict[DocBlockElementType, Callable] = {}
         self._resource_prefix = Path(resource_prefix) if resource_prefix else None
         self._required_resources: List[str] = []
-        self.func_list = self._default_func_list.copy()
         self.__block_cache: Dict[ObjectId, DocBlockElement] = {block.id: block for block in block_list}
+        self.__token_cache: Dict[ObjectId, Union[Dict[str, Any], Exception]] = {}
 
     @classmethod
     def render_docBlock(
         cls,
         block_list: List[DocBlockElement],
         id_list: List[ObjectId],
-        renderer: Optional[BaseRenderer] = None,
+        renderer: Optional[Union[BaseRenderer, Type[BaseRenderer]]] = None,
         resource_prefix: Optional[Union[Path, str]] = None,
+        cache: Optional[RenderCache] = None,
+        per_subtree: bool = False,
     ) -> Tuple[str, List[str]]:
         """Renders a list of DocBlockElement's into a formatted string. Defaults to HTML
 
         Args:
             block_list (List[DocBlockElement]): A list of DocBlockElement's that consist of all elements in a document tree/forest.
             id_list (List[ObjectId]): A list of root nodes for constructing the elements of the tree.
-            renderer (BaseRenderer, optional): A mistune renderer to render to different formats. Defaults to MdRenderer.
+            renderer (Union[BaseRenderer, Type[BaseRenderer]], optional): A mistune renderer, or renderer class, to render to different formats. Defaults to HTMLRenderer.
             resource_prefix (Union[Path, str], optional): Prefix used before the basename of relative resource references in the URL field. Defaults to None.
+            cache (RenderCache, optional): Cache of rendered pages keyed by the content hash of their blocks. Defaults to None.
+            per_subtree (bool, optional): Also cache each top level block on its own so pages sharing blocks reuse them. Only used with a cache and a renderer that joins the output of each top level block, like HTMLRenderer. Defaults to False.
 
         Returns:
             Tuple[str, List[str]]: Output Markdown string, list of resources needed to render page.
         """
+        if cache is not None:
+            return cls._render_cached(block_list, id_list, renderer, resource_prefix, cache, per_subtree)
 
         parser = cls(block_list, resource_prefix)
         token_list = []
@@ -148,39 +220,209 @@ class FromDocBlock:
         debug_print(token_list)
 
         block_state = BlockState()
-        for token in token_list:
-            block_state.append_token(token)
+        block_state.tokens = token_list
+
+        converter = cls.get_converter(renderer)
+        result = converter.render_state(block_state)
+
+        return (result, parser._required_resources)
+
+    @classmethod
+    def _render_cached(
+        cls,
+        block_list: List[DocBlockElement],
+        id_list: List[ObjectId],
+        renderer: Optional[Union[BaseRenderer, Type[BaseRenderer]]],
+        resource_prefix: Optional[Union[Path, str]],
+        cache: RenderCache,
+        per_subtree: bool,
+    ) -> Tuple[str, List[str]]:
+        hashes = subtree_hashes({block.id: block for block in block_list}, id_list)
+        converter = cls.get_converter(renderer)
+        # Output also depends on the parse functions, the renderer settings and the resource prefix
+        prefix = f"{cls.__module__}.{cls.__qualname__}|{cls._renderer_key(converter.renderer)}|{resource_prefix}|"
+        page_key = RenderCache.make_key(prefix, *(hashes[id] for id in id_list))
+        entry = cache.get(page_key)
+        if entry is not None:
+            return entry[0], list(entry[1])
+
+        if per_subtree and type(converter.renderer).__call__ is BaseRenderer.__call__:
+            parser = cls(block_list, resource_prefix)
+            outputs = []
+            resources = []
+            for id in id_list:
+                key = RenderCache.make_key(prefix, hashes[id])
+                entry = cache.get(key)
+                if entry is None:
+                    start = len(parser._required_resources)
+                    block_state = BlockState()
+                    block_state.tokens = [parser.make_token(parser.get_block(id))]
+                    entry = (converter.render_state(block_state), parser._required_resources[start:])
+                    cache.put(key, *entry)
+                outputs.append(entry[0])
+                resources.extend(entry[1])
+            result = ("".join(outputs), resources)
+        else:
+            result = cls.render_docBlock(block_list, id_list, renderer, resource_prefix)
+
+        cache.put(page_key, *result)
+        return result
+
+    @staticmethod
+    def _renderer_key(renderer: BaseRenderer) -> str:
+        """Names a renderer by its class and plain settings such as escape."""
+        settings = sorted(
+            (name, value) for name, value in vars(renderer).items() if isinstance(value, (str, int, float, bool, tuple, list, type(None)))
+        )
+        return f"{type(renderer).__module__}.{type(renderer).__qualname__}{settings}"
+
+    @classmethod
+    def render_forest(
+        cls,
+        forest: DocBlockForest,
+        renderer: Optional[Union[BaseRenderer, Type[BaseRenderer]]] = None,
+        resource_prefix: Optional[Union[Path, str]] = None,
+    ) -> Tuple[str, List[str]]:
+        """Renders a page stored as a DocBlockForest, reading each block straight from its lists. Same as render_docBlock.
+
+        No DocBlockElements are made, the parse functions get ForestBlocks. Overrides must only use the fields the two share.
+
+        Args:
+            forest (DocBlockForest): The page's blocks.
+            renderer (Union[BaseRenderer, Type[BaseRenderer]], optional): A mistune renderer, or renderer class, to render to different formats. Defaults to HTMLRenderer.
+            resource_prefix (Union[Path, str], optional): Prefix used before the basename of relative resource references in the URL field. Defaults to None.
+
+        Returns:
+            Tuple[str, List[str]]: Output string, list of resources needed to render page.
+        """
+        block_list = [forest.get_block(i) for i in range(len(forest.block_ids))]
+        return cls.render_docBlock(block_list, [forest.block_ids[i] for i in forest.root_indexes], renderer, resource_prefix)
+
+    @classmethod
+    def dispatch_table(cls) -> Dict[DocBlockElementType, Callable]:
+        """Parse functions of this class by block type. Built once per class and shared by every instance.
+
+        Returns:
+            Dict[DocBlockElementType, Callable]: Block type to an unbound parse method.
+        """
+        return class_dispatch_table(cls, cls.FUNC_NAMES)
+
+    @property
+    def func_list(self) -> FuncListView:
+        """Live view of the parse functions of this instance, bound to it. Setting an item overrides the parse function of one block type.
+
+        Returns:
+            FuncListView: Block type to parse function.
+        """
+        return FuncListView(self)
+
+    @func_list.setter
+    def func_list(self, set_func_list: Dict[DocBlockElementType, Callable]):
+        """Replaces every parse function of this instance.
+
+        Args:
+            set_func_list (Dict[DocBlockElementType, Callable]): Block type to parse function.
+        """
+        self._dispatch = {}
+        self._overrides = dict(set_func_list)
+
+    def override_func_list(self, block_type: DocBlockElementType, block_parser_callable: Callable):
+        """Replaces the parse function of one block type for this instance only.
+
+        Args:
+            block_type (DocBlockElementType): Block type to override.
+            block_parser_callable (Callable): Called with the block, returns its token.
+        """
+        self._overrides[block_type] = block_parser_callable
+
+    def parse_block(self, block: DocBlockElement, block_type: Optional[DocBlockElementType] = None) -> Dict[str, Any]:
+        """Calls the parse function of a block type, the block's own type by default, on one block."""
+        block_type = block.type if block_type is None else block_type
+        func = self._overrides.get(block_type)
+        return func(block) if func is not None else self._dispatch[block_type](self, block)
+
+    @classmethod
+    def get_converter(cls, renderer: Optional[Union[BaseRenderer, Type[BaseRenderer]]] = None) -> mistune.Markdown:
+        """Gets a configured mistune Markdown instance from the pool, which holds one per renderer type.
+
+        Rendering keeps no state on the converter or renderer, so pooled converters are shared between threads. A renderer instance reuses its pooled converter when it is the same instance as last time, otherwise it takes its place in the pool.
+
+        Args:
+            renderer (Union[BaseRenderer, Type[BaseRenderer]], optional): Renderer, or renderer class that is made with no arguments. Defaults to HTMLRenderer(escape=False).
+
+        Returns:
+            mistune.Markdown: Converter with the table plugin for rendering BlockStates.
+        """
+        key = renderer if renderer is None or isinstance(renderer, type) else type(renderer)
+        converter = cls._converters.get(key)
+        if converter is not None and (key is renderer or converter.renderer is renderer):
+            return converter
 
         if renderer is None:
             renderer = mistune.HTMLRenderer(escape=False)
-
+        elif isinstance(renderer, type):
+            renderer = renderer()
         converter = mistune.Markdown(renderer=renderer, plugins=[table])
         converter.block.list_rules += ["table"]
-        result = converter.render_state(block_state)
-
-        return (result, parser._required_resources)
+        cls._converters[key] = converter
+        return converter
 
     def make_token(self, block: DocBlockElement) -> Dict[str, Any]:
-        b_type = block.type
+        """Makes the token of a block and all of its descendants.
 
-        if b_type in self.func_list:
-            try:
-                new_token = self.func_list[b_type](block)
-            except Exception as e:
-                raise Exception(f"While parsing block: {block}") from e
-        else:
-            raise KeyError(f"invalid block: {block}")
+        The tree is walked with an explicit stack so that children are made before their parents, which keeps deep trees from hitting the recursion limit. Parse functions get their children's tokens from make_children_token. Errors of children are only raised if their parent asks for them, as if they were made on demand, and the tokens of children no parse function asked for are dropped.
 
-        return new_token
+        Args:
+            block (DocBlockElement): Root block of the tree.
+
+        Raises:
+            KeyError: A block has a type without a parse function.
+            MissingBlockElements: A child block is not in the block list.
+
+        Returns:
+            Dict[str, Any]: Mistune token of the block.
+        """
+        dispatch = self._dispatch
+        overrides = self._overrides
+        outer_token_cache = self.__token_cache
+        token_cache = self.__token_cache = {}
+        stack: List[Tuple[DocBlockElement, bool]] = [(block, False)]
+        try:
+            while stack:
+                current, expanded = stack.pop()
+                if not expanded:
+                    if current.type not in dispatch and current.type not in overrides:
+                        token_cache[current.id] = KeyError(f"invalid block: {current}")
+                        continue
+                    stack.append((current, True))
+                    for id in reversed(current.children or []):
+                        try:
+                            stack.append((self.get_block(id), False))
+                        except MissingBlockElements as e:
+                            token_cache[id] = e
+                    continue
+
+                try:
+                    func = overrides.get(current.type) if overrides else None
+                    token_cache[current.id] = func(current) if func is not None else dispatch[current.type](self, current)
+                except Exception as e:
+                    token_cache[current.id] = error = Exception(f"While parsing block: {current}")
+                    error.__cause__ = e
+        finally:
+            self.__token_cache = outer_token_cache
+
+        token = token_cache[block.id]
+        if isinstance(token, Exception):
+            raise token
+        return token
 
     def make_children_token(self, block: DocBlockElement) -> List[Dict[str, Any]]:
-        id_list = block.children
-        child_list = []
-        for id in id_list:
-            block = self.get_block(id)
-            token = self.make_token(block)
-            child_list.append(token)
-        return child_list
+        token_cache = self.__token_cache
+        tokens = [token_cache[id] for id in block.children or []]
+        for token in tokens:
+            if isinstance(token, Exception):
+                raise token
+        return tokens
 
     def get_block(self, id: ObjectId) -> DocBlockElement:
         block = self.__block_cache.get(id)
@@ -208,7 +450,7 @@ class FromDocBlock:
         return {"type": DocBlockElementType.LINK.value, "children": child_list, "attrs": attr}
 
     def _image(self, block: DocBlockElement) -> Dict[str, Any]:
-        token = self.func_list[DocBlockElementType.LINK](block)
+        token = self.parse_block(block, DocBlockElementType.LINK)
         token["type"] = DocBlockElementType.IMAGE.value
         return token
 
@@ -306,11 +548,124 @@ class FromDocBlock:
         return {"type": element.value, "children": child_list}
 
 
+def allocate_object_ids(count: int) -> List[ObjectId]:
+    """Makes unique ObjectIds in bulk. They share the current time and a fresh random 5 bytes, and count up in the last 3 bytes the way ObjectIds made one at a time do.
+
+    Args:
+        count (int): Number of ids, at most 2**24.
+
+    Returns:
+        List[ObjectId]: The ids in increasing order.
+    """
+    if not 0 <= count <= 0xFFFFFF + 1:
+        raise ValueError(f"Can allocate at most {0xFFFFFF + 1} ObjectIds at once, not {count}")
+    prefix = struct.pack(">I", int(time.time())) + os.urandom(5)
+    return [ObjectId(prefix + i.to_bytes(3, "big")) for i in range(count)]
+
+
+class DocBlockBuilder:
+    """Makes the DocBlockElements the parser produces, sharing one creation time and allocating ids in batches.
+
+    Ids are allocated in batches that double in size up to MAX_ID_BATCH. Blocks are still validated: with the id and creation time
+    given, that is cheaper than a fresh ObjectId and datetime per block, and cheaper than DocBlockElement.model_construct.
+    """
+
+    MIN_ID_BATCH = 16
+    MAX_ID_BATCH = 1024
+
+    def __init__(self, created_at: Optional[datetime] = None):
+        # Naive local time like the Element.created_at default, so blocks from the builder and elsewhere compare
+        self.created_at = created_at if created_at is not None else datetime.now()  # noqa: DTZ005
+        self._ids: List[ObjectId] = []
+        self._id_batch = self.MIN_ID_BATCH
+
+    def new_id(self) -> ObjectId:
+        if not self._ids:
+            self._ids = allocate_object_ids(self._id_batch)
+            self._ids.reverse()
+            self._id_batch = min(self._id_batch * 2, self.MAX_ID_BATCH)
+        return self._ids.pop()
+
+    def build(
+        self,
+        type: DocBlockElementType,
+        block_content: Optional[str] = None,
+        block_attr: Optional[Dict[str, Any]] = None,
+        children: Optional[List[ObjectId]] = None,
+    ) -> DocBlockElement:
+        """Makes a block with the next id and the shared creation time.
+
+        Args:
+            type (DocBlockElementType): Type of the block.
+            block_content (Optional[str], optional): Content of the block. Defaults to None.
+            block_attr (Optional[Dict[str, Any]], optional): Block specific attributes. Defaults to None.
+            children (Optional[List[ObjectId]], optional): Ids of the children blocks. Defaults to None.
+
+        Returns:
+            DocBlockElement: The block.
+        """
+        return DocBlockElement(
+            id=self.new_id(),
+            created_at=self.created_at,
+            type=type,
+            block_content=block_content,
+            block_attr=block_attr,
+            children=[] if children is None else children,
+            tags=[],  # Given, so validation does not deep copy the default
+        )
+
+
+class ForestBlockBuilder(DocBlockBuilder):
+    """Makes ForestBlocks to pack into a DocBlockForest, so parsing into a forest makes no DocBlockElements."""
+
+    def build(
+        self,
+        type: DocBlockElementType,
+        block_content: Optional[str] = None,
+        block_attr: Optional[Dict[str, Any]] = None,
+        children: Optional[List[ObjectId]] = None,
+    ) -> ForestBlock:
+        return ForestBlock(self.new_id(), type, block_content, block_attr, children)
+
+
 class ToDocBlock:
     GENERIC_MODE = "generic"
     ONE_NOTE_MODE = "one_note"
     USER_DEFINED_MODE = "user_defined"
 
+    # Parse method for each block type. Looked up by name so subclasses can override the methods
+    FUNC_NAMES: ClassVar[Dict[DocBlockElementType, str]] = {
+        DocBlockElementType.TEXT: "_text",
+        DocBlockElementType.EMPHASIS: "_emphasis",
+        DocBlockElementType.STRONG: "_strong",
+        DocBlockElementType.LINK: "_link",
+        DocBlockElementType.IMAGE: "_image",
+        DocBlockElementType.CODESPAN: "_codespan",
+        DocBlockElementType.LINE_BREAK: "_line_break",
+        DocBlockElementType.SOFT_BREAK: "_soft_break",
+        DocBlockElementType.BLANK_LINE: "_blank_line",
+        DocBlockElementType.INLINE_HTML: "_inline_html",
+        DocBlockElementType.PARAGRAPH: "_paragraph",
+        DocBlockElementType.HEADING: "_heading",
+        DocBlockElementType.THEMATIC_BREAK: "_thematic_break",
+        DocBlockElementType.BLOCK_TEXT: "_block_text",
+        DocBlockElementType.BLOCK_CODE: "_block_code",
+        DocBlockElementType.BLOCK_QUOTE: "_block_quote",
+        DocBlockElementType.BLOCK_HTML: "_block_html",
+        DocBlockElementType.LIST_ITEM: "_list_item",
+        DocBlockElementType.LIST: "_list",
+        DocBlockElementType.TABLE: "_table",
+        DocBlockElementType.TABLE_HEAD: "_table_head",
+        DocBlockElementType.TABLE_BODY: "_table_body",
+        DocBlockElementType.TABLE_ROW: "_table_row",
+        DocBlockElementType.TABLE_CELL: "_table_cell",
+    }
+    # Parse methods that replace the defaults in each mode
+    MODE_FUNC_NAMES: ClassVar[Dict[str, Dict[DocBlockElementType, str]]] = {
+        GENERIC_MODE: {},
+        ONE_NOTE_MODE: {DocBlockElementType.LINK: "_on_link"},
+    }
+
     def __init__(self, mode_set: Optional[str] = GENERIC_MODE):
         """Initializes an Md2DocBlock instance.
 
@@ -318,37 +673,13 @@ class ToDocBlock:
             ignore_token_type_list (Optional[List[str]], optional): additional list of token types for the parser to ignore. Parser automatically ignores None types and "blank_line" types. Defaults to None.
             mode_set (Optional[str], optional): Parsing mode. Can be "Generic", "oneNote", or "User_Defined". Defaults to GENERIC_MODE.
         """
-        self._default_func_list = {
-            DocBlockElementType.TEXT: self._text,
-            DocBlockElementType.EMPHASIS: self._emphasis,
-            DocBlockElementType.STRONG: self._strong,
-            DocBlockElementType.LINK: self._link,
-            DocBlockElementType.IMAGE: self._image,
-            DocBlockElementType.CODESPAN: self._codespan,
-            DocBlockElementType.LINE_BREAK: self._line_break,
-            DocBlockElementType.SOFT_BREAK: self._soft_break,
-            DocBlockElementType.BLANK_LINE: self._blank_line,
-            DocBlockElementType.INLINE_HTML: self._inline_html,
-            DocBlockElementType.PARAGRAPH: self._paragraph,
-            DocBlockElementType.HEADING: self._heading,
-            DocBlockElementType.THEMATIC_BREAK: self._thematic_break,
-            DocBlockElementType.BLOCK_TEXT: self._block_text,
-            DocBlockElementType.BLOCK_CODE: self._block_code,
-            DocBlockElementType.BLOCK_QUOTE: self._block_quote,
-            DocBlockElementType.BLOCK_HTML: self._block_html,
-            DocBlockElementType.LIST_ITEM: self._list_item,
-            DocBlockElementType.LIST: self._list,
-            DocBlockElementType.TABLE: self._table,
-            DocBlockElementType.TABLE_HEAD: self._table_head,
-            DocBlockElementType.TABLE_BODY: self._table_body,
-            DocBlockElementType.TABLE_ROW: self._table_row,
-            DocBlockElementType.TABLE_CELL: self._table_cell,
-        }
-        self.func_list = self._default_func_list
-
+        self._overrides: Dict[DocBlockElementType, Callable] = {}
         self.mode = mode_set
+        self._builder = DocBlockBuilder()
 
         self.__block_list: List[DocBlockElement] = []
+        self.__block_cache: Dict[int, Union[Tuple[DocBlockElement, dict], Exception]] = {}
+        self.__used_children: Dict[int, Tuple[DocBlockElement, dict]] = {}
 
     @classmethod
     def parse_md2docblock(cls, md: str, mode: Optional[str] = GENERIC_MODE) -> Tuple[List[DocBlockElement], List[ObjectId]]:
@@ -369,6 +700,60 @@ class ToDocBlock:
 
         return (parser.get_block_list(), id_list)
 
+    @classmethod
+    def iter_md2docblock(
+        cls, md: str, mode: Optional[str] = GENERIC_MODE, batch_size: int = 500
+    ) -> Generator[Tuple[List[DocBlockElement], List[ObjectId]], None, None]:
+        """Parses a Markdown string into DocBlockElements a batch at a time, so they can be written while parsing continues.
+
+        Every block comes after its children, so a batch never references a block that has not been yielded yet. A top level tree
+        bigger than batch_size is split over several batches, and its root id comes with the batch holding its root block. Joining the
+        batches gives the same lists as parse_md2docblock. At most the mistune tokens of the page, one top level tree of blocks and one
+        batch are held at once.
+
+        Args:
+            md (str): Markdown string.
+            mode (Optional[str], optional): Parsing mode as defined by Md2DocBlock constants. Defaults to GENERIC_MODE.
+            batch_size (int, optional): Most blocks in a batch. Defaults to 500.
+
+        Yields:
+            Generator[Tuple[List[DocBlockElement], List[ObjectId]], None, None]: The blocks of the batch, and the ids of the top level blocks in it.
+        """
+        parser = cls(mode_set=mode)
+        id_list = []
+        for token in parser.md_to_token(md):
+            id_list.append(parser.make_block(token))
+            blocks = parser.__block_list
+            full = len(blocks) - len(blocks) % batch_size
+            for start in range(0, full, batch_size):
+                if start + batch_size < len(blocks):  # The root of the current tree is in a later batch
+                    yield blocks[start : start + batch_size], id_list[:-1]
+                    id_list = id_list[-1:]
+                else:
+                    yield blocks[start:], id_list
+                    id_list = []
+            parser.__block_list = blocks[full:]
+
+        if parser.__block_list:
+            yield parser.__block_list, id_list
+
+    @classmethod
+    def parse_md2forest(cls, md: str, mode: Optional[str] = GENERIC_MODE, **kwargs) -> DocBlockForest:
+        """Parses a Markdown string into a single DocBlockForest. The parse functions make ForestBlocks instead of DocBlockElements.
+
+        Args:
+            md (str): Markdown string.
+            mode (Optional[str], optional): Parsing mode as defined by Md2DocBlock constants. Defaults to GENERIC_MODE.
+            **kwargs: Other fields of the forest, e.g. page_id and export_id.
+
+        Returns:
+            DocBlockForest: All of the parsed blocks in one document.
+        """
+        parser = cls(mode_set=mode)
+        parser._builder = ForestBlockBuilder(parser._builder.created_at)
+        id_list = [parser.make_block(token) for token in parser.md_to_token(md)]
+        return DocBlockForest.from_blocks(parser.__block_list, id_list, **kwargs)
+
     @property
     def mode(self) -> str:
         """Getter for the mode of an instance of this parser.
@@ -388,24 +773,32 @@ class ToDocBlock:
         Raises:
             AttributeError: Using mode presets to configure the parse function list.
         """
-        if mode_to_set == self.GENERIC_MODE:
-            self._mode = self.GENERIC_MODE
-            self._func_list = self._default_func_list.copy()
-        elif mode_to_set == self.ONE_NOTE_MODE:
-            self._func_list = self._default_func_list.copy()
-            self.override_func_list(DocBlockElementType.LINK, self._on_link)
-            self._mode = self.ONE_NOTE_MODE
-        else:
+        if mode_to_set not in self.MODE_FUNC_NAMES:
             raise AttributeError(f"Invalid mode: {mode_to_set}")
+        self._dispatch = self.dispatch_table(mode_to_set)
+        self._overrides = {}
+        self._mode = mode_to_set
+
+    @classmethod
+    def dispatch_table(cls, mode: str = GENERIC_MODE) -> Dict[DocBlockElementType, Callable]:
+        """Parse functions of this class by token type for a mode. Built once per class and mode, and shared by every instance.
+
+        Args:
+            mode (str, optional): Parsing mode. Defaults to GENERIC_MODE.
+
+        Returns:
+            Dict[DocBlockElementType, Callable]: Token type to an unbound parse method.
+        """
+        return class_dispatch_table(cls, {**cls.FUNC_NAMES, **cls.MODE_FUNC_NAMES[mode]}, mode)
 
     @property
-    def func_list(self) -> Dict[str, Callable]:
-        """Shallow copy of parser list.
+    def func_list(self) -> FuncListView:
+        """Live view of the parse functions of this instance, bound to it. Setting an item overrides the parser of one token type.
 
         Returns:
-            Dict[str, Callable]: A string-callable dictionary for each token type specified in Md2DocBlock.TOKEN_TYPES
+            FuncListView: Token type to parse function.
         """
-        return self._func_list.copy()
+        return FuncListView(self)
 
     @func_list.setter
     def func_list(self, set_func_list: Dict[DocBlockElementType, Callable]):
@@ -414,7 +807,8 @@ class ToDocBlock:
         Args:
             set_func_list (Dict[DocBlockElementType, Callable]): Function list to set the parser's function list to.
         """
-        self._func_list = set_func_list.copy()
+        self._dispatch = {}
+        self._overrides = dict(set_func_list)
 
     def override_func_list(self, token_parser_type: DocBlockElementType, token_parser_callable: Callable):
         """Sets the parse functions for each potential token type encountered in a markdown file.
@@ -429,9 +823,15 @@ class ToDocBlock:
         if not token_parser_type and token_parser_callable:
             raise AttributeError(f"No token parser type given to override with {token_parser_callable}.")
         else:
-            self._func_list[token_parser_type] = token_parser_callable
+            self._overrides[token_parser_type] = token_parser_callable
             self._mode = self.USER_DEFINED_MODE
 
+    def parse_token(self, token: Dict[str, Any], token_type: Optional[DocBlockElementType] = None) -> DocBlockElement:
+        """Calls the parse function of a token type, the token's own type by default, on one token."""
+        token_type = token["type"] if token_type is None else token_type
+        func = self._overrides.get(token_type)
+        return func(token) if func is not None else self._dispatch[token_type](self, token)
+
     def md_to_token(self, raw_md: str) -> List[Dict[str, Any]]:
         """Parses a raw Markdown string into python tokens.
 
@@ -459,36 +859,88 @@ class ToDocBlock:
         if not child_list:
             return []
 
+        block_cache = self.__block_cache
+        used_children = self.__used_children
         id_list: List[ObjectId] = []
-
         for child in child_list:
-            id_list.append(self.make_block(child))
-
+            entry = block_cache[id(child)]
+            if isinstance(entry, Exception):
+                raise entry
+            used_children[id(child)] = entry  # Keyed so asking twice does not add the child twice
+            id_list.append(entry[0].id)
         return id_list
 
     def make_block(self, token: Dict[str, Any]) -> ObjectId:
-        token_type = token.get("type")
-        if token_type in self.func_list:
-            try:
-                new_block: DocBlockElement = self._func_list[token_type](token)
-            except Exception as e:
-                raise Exception(f"While parsing: {token}.") from e
-        else:
-            raise KeyError(f"Invalid token type: {token}")
+        """Makes the block of a token and all of its descendants, adding them to the block list children first.
 
-        self.__block_list.append(new_block)
-        return new_block.id
+        The tree is walked with an explicit stack so that children are made before their parents, which keeps deep trees from hitting the recursion limit. Parse functions get their children's ids from make_children_blocks, and only the children they use end up in the block list. Errors of children are only raised if their parent asks for them, as if they were made on demand.
+
+        Args:
+            token (Dict[str, Any]): Root mistune token of the tree.
+
+        Raises:
+            KeyError: A token has a type without a parse function.
+
+        Returns:
+            ObjectId: Id of the root block.
+        """
+        dispatch = self._dispatch
+        overrides = self._overrides
+        outer_block_cache, outer_used_children = self.__block_cache, self.__used_children
+        block_cache = self.__block_cache = {}  # Dropped after the tree, with the blocks no parse function asked for
+        stack: List[Tuple[Dict[str, Any], bool]] = [(token, False)]
+        try:
+            while stack:
+                current, expanded = stack.pop()
+                if not expanded:
+                    token_type = current.get("type")
+                    if token_type not in dispatch and token_type not in overrides:
+                        block_cache[id(current)] = KeyError(f"Invalid token type: {current}")
+                        continue
+                    stack.append((current, True))
+                    children = current.get("children")
+                    if children:
+                        stack.extend((child, False) for child in reversed(children))
+                    continue
+
+                used_children = self.__used_children = {}
+                try:
+                    func = overrides.get(current["type"]) if overrides else None
+                    new_block: DocBlockElement = func(current) if func is not None else dispatch[current["type"]](self, current)
+                except Exception as e:
+                    block_cache[id(current)] = error = Exception(f"While parsing: {current}.")
+                    error.__cause__ = e
+                    continue
+                block_cache[id(current)] = (new_block, used_children)
+        finally:
+            self.__block_cache, self.__used_children = outer_block_cache, outer_used_children
+
+        root = block_cache[id(token)]
+        if isinstance(root, Exception):
+            raise root
+
+        # Add the tree to the block list in the order the recursive parser did, each block after its children
+        entries: List[Tuple[Tuple[DocBlockElement, dict], bool]] = [(root, False)]
+        while entries:
+            (block, used_children), expanded = entries.pop()
+            if expanded:
+                self.__block_list.append(block)
+                continue
+            entries.append(((block, used_children), True))
+            entries.extend((child, False) for child in reversed(used_children.values()))
+
+        return root[0].id
 
     def _text(self, token: Dict[str, Any]) -> DocBlockElement:
-        return DocBlockElement(type=DocBlockElementType.TEXT, block_content=token.get("raw"))
+        return self._builder.build(type=DocBlockElementType.TEXT, block_content=token.get("raw"))
 
     def _emphasis(self, token: Dict[str, Any]) -> DocBlockElement:
         id_list = self.make_children_blocks(token)
-        return DocBlockElement(type=DocBlockElementType.EMPHASIS, children=id_list)
+        return self._builder.build(type=DocBlockElementType.EMPHASIS, children=id_list)
 
     def _strong(self, token: Dict[str, Any]) -> DocBlockElement:
         id_list = self.make_children_blocks(token)
-        return DocBlockElement(type=DocBlockElementType.STRONG, children=id_list)
+        return self._builder.build(type=DocBlockElementType.STRONG, children=id_list)
 
     def _link(self, token: Dict[str, Any]) -> DocBlockElement:
         id_list = self.make_children_blocks(token)
@@ -496,7 +948,7 @@ class ToDocBlock:
         url = attrs.get("url") if attrs else None
         title = attrs.get("title") if attrs else None
 
-        return DocBlockElement(
+        return self._builder.build(
             type=DocBlockElementType.LINK,
             children=id_list,
             block_attr={"url": url, "title": title},
@@ -514,7 +966,7 @@ class ToDocBlock:
             return self._link(token)
 
     def _image(self, token: Dict[str, Any]) -> DocBlockElement:
-        block = self._func_list[DocBlockElementType.LINK](token)
+        block = self.parse_token(token, DocBlockElementType.LINK)
         if block.type == DocBlockElementType.RESOURCE_REFERENCE:
             return block
         else:
@@ -522,51 +974,51 @@ class ToDocBlock:
             return block
 
     def _codespan(self, token: Dict[str, Any]) -> DocBlockElement:
-        return DocBlockElement(type=DocBlockElementType.CODESPAN, block_content=token.get("raw"))
+        return self._builder.build(type=DocBlockElementType.CODESPAN, block_content=token.get("raw"))
 
     def _line_break(self, token: Dict[str, Any]) -> DocBlockElement:
-        return DocBlockElement(type=DocBlockElementType.LINE_BREAK)
+        return self._builder.build(type=DocBlockElementType.LINE_BREAK)
 
     def _soft_break(self, token: Dict[str, Any]) -> DocBlockElement:
-        return DocBlockElement(type=DocBlockElementType.SOFT_BREAK)
+        return self._builder.build(type=DocBlockElementType.SOFT_BREAK)
 
     def _blank_line(self, token: Dict[str, Any]) -> DocBlockElement:
-        return DocBlockElement(type=DocBlockElementType.BLANK_LINE)
+        return self._builder.build(type=DocBlockElementType.BLANK_LINE)
 
     def _inline_html(self, token: Dict[str, Any]) -> DocBlockElement:
-        return DocBlockElement(type=DocBlockElementType.INLINE_HTML, block_content=token.get("raw"))
+        return self._builder.build(type=DocBlockElementType.INLINE_HTML, block_content=token.get("raw"))
 
     def _paragraph(self, token: Dict[str, Any]) -> DocBlockElement:
         id_list = self.make_children_blocks(token)
-        return DocBlockElement(type=DocBlockElementType.PARAGRAPH, children=id_list)
+        return self._builder.build(type=DocBlockElementType.PARAGRAPH, children=id_list)
 
     def _heading(self, token: Dict[str, Any]) -> DocBlockElement:
         id_list = self.make_children_blocks(token)
         attrs = token.get("attrs")
         level = attrs.get("level") if attrs else None
 
-        return DocBlockElement(type=DocBlockElementType.HEADING, children=id_list, block_attr={"level": level})
+        return self._builder.build(type=DocBlockElementType.HEADING, children=id_list, block_attr={"level": level})
 
     def _thematic_break(self, token: Dict[str, Any]) -> DocBlockElement:
-        return DocBlockElement(type=DocBlockElementType.THEMATIC_BREAK)
+        return self._builder.build(type=DocBlockElementType.THEMATIC_BREAK)
 
     def _block_text(self, token: Dict[str, Any]) -> DocBlockElement:
         id_list = self.make_children_blocks(token)
-        return DocBlockElement(type=DocBlockElementType.BLOCK_TEXT, children=id_list)
+        return self._builder.build(type=DocBlockElementType.BLOCK_TEXT, children=id_list)
 
     def _block_code(self, token: Dict[str, Any]) -> DocBlockElement:
         raw = token.get("raw")
         attrs = token.get("attrs")
         lang = attrs.get("info") if attrs else None
 
-        return DocBlockElement(type=DocBlockElementType.BLOCK_CODE, block_content=raw, block_attr={"language": lang})
+        return self._builder.build(type=DocBlockElementType.BLOCK_CODE, block_content=raw, block_attr={"language": lang})
 
     def _block_quote(self, token: Dict[str, Any]) -> DocBlockElement:
         id_list = self.make_children_blocks(token)
-        return DocBlockElement(type=DocBlockElementType.BLOCK_QUOTE, children=id_list)
+        return self._builder.build(type=DocBlockElementType.BLOCK_QUOTE, children=id_list)
 
     def _block_html(self, token: Dict[str, Any]) -> DocBlockElement:
-        return DocBlockElement(type=DocBlockElementType.BLOCK_HTML, block_content=token.get("raw"))
+        return self._builder.build(type=DocBlockElementType.BLOCK_HTML, block_content=token.get("raw"))
 
     def _list(self, token: Dict[str, Any]) -> DocBlockElement:
         id_list = self.make_children_blocks(token)
@@ -576,7 +1028,7 @@ class ToDocBlock:
         bullet = token.get("bullet")
         tight = token.get("tight")
 
-        return DocBlockElement(
+        return self._builder.build(
             type=DocBlockElementType.LIST,
             children=id_list,
             block_attr={"ordered": ordered, "depth": depth, "bullet": bullet, "tight": tight},
@@ -584,7 +1036,7 @@ class ToDocBlock:
 
     def _list_item(self, token: Dict[str, Any]) -> DocBlockElement:
         id_list = self.make_children_blocks(token)
-        return DocBlockElement(type=DocBlockElementType.LIST_ITEM, children=id_list)
+        return self._builder.build(type=DocBlockElementType.LIST_ITEM, children=id_list)
 
     def _table(self, token: Dict[str, Any]) -> DocBlockElement:
         return self._table_element(token, DocBlockElementType.TABLE)
@@ -604,11 +1056,11 @@ class ToDocBlock:
         align = attrs.get("align") if attrs else None
         head = attrs.get("head") if attrs else None
 
-        return DocBlockElement(type=DocBlockElementType.TABLE_CELL, block_attr={"align": align, "head": head}, children=id_list)
+        return self._builder.build(type=DocBlockElementType.TABLE_CELL, block_attr={"align": align, "head": head}, children=id_list)
 
     def _table_element(self, token: Dict[str, Any], element: DocBlockElementType) -> DocBlockElement:
         id_list = self.make_children_blocks(token)
-        return DocBlockElement(type=element, children=id_list)
+        return self._builder.build(type=element, children=id_list)
 
     def _on_check_relative(self, token: Dict[str, Any]) -> str:
         """Checks a token for a uri, and if it is a relative reference to another item in a resource folder like in a oneNote export.
@@ -0,0 +1,154 @@
+"""
+Memoization of rendered DocBlock trees.
+
+Classes:
+    RenderCache: Thread safe, size bounded LRU of rendered output, optionally backed by a mongo collection.
+
+Functions:
+    subtree_hashes: Content hash of the tree under each top level block.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from bson import ObjectId
+from pymongo.collection import Collection
+
+from ...models.docblock import DocBlockElement
+
+
+def subtree_hashes(block_dict: Dict[ObjectId, DocBlockElement], root_ids: Iterable[ObjectId]) -> Dict[ObjectId, str]:
+    """Hashes the tree under each root from the type, content and attributes of its blocks and their nesting, so equal trees hash the same whatever their ids.
+
+    Args:
+        block_dict (Dict[ObjectId, DocBlockElement]): Every block of the trees by id.
+        root_ids (Iterable[ObjectId]): Ids of the top level blocks.
+
+    Raises:
+        KeyError: If a block under the roots is not in block_dict.
+
+    Returns:
+        Dict[ObjectId, str]: Root id to the hex digest of its tree.
+    """
+    hashes: Dict[ObjectId, str] = {}
+    for root_id in root_ids:
+        if root_id in hashes:
+            continue
+        parts: List[str] = []
+        stack: List[Optional[ObjectId]] = [root_id]
+        while stack:
+            block_id = stack.pop()
+            if block_id is None:  # End of a block's children
+                parts.append(")")
+                continue
+            block = block_dict[block_id]
+            parts.append(repr((block.type.value, block.block_content, block.block_attr)))
+            if block.children:
+                parts.append("(")
+                stack.append(None)
+                stack.extend(reversed(block.children))
+        hashes[root_id] = hashlib.blake2b("\0".join(parts).encode(), digest_size=16).hexdigest()
+    return hashes
+
+
+class RenderCache:
+    """Size bounded LRU of rendered output keyed by content hash. Entries that fall out, or were made by another process, are looked up in the mongo collection if one is given.
+
+    Attributes:
+        max_size (int): Most characters of output held in memory.
+        collection (Optional[Collection]): Collection that every entry is also written to.
+        hits (int): Lookups answered from memory or the collection.
+        misses (int): Lookups that were not.
+    """
+
+    def __init__(self, max_size: int = 16 * 2**20, collection: Optional[Collection] = None):
+        self.max_size = max_size
+        self.collection = collection
+        self.hits = 0
+        self.misses = 0
+        self._size = 0
+        self._entries: "OrderedDict[str, Tuple[str, List[str]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(*parts: str) -> str:
+        """Hashes parts of a key, e.g. renderer settings and subtree hashes, into one key."""
+        digest = hashlib.blake2b(digest_size=16)
+        for part in parts:
+            digest.update(part.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[Tuple[str, List[str]]]:
+        """Looks up rendered output.
+
+        Args:
+            key (str): Content hash of what was rendered.
+
+        Returns:
+            Optional[Tuple[str, List[str]]]: Rendered string and the resources it needs, or None on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        document = self.collection.find_one({"_id": key}) if self.collection is not None else None
+        if document is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        entry = (document["output"], document["resources"])
+        self._store(key, entry)
+        with self._lock:
+            self.hits += 1
+        return entry
+
+    def put(self, key: str, output: str, resources: List[str]) -> None:
+        """Stores rendered output, evicting the least recently used entries past max_size.
+
+        Args:
+            key (str): Content hash of what was rendered.
+            output (str): Rendered string.
+            resources (List[str]): Resources the output needs.
+        """
+        entry = (output, list(resources))
+        self._store(key, entry)
+        if self.collection is not None:
+            self.collection.replace_one({"_id": key}, {"output": output, "resources": entry[1]}, upsert=True)
+
+    def clear(self) -> None:
+        """Empties the in memory entries. The collection is left alone."""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    @staticmethod
+    def _entry_size(entry: Tuple[str, List[str]]) -> int:
+        return len(entry[0]) + sum(len(resource) for resource in entry[1])
+
+    def _store(self, key: str, entry: Tuple[str, List[str]]) -> None:
+        size = self._entry_size(entry)
+        if size > self.max_size:
+            return
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self._size -= self._entry_size(old_entry)
+            self._entries[key] = entry
+            self._size += size
+            while self._size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= self._entry_size(evicted)
@@ -0,0 +1,280 @@
+"""
+Rate limiting helpers shared by the http adapters.
+
+Classes:
+    TokenBucket: Thread safe token bucket that callers block on before each request.
+    RequestScheduler: Hands out a token bucket's tokens in priority order.
+    CircuitBreaker: Stops sending requests to a server after repeated failures.
+    RequestStats: Per endpoint latency, retry and error counters.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from datetime import datetime
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+
+class TokenBucket:
+    """Thread safe token bucket. Each request takes a token and tokens refill at a fixed rate.
+
+    Attributes:
+        rate (float): Tokens added per second.
+        capacity (float): Most tokens the bucket can hold, which is the largest allowed burst.
+        throttle_time (float): Total seconds callers have spent waiting for tokens.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        if rate <= 0:
+            raise ValueError(f"Token bucket rate must be positive, got {rate}")
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.throttle_time = 0.0
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens: float = 1.0) -> float:
+        """Blocks until the tokens are available and takes them.
+
+        Args:
+            tokens (float, optional): Number of tokens to take. Defaults to 1.0.
+
+        Returns:
+            float: Seconds spent waiting.
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                elif self._tokens >= tokens:
+                    self._tokens -= tokens
+                    self.throttle_time += waited
+                    return waited
+                else:
+                    delay = (tokens - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds: float) -> None:
+        """Stops handing out tokens for a number of seconds, e.g. when a server answers with Retry-After.
+
+        Args:
+            seconds (float): Seconds from now until tokens are handed out again.
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+
+class RequestScheduler:
+    """Hands out the tokens of a token bucket to waiting callers in priority order, lower numbers first and first come first served
+    within a priority. Share one scheduler between every client of a rate limited api.
+
+    Attributes:
+        limiter (TokenBucket): Bucket the tokens come from.
+        queue_time (float): Total seconds callers have spent waiting, both behind other callers and for tokens.
+        max_queue_depth (int): Most callers that have waited at once.
+        requests (Dict[int, int]): Number of tokens handed out per priority.
+    """
+
+    def __init__(self, limiter: TokenBucket):
+        self.limiter = limiter
+        self.queue_time = 0.0
+        self.max_queue_depth = 0
+        self.requests: Dict[int, int] = {}
+        self._waiting: List[Tuple[int, int]] = []
+        self._acquiring = False
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of callers waiting for a token right now."""
+        return len(self._waiting) + int(self._acquiring)
+
+    def acquire(self, priority: int = 0) -> float:
+        """Blocks until every caller ahead of this one has its token, then takes one.
+
+        Args:
+            priority (int, optional): Lower numbers are served first. Defaults to 0.
+
+        Returns:
+            float: Seconds spent waiting.
+        """
+        start = time.monotonic()
+        with self._condition:
+            ticket = (priority, next(self._counter))
+            heapq.heappush(self._waiting, ticket)
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+            while self._acquiring or self._waiting[0] != ticket:
+                self._condition.wait()
+            heapq.heappop(self._waiting)
+            self._acquiring = True
+
+        try:
+            self.limiter.acquire()
+        finally:
+            with self._condition:
+                self._acquiring = False
+                waited = time.monotonic() - start
+                self.queue_time += waited
+                self.requests[priority] = self.requests.get(priority, 0) + 1
+                self._condition.notify_all()
+        return waited
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Copies the counters.
+
+        Returns:
+            Dict[str, Any]: "queue_depth", "max_queue_depth", "queue_time", "throttle_time" spent waiting for tokens, and "requests" per
+                priority.
+        """
+        with self._condition:
+            return {
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "queue_time": self.queue_time,
+                "throttle_time": self.limiter.throttle_time,
+                "requests": dict(self.requests),
+            }
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request while a circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Opens after a number of failures in a row and rejects requests until the reset timeout passes. After that one trial request is let through, which closes the breaker if it succeeds.
+
+    Attributes:
+        failure_threshold (int): Failures in a row that open the breaker.
+        reset_timeout (float): Seconds the breaker stays open before a trial request.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = 0.0
+        self._state = self.CLOSED
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    def before_request(self) -> None:
+        """Checks that a request may be sent.
+
+        Raises:
+            CircuitOpenError: If the breaker is open, or half open with a trial request already in flight.
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._state = self.HALF_OPEN
+                return
+            raise CircuitOpenError(f"Circuit breaker is {self._state} after {self._failures} failures in a row")
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._state = self.CLOSED
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class RequestStats:
+    """Thread safe per endpoint request counters."""
+
+    def __init__(self):
+        self._stats: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint: str, latency: float, retries: int = 0, error: bool = False) -> None:
+        """Records one finished request, including all of its retries.
+
+        Args:
+            endpoint (str): Name of the endpoint, e.g. "GET /rest/api/content/{id}".
+            latency (float): Seconds from the first attempt until the final response.
+            retries (int, optional): Number of attempts after the first. Defaults to 0.
+            error (bool, optional): If the request ended in an error. Defaults to False.
+        """
+        with self._lock:
+            stats = self._stats.setdefault(
+                endpoint, {"requests": 0, "retries": 0, "errors": 0, "total_latency": 0.0, "max_latency": 0.0}
+            )
+            stats["requests"] += 1
+            stats["retries"] += retries
+            stats["errors"] += int(error)
+            stats["total_latency"] += latency
+            stats["max_latency"] = max(stats["max_latency"], latency)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """Copies the counters.
+
+        Returns:
+            Dict[str, Dict[str, float]]: Endpoint to its "requests", "retries", "errors", "total_latency", "max_latency" and "mean_latency".
+        """
+        with self._lock:
+            return {
+                endpoint: {**stats, "mean_latency": stats["total_latency"] / stats["requests"]} for endpoint, stats in self._stats.items()
+            }
+
+
+def parse_retry_after(value: Optional[Union[str, float]]) -> Optional[float]:
+    """Parses a Retry-After header, which is either a number of seconds or an http date.
+
+    Args:
+        value (Optional[Union[str, float]]): Header value.
+
+    Returns:
+        Optional[float]: Seconds to wait, or None if the header is missing or invalid.
+
+    >>> parse_retry_after("3")
+    3.0
+    >>> parse_retry_after(None) is None
+    True
+    >>> parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT")
+    0.0
+    """
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
@@ -0,0 +1,211 @@
+"""
+Offline benchmarks of the markdown -> DocBlock -> html ingest path and of the Notion json -> markdown export.
+
+Each corpus is run through cf_pre_process, ToDocBlock.parse_md2docblock, FromDocBlock.render_docBlock and cf_post_process. Large
+Notion pages are run through JsonToMd.page2md. The throughput and the peak traced memory of every stage are printed as a table.
+
+Skipped unless BENCHMARK or BENCHMARK_BASELINE is set.
+
+Environment:
+    BENCHMARK: Set to run the benchmarks.
+    BENCHMARK_SCALE: Multiplies the size of every corpus. Defaults to 1.
+    BENCHMARK_REPEAT: Timed runs per stage, the fastest is reported. Defaults to 3.
+    BENCHMARK_BASELINE: Json file of earlier results. Written if it does not exist, otherwise a stage that is more than
+        BENCHMARK_TOLERANCE times, plus NOISE_FLOOR seconds, slower than its baseline fails the run.
+    BENCHMARK_TOLERANCE: Defaults to 1.5.
+"""
+
+import gc
+import json
+import os
+import time
+import tracemalloc
+import unittest
+from pathlib import Path
+from typing import Any
+from typing import Callable
+from typing import ClassVar
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import mistune
+
+from databasetools.adapters.confluence.cf_adapter import cf_post_process
+from databasetools.adapters.confluence.cf_adapter import cf_pre_process
+from databasetools.adapters.notion.json2md import JsonToMd
+from databasetools.utils.docBlock.docBlock_utils import FromDocBlock
+from databasetools.utils.docBlock.docBlock_utils import ToDocBlock
+from test_docblock_utils import TEST_MD
+
+BENCHMARK = bool(os.getenv("BENCHMARK"))
+BENCHMARK_SCALE = float(os.getenv("BENCHMARK_SCALE", "1"))
+BENCHMARK_REPEAT = int(os.getenv("BENCHMARK_REPEAT", "3"))
+BENCHMARK_BASELINE = os.getenv("BENCHMARK_BASELINE")
+BENCHMARK_TOLERANCE = float(os.getenv("BENCHMARK_TOLERANCE", "1.5"))
+NOISE_FLOOR = 0.002  # Stages this fast vary more run to run than any tolerance
+
+
+def scaled(count: int) -> int:
+    return max(1, int(count * BENCHMARK_SCALE))
+
+
+def small_pages(count: int) -> List[str]:
+    """Short notes, the most common page in a OneNote export."""
+    return [
+        f"# Meeting {i}\n\nNotes from **meeting {i}** with the [team](https://example.com/team/{i}).\n\n"
+        f"- Action item {i}\n- Follow up on *item {i + 1}*\n\nSee `ticket-{i}` for details.\n"
+        for i in range(count)
+    ]
+
+
+def huge_table(rows: int, columns: int = 8) -> str:
+    """One page holding a single wide table."""
+    header = "| " + " | ".join(f"Column {c}" for c in range(columns)) + " |"
+    delimiter = "| " + " | ".join("---" for _ in range(columns)) + " |"
+    body = ["| " + " | ".join(f"**r{r}** c{c}" if c == 0 else f"r{r} c{c}" for c in range(columns)) + " |" for r in range(rows)]
+    return "Some text before the table\n" + "\n".join([header, delimiter, *body]) + "\nSome text after the table\n"
+
+
+def deep_lists(count: int, depth: int = 8) -> str:
+    """Lists nested as deep as the block parser allows, repeated."""
+    items = []
+    for i in range(count):
+        for level in range(depth):
+            items.append(f"{'  ' * level}- Item {i}.{level} with *emphasis*")
+        items.append("")
+    return "\n".join(items)
+
+
+def image_page(count: int) -> str:
+    """A page of relative images and attachment links, which become resource references in one_note mode."""
+    lines = []
+    for i in range(count):
+        lines.append(f"![Figure {i}](../../resources/figure_{i}.png)\n")
+        lines.append(f"Caption for figure {i}, see [the slides](../../resources/slides_{i}.pptx).\n")
+    return "\n".join(lines)
+
+
+def rich_text(text: str, bold: bool = False, code: bool = False) -> List[dict]:
+    annotations = {"bold": bold, "italic": False, "strikethrough": False, "underline": False, "code": code, "color": "default"}
+    return [{"type": "text", "text": {"content": text, "link": None}, "annotations": annotations, "plain_text": text, "href": None}]
+
+
+def notion_block(block_type: str, content: dict, children: Optional[List[dict]] = None) -> dict:
+    return {"object": "block", "type": block_type, block_type: content, "has_children": bool(children), "children": children or []}
+
+
+def notion_page(sections: int) -> List[dict]:
+    """Blocks of a long Notion page, as downloaded by NotionDownloader, with headings, paragraphs, nested lists, code and tables."""
+    blocks = []
+    for i in range(sections):
+        blocks.append(notion_block("heading_2", {"rich_text": rich_text(f"Section {i}")}))
+        blocks.append(notion_block("paragraph", {"rich_text": rich_text(f"Some **text** of section {i} ") + rich_text("in bold", bold=True)}))
+        nested = [notion_block("bulleted_list_item", {"rich_text": rich_text(f"Sub item {i}.{j}")}) for j in range(3)]
+        blocks.extend(notion_block("bulleted_list_item", {"rich_text": rich_text(f"Item {i}.{j}")}, nested) for j in range(3))
+        blocks.append(notion_block("to_do", {"rich_text": rich_text(f"Follow up on section {i}"), "checked": False}))
+        blocks.append(notion_block("code", {"rich_text": rich_text(f"print({i})"), "language": "python"}))
+        rows = [notion_block("table_row", {"cells": [rich_text(f"r{r} c{c}") for c in range(4)]}) for r in range(4)]
+        blocks.append(notion_block("table", {"table_width": 4}, rows))
+    return blocks
+
+
+def measure(func: Callable[[Any], Any], items: List[Any], size: int) -> Dict[str, float]:
+    """Runs a function over every item. Memory is traced in a separate run so tracing does not slow the timed ones, which run with the garbage collector off.
+
+    Args:
+        func (Callable[[Any], Any]): Stage to measure.
+        items (List[Any]): Inputs of the stage.
+        size (int): Characters of markdown the items came from.
+
+    Returns:
+        Dict[str, float]: Fastest "seconds" of the timed runs, "items_per_s", "mb_per_s" of markdown and "peak_mb" of traced memory.
+    """
+    tracemalloc.start()
+    try:
+        for item in items:
+            func(item)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    best = float("inf")
+    for _ in range(BENCHMARK_REPEAT):
+        gc.collect()
+        gc.disable()  # Like timeit, so collections triggered by earlier stages are not counted
+        try:
+            start = time.perf_counter()
+            for item in items:
+                func(item)
+            best = min(best, time.perf_counter() - start)
+        finally:
+            gc.enable()
+    return {"seconds": best, "items_per_s": len(items) / best, "mb_per_s": size / best / 2**20, "peak_mb": peak / 2**20}
+
+
+@unittest.skipUnless(BENCHMARK or BENCHMARK_BASELINE, "Set BENCHMARK or BENCHMARK_BASELINE to run the benchmarks")
+class TestIngestBenchmarks(unittest.TestCase):
+    results: ClassVar[Dict[str, Dict[str, float]]] = {}
+
+    def run_corpus(self, name: str, pages: List[str]):
+        size = sum(len(page) for page in pages)
+        renderer = mistune.HTMLRenderer(escape=False)
+
+        pre_processed = [cf_pre_process(page) for page in pages]
+        parsed = [ToDocBlock.parse_md2docblock(page, ToDocBlock.ONE_NOTE_MODE) for page in pre_processed]
+        rendered = [FromDocBlock.render_docBlock(block_list, id_list, renderer)[0] for block_list, id_list in parsed]
+        assert all(rendered)
+
+        stages = {
+            "cf_pre_process": (cf_pre_process, pages),
+            "parse_md2docblock": (lambda page: ToDocBlock.parse_md2docblock(page, ToDocBlock.ONE_NOTE_MODE), pre_processed),
+            "render_docBlock": (lambda page: FromDocBlock.render_docBlock(*page, renderer), parsed),
+            "cf_post_process": (cf_post_process, rendered),
+        }
+        for stage, (func, items) in stages.items():
+            self.results[f"{name}/{stage}"] = measure(func, items, size)
+
+    def test_small_pages(self):
+        self.run_corpus("small_pages", small_pages(scaled(200)))
+
+    def test_huge_table(self):
+        self.run_corpus("huge_table", [huge_table(scaled(500))])
+
+    def test_deep_lists(self):
+        self.run_corpus("deep_lists", [deep_lists(scaled(50))])
+
+    def test_image_page(self):
+        self.run_corpus("image_page", [image_page(scaled(100))])
+
+    def test_mixed_page(self):
+        self.run_corpus("mixed_page", [TEST_MD * scaled(5)])
+
+    def test_notion_page(self):
+        pages = [notion_page(scaled(200))]
+        size = sum(len(json.dumps(page)) for page in pages)
+        self.results["notion_page/page2md"] = measure(lambda page: JsonToMd({"Name": "Benchmark"}).page2md(page), pages, size)
+        with Path(os.devnull).open("w", encoding="utf-8") as f:
+            self.results["notion_page/write_page"] = measure(lambda page: JsonToMd({"Name": "Benchmark"}).write_page(page, f), pages, size)
+
+    @classmethod
+    def tearDownClass(cls):
+        if not cls.results:
+            return
+        print(f"\n{'benchmark':<40}{'items/s':>12}{'MB/s':>10}{'peak MB':>10}")
+        for name, result in sorted(cls.results.items()):
+            print(f"{name:<40}{result['items_per_s']:>12.1f}{result['mb_per_s']:>10.2f}{result['peak_mb']:>10.2f}")
+
+        if not BENCHMARK_BASELINE:
+            return
+        baseline_path = Path(BENCHMARK_BASELINE)
+        if not baseline_path.exists():
+            baseline_path.write_text(json.dumps(cls.results, indent=2))
+            return
+        baseline = json.loads(baseline_path.read_text())
+        regressions = [
+            f"{name}: {result['seconds'] * 1000:.1f} ms, baseline {baseline[name]['seconds'] * 1000:.1f} ms"
+            for name, result in cls.results.items()
+            if name in baseline and result["seconds"] > baseline[name]["seconds"] * BENCHMARK_TOLERANCE + NOISE_FLOOR
+        ]
+        if regressions:
+            raise AssertionError("Slower than the baseline:\n" + "\n".join(regressions))
@@ -1,5 +1,7 @@
 import logging
 import os
+import random
+import time
 import unittest
 from pathlib import Path
 
@@ -31,6 +33,91 @@ class TestCFAdapter(unittest.TestCase):
 
         assert cf.html_pptx_link_2_cf_pptx(test_str)
 
+    def test_cf_post_process_links(self):
+        test_str = """<p><a href="agenda.pptx">Agenda</a> <a href="notes.txt">Notes</a> <a href="https://example.com">Site</a></p>"""
+
+        result = cf.cf_post_process(test_str)
+        assert """<ac:structured-macro ac:name="viewppt">""" in result
+        assert """<ri:attachment ri:filename="agenda.pptx" />""" in result
+        assert """<a href="notes.txt">Notes</a>""" in result
+        assert """<a href="https://example.com">Site</a>""" in result
+        assert result.endswith("""<p><ac:structured-macro ac:name="attachments" /></p>""")
+
+        result = cf.cf_post_process(test_str, lambda filename, text: f"[{filename}|{text}]")
+        assert "[notes.txt|Notes]" in result
+        assert """<ac:structured-macro ac:name="viewppt">""" in result
+
+    def test_cf_post_process_single_pass(self):
+        def separate_passes(html_string, misc_link=None):
+            html_string = cf.html_image_2_cf_image(html_string)
+            html_string = cf.html_attachment_links_2_cf(html_string, misc_link)
+            return cf.add_attachments_macro(html_string)
+
+        def misc_link(filename, text):
+            return f"[{filename}|{text}]"
+
+        rand = random.Random(0)  # noqa: S311
+        parts = [
+            """<p><img src="resources/abc.png" alt="pic" /></p>\n""",
+            """<p><a href="deck.pptx">Deck</a> <a href="sheet.xlsx">Sheet</a> <a href="report.pdf">Report</a></p>\n""",
+            """<p><a href="notes.txt">Notes</a> and <a href="https://example.com">a site</a></p>\n""",
+            """<a href="paper.pdf"><img src="resources/cover.png" alt="" /></a>\n""",
+        ] + ["""<p>Plain <em>text</em> paragraph with some <strong>more</strong> words in it.</p>\n"""] * 20
+        page = "".join(rand.choices(parts, k=20000))
+
+        assert cf.cf_post_process(page, misc_link) == separate_passes(page, misc_link)
+
+        tokens = ["""<img src="a/b.png" alt="x" />""", """<a href="f.pdf">""", """<a href="n.txt">""", "</a>", "text", "\n", "<p>", "</p>"]
+        for _ in range(2000):
+            html_string = "".join(rand.choices(tokens, k=rand.randint(0, 30)))
+            assert cf.cf_post_process(html_string, misc_link) == separate_passes(html_string, misc_link)
+
+    def test_space_out_tables(self):
+        test_str = "text\n| a | b |\n|---|:-:|\n| 1 | 2 |\nafter\n<p><table><tr></tr></table></p>"
+        result = cf.space_out_tables(test_str)
+        assert result == "text\n\n\n| a | b |\n|---|:-:|\n| 1 | 2 |\n\n\nafter\n<p>\n\n<table><tr></tr></table>\n\n</p>"
+
+        conjoined = "|a|b|\n|---|---|\n|1|2|\n|c|d|\n|---|---|\n|3|4|"
+        result = cf.space_out_tables(conjoined)
+        assert "|1|2|\n\n\n" in result
+        assert "\n\n|c|d|\n|---|---|\n|3|4|\n\n" in result
+
+        not_a_table = "| a | b |\n| 1 | 2 |\n|-|x|\n<table>"
+        assert cf.space_out_tables(not_a_table) == not_a_table
+
+    def test_space_out_tables_adversarial(self):
+        # Inputs that made the old regex based table detection backtrack for minutes
+        adversarial = {
+            "long_pipe_row": lambda n: "|" * n + "\n|---|\n|a|",
+            "unclosed_html_tables": lambda n: "<table>" * n,
+            "delimiters_only": lambda n: "|a|\n" + "|---|\n" * (n // 5),
+            "conjoined": lambda n: ("|a|b|\n|---|---|\n" + "|x|y|\n" * 50) * (n // 250),
+            "rows_without_delimiter": lambda n: "| a | b |\n" * (n // 5),
+        }
+
+        def best_time(markdown: str) -> float:
+            times = []
+            for _ in range(3):
+                start = time.perf_counter()
+                cf.space_out_tables(markdown)
+                times.append(time.perf_counter() - start)
+            return min(times)
+
+        # Linear time, so 4 times the input takes about 4 times as long. Quadratic would take 16 times as long
+        for name, make in adversarial.items():
+            small, large = make(25000), make(100000)
+            ratio = best_time(large) / best_time(small)
+            assert ratio < 10, f"{name} took {ratio:.1f} times as long for 4 times the input"
+            assert cf.space_out_tables(large).replace("\n", "") == large.replace("\n", "")
+
+        # Only blank lines are ever added, whatever the input looks like
+        rand = random.Random(0)  # noqa: S311
+        alphabet = ["|", "|", "-", "---", ":", " ", "a", "\n", "\n", "<table>", "</table>"]
+        for _ in range(500):
+            markdown = "".join(rand.choices(alphabet, k=rand.randint(0, 200)))
+            result = cf.space_out_tables(markdown)
+            assert result.replace("\n", "") == markdown.replace("\n", "")
+
     def _test_debug_tree(self):
         id = "906360785"
         mm = MongoManager(MONGO_URI, CONFLUENCE_URL, CONFLUENCE_SPACE_KEY, CONFLUENCE_UNAME, CONFLUENCE_TOKEN, "TEST_2", "TEST_2_Grid")
@@ -38,4 +125,4 @@ class TestCFAdapter(unittest.TestCase):
 
     def test_dumb_thing(self):
         cm = ConfluenceManager(CONFLUENCE_URL, CONFLUENCE_SPACE_KEY, CONFLUENCE_UNAME, CONFLUENCE_TOKEN)
-        print(cm.clean_space("SERGEANT"))
+        print(cm.clean_space("SERGEANT", dry_run=True))
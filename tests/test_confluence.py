@@ -1,7 +1,16 @@
+import io
 import os
 import unittest
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import pytest
+from requests import Response
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ChunkedEncodingError
 
 from databasetools.adapters.confluence.confluence import ConfluenceManager
+from databasetools.utils.rate_limit import CircuitOpenError
 
 TEST_MD = """
 
@@ -132,3 +141,90 @@ class TestConfluence(unittest.TestCase):
     def test_ty(self):
         parent_id = self.con_man.get_confluence_page_id("Test Page")
         self.con_man.remove_pages_from_parent(parent_id)
+
+
+def make_response(status_code: int, headers=None) -> Response:
+    response = Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    response.raw = io.BytesIO(b"{}")
+    return response
+
+
+class TestConfluenceSession(unittest.TestCase):
+    def setUp(self):
+        self.con_man = ConfluenceManager("https://confluence.test", "KEY", "user", "token", retries=2, failure_threshold=3)
+        self.session = self.con_man.confluence_client.session
+
+    def test_retry_after(self):
+        responses = [make_response(429, {"Retry-After": "0.1"}), make_response(200)]
+        with patch.object(HTTPAdapter, "send", side_effect=responses) as send:
+            response = self.session.get("https://confluence.test/rest/api/content/123/child/page")
+        assert response.status_code == 200
+        assert send.call_count == 2
+        assert self.con_man.limiter.throttle_time >= 0.09
+
+        stats = self.con_man.request_stats["GET /rest/api/content/{id}/child/page"]
+        assert stats["requests"] == 1
+        assert stats["retries"] == 1
+        assert stats["errors"] == 0
+
+    def test_circuit_breaker(self):
+        self.con_man.breaker.reset_timeout = 60
+        with patch.object(HTTPAdapter, "send", side_effect=lambda *args, **kwargs: make_response(502)) as send, patch("time.sleep"):
+            response = self.session.get("https://confluence.test/rest/api/space")
+            assert response.status_code == 502
+            assert send.call_count == 3
+            with pytest.raises(CircuitOpenError):
+                self.session.get("https://confluence.test/rest/api/space")
+            assert send.call_count == 3
+        assert self.con_man.request_stats["GET /rest/api/space"]["errors"] == 1
+
+    def test_circuit_breaker_unexpected_error(self):
+        breaker = self.con_man.breaker
+        breaker.reset_timeout = 0
+        with patch.object(HTTPAdapter, "send", side_effect=lambda *args, **kwargs: make_response(502)), patch("time.sleep"):
+            self.session.get("https://confluence.test/rest/api/space")
+        assert breaker.state == breaker.OPEN
+
+        # The trial request of the half open breaker fails with an error that is not retried
+        with patch.object(HTTPAdapter, "send", side_effect=ChunkedEncodingError("truncated")), pytest.raises(ChunkedEncodingError):
+            self.session.get("https://confluence.test/rest/api/space")
+        assert breaker.state == breaker.OPEN
+        with patch.object(HTTPAdapter, "send", side_effect=lambda *args, **kwargs: make_response(200)):
+            assert self.session.get("https://confluence.test/rest/api/space").status_code == 200
+        assert breaker.state == breaker.CLOSED
+
+
+class TestCleanSpace(unittest.TestCase):
+    def setUp(self):
+        self.con_man = ConfluenceManager("https://confluence.test", "KEY", "user", "token")
+        self.client = MagicMock()
+        self.con_man.confluence_client = self.client
+        self.client.get_page_by_title.return_value = {"id": "1"}
+        pages = [{"content": {"id": str(i)}} for i in range(2, 502)]
+
+        def cql(query, start=0, limit=25):
+            assert query == "ancestor=1 and type=page"
+            results = pages[start : start + limit]
+            links = {"next": "..."} if start + limit < len(pages) else {}
+            return {"results": results, "totalSize": len(pages), "_links": links}
+
+        self.client.cql.side_effect = cql
+
+    def test_dry_run(self):
+        page_ids = self.con_man.clean_space("Test Page", dry_run=True)
+        assert page_ids == [str(i) for i in range(2, 502)]
+        assert self.client.cql.call_count == 3
+        self.client.remove_page.assert_not_called()
+
+    def test_clean_space(self):
+        page_ids = self.con_man.clean_space(["Test Page"])
+        assert len(page_ids) == 500
+        deleted = {call.args[0] for call in self.client.remove_page.call_args_list}
+        assert deleted == set(page_ids)
+        assert "1" not in deleted
+
+        self.client.get_page_by_title.return_value = None
+        with pytest.raises(KeyError):
+            self.con_man.clean_space("Missing Page")
@@ -1,11 +1,23 @@
+import sys
 import unittest
 import unittest.test
+from unittest.mock import patch
 
 import mistune
+import mongomock
+import pytest
+from mistune.core import BlockState
+from mistune.plugins.table import table
 
+from databasetools.models.docblock import DocBlockElement
 from databasetools.models.docblock import DocBlockElementType
+from databasetools.models.docblock import DocBlockForest
+from databasetools.utils.docBlock.docBlock_utils import DocBlockBuilder
 from databasetools.utils.docBlock.docBlock_utils import FromDocBlock
+from databasetools.utils.docBlock.docBlock_utils import MdRenderer
 from databasetools.utils.docBlock.docBlock_utils import ToDocBlock
+from databasetools.utils.docBlock.docBlock_utils import allocate_object_ids
+from databasetools.utils.docBlock.render_cache import RenderCache
 
 TEST_MD = """
 
@@ -143,6 +155,30 @@ class TestDocBlock2Md(unittest.TestCase):
         html_answer = "\n".join(html_answer.split("\n")[0:-2])
         assert html_answer == truncated_result
 
+    def test_converter_pool(self):
+        assert FromDocBlock.get_converter() is FromDocBlock.get_converter()
+        assert FromDocBlock.get_converter(MdRenderer) is FromDocBlock.get_converter(MdRenderer)
+        renderer = mistune.HTMLRenderer(escape=True)
+        assert FromDocBlock.get_converter(renderer) is FromDocBlock.get_converter(renderer)
+        assert FromDocBlock.get_converter(renderer) is not FromDocBlock.get_converter()
+        assert FromDocBlock.get_converter(mistune.HTMLRenderer(escape=True)).renderer is not renderer
+
+        block_list, id_list = ToDocBlock.parse_md2docblock(TEST_MD)
+        md_result, _ = FromDocBlock.render_docBlock(block_list, id_list, MdRenderer())
+        assert md_result == FromDocBlock.render_docBlock(block_list, id_list, MdRenderer)[0]
+
+        def render_unpooled(block_list, id_list):
+            parser = FromDocBlock(block_list)
+            block_state = BlockState()
+            for id in id_list:
+                block_state.append_token(parser.make_token(parser.get_block(id)))
+            converter = mistune.Markdown(renderer=mistune.HTMLRenderer(escape=False), plugins=[table])
+            converter.block.list_rules += ["table"]
+            return converter.render_state(block_state)
+
+        pages = [ToDocBlock.parse_md2docblock(f"# Page {i}\n\nSome **text** on page {i}.") for i in range(10)]
+        assert [render_unpooled(*page) for page in pages] == [FromDocBlock.render_docBlock(*page)[0] for page in pages]
+
 
 class TestMd2DocBlock(unittest.TestCase):
     def test_md2docblock(self):
@@ -153,3 +189,244 @@ class TestMd2DocBlock(unittest.TestCase):
         type_list = [block.type for block in block_list]
 
         assert DocBlockElementType.RESOURCE_REFERENCE in type_list
+
+    def test_deep_nesting(self):
+        depth = sys.getrecursionlimit() * 3
+        token = {"type": "text", "raw": "deep"}
+        for _ in range(depth):
+            token = {"type": "emphasis", "children": [token, {"type": "text", "raw": "side"}]}
+        token = {"type": "paragraph", "children": [token]}
+
+        parser = ToDocBlock()
+        root_id = parser.make_block(token)
+        block_list = parser.get_block_list()
+        assert len(block_list) == 2 * depth + 2
+        assert block_list[0].block_content == "deep"
+        assert block_list[-1].id == root_id
+
+        seen = set()
+        for block in block_list:  # Every block comes after its children
+            assert all(child_id in seen for child_id in block.children)
+            seen.add(block.id)
+
+        renderer = FromDocBlock(block_list)
+        result = renderer.make_token(renderer.get_block(root_id))
+        for _ in range(depth + 1):
+            assert result["children"][-1] in ({"type": "text", "raw": "side"}, result["children"][0])
+            result = result["children"][0]
+        assert result == {"type": "text", "raw": "deep"}
+
+    def test_children_on_demand(self):
+        # Children a parse function ignores are never errors and are not kept, like when they were only made when asked for
+        parser = ToDocBlock()
+        parser.override_func_list(DocBlockElementType.PARAGRAPH, lambda token: DocBlockElement(type=DocBlockElementType.PARAGRAPH))
+        unknown = {"type": "no_such_type"}
+        root_id = parser.make_block({"type": "paragraph", "children": [unknown, {"type": "emphasis", "children": [{"type": "text", "raw": "x"}]}]})
+        assert [block.id for block in parser.get_block_list()] == [root_id]
+        assert parser._ToDocBlock__block_cache == {}
+
+        with pytest.raises(Exception, match="While parsing") as info:
+            ToDocBlock().make_block({"type": "paragraph", "children": [unknown]})
+        assert isinstance(info.value.__cause__, KeyError)
+
+        # Asking twice gives the same children, added to the block list once
+        def paragraph(token):
+            parser.make_children_blocks(token)
+            return DocBlockElement(type=DocBlockElementType.PARAGRAPH, children=parser.make_children_blocks(token))
+
+        parser = ToDocBlock()
+        parser.override_func_list(DocBlockElementType.PARAGRAPH, paragraph)
+        parser.make_block({"type": "paragraph", "children": [{"type": "text", "raw": "x"}]})
+        text, root = parser.get_block_list()
+        assert (text.type, root.children) == (DocBlockElementType.TEXT, [text.id])
+
+        missing = DocBlockElement(type=DocBlockElementType.PARAGRAPH, children=[text.id])
+        renderer = FromDocBlock([missing])
+        renderer.override_func_list(DocBlockElementType.PARAGRAPH, lambda block: {"type": "paragraph", "children": []})
+        assert renderer.make_token(renderer.get_block(missing.id)) == {"type": "paragraph", "children": []}
+
+        def paragraph_token(block):
+            renderer.make_children_token(block)
+            return {"type": "paragraph", "children": renderer.make_children_token(block)}
+
+        renderer = FromDocBlock([text, root])
+        renderer.override_func_list(DocBlockElementType.PARAGRAPH, paragraph_token)
+        assert renderer.make_token(renderer.get_block(root.id)) == {"type": "paragraph", "children": [{"type": "text", "raw": "x"}]}
+
+    def test_iter_md2docblock(self):
+        md = TEST_MD * 5
+        block_list, id_list = ToDocBlock.parse_md2docblock(md, ToDocBlock.ONE_NOTE_MODE)
+
+        batches = list(ToDocBlock.iter_md2docblock(md, ToDocBlock.ONE_NOTE_MODE, batch_size=50))
+        assert len(batches) > 5
+        seen = set()
+        for batch, root_ids in batches:
+            assert len(batch) <= 50
+            positions = [i for i, block in enumerate(batch) if block.id in root_ids]
+            assert len(positions) == len(root_ids)
+            for block in batch:  # Children were in this batch or an earlier one
+                assert all(child_id in seen for child_id in block.children)
+                seen.add(block.id)
+
+        # One table bigger than a batch is split over several
+        table = "| a | b |\n|---|---|\n" + "| x | *y* |\n" * 100
+        table_batches = list(ToDocBlock.iter_md2docblock(table, batch_size=50))
+        assert len(table_batches) > 5
+        assert all(len(batch) <= 50 for batch, _ in table_batches)
+        assert [len(root_ids) for _, root_ids in table_batches] == [0] * (len(table_batches) - 1) + [1]
+        assert table_batches[-1][0][-1].id == table_batches[-1][1][0]
+
+        streamed_blocks = [block for batch, _ in batches for block in batch]
+        streamed_ids = [root_id for _, root_ids in batches for root_id in root_ids]
+        assert [(b.type, b.block_content, b.block_attr) for b in streamed_blocks] == [(b.type, b.block_content, b.block_attr) for b in block_list]
+        assert FromDocBlock.render_docBlock(streamed_blocks, streamed_ids) == FromDocBlock.render_docBlock(block_list, id_list)
+
+    def test_dispatch_table(self):
+        assert ToDocBlock(ToDocBlock.ONE_NOTE_MODE)._dispatch is ToDocBlock(ToDocBlock.ONE_NOTE_MODE)._dispatch
+        assert ToDocBlock()._dispatch is not ToDocBlock(ToDocBlock.ONE_NOTE_MODE)._dispatch
+
+        parser = ToDocBlock()
+        parser.override_func_list(DocBlockElementType.CODESPAN, lambda token: parser._text(token))
+        assert parser.mode == ToDocBlock.USER_DEFINED_MODE
+        parser.make_block({"type": "codespan", "raw": "x"})
+        assert parser.get_block_list()[0].type == DocBlockElementType.TEXT
+        assert ToDocBlock().func_list[DocBlockElementType.CODESPAN].__func__ is ToDocBlock._codespan  # Other instances are untouched
+
+        class UpperDocBlock(ToDocBlock):
+            def _text(self, token):
+                block = super()._text(token)
+                block.block_content = block.block_content.upper()
+                return block
+
+        block_list, _ = UpperDocBlock.parse_md2docblock("Some *text*")
+        assert [block.block_content for block in block_list if block.block_content] == ["SOME ", "TEXT"]
+
+        block_list, id_list = ToDocBlock.parse_md2docblock("Some *text*")
+        renderer = FromDocBlock(block_list)
+        renderer.override_func_list(DocBlockElementType.EMPHASIS, lambda block: renderer._strong(block))
+        token = renderer.make_token(renderer.get_block(id_list[0]))
+        assert token["children"][1]["type"] == "strong"
+        renderer = FromDocBlock(block_list)
+        renderer.func_list = {**renderer.func_list, DocBlockElementType.EMPHASIS: renderer._strong}
+        assert renderer.make_token(renderer.get_block(id_list[0]))["children"][1]["type"] == "strong"
+
+    def test_func_list_assignment(self):
+        block_list, id_list = ToDocBlock.parse_md2docblock("Some *text*")
+
+        renderer = FromDocBlock(block_list)
+        renderer.func_list[DocBlockElementType.EMPHASIS] = renderer._strong
+        assert renderer.func_list[DocBlockElementType.EMPHASIS] == renderer._strong
+        assert renderer.make_token(renderer.get_block(id_list[0]))["children"][1]["type"] == "strong"
+        del renderer.func_list[DocBlockElementType.EMPHASIS]
+        assert renderer.func_list[DocBlockElementType.EMPHASIS].__func__ is FromDocBlock._emphasis
+        assert set(renderer.func_list) == set(FromDocBlock.FUNC_NAMES)
+        assert FromDocBlock(block_list).func_list[DocBlockElementType.EMPHASIS].__func__ is FromDocBlock._emphasis  # Other instances are untouched
+
+        parser = ToDocBlock()
+        parser.func_list[DocBlockElementType.EMPHASIS] = parser._strong
+        assert parser.mode == ToDocBlock.USER_DEFINED_MODE
+        for token in parser.md_to_token("Some *text*"):
+            parser.make_block(token)
+        assert DocBlockElementType.STRONG in [block.type for block in parser.get_block_list()]
+        assert DocBlockElementType.EMPHASIS not in [block.type for block in parser.get_block_list()]
+        assert ToDocBlock().func_list[DocBlockElementType.EMPHASIS].__func__ is ToDocBlock._emphasis  # Other instances are untouched
+
+    def test_block_builder(self):
+        ids = allocate_object_ids(5000)
+        assert len(set(ids)) == 5000
+        assert ids == sorted(ids)
+        with pytest.raises(ValueError, match="at most"):
+            allocate_object_ids(2**24 + 1)
+
+        builder = DocBlockBuilder()
+        block = builder.build(DocBlockElementType.TEXT, "text")
+        assert block == DocBlockElement(id=block.id, created_at=builder.created_at, type=DocBlockElementType.TEXT, block_content="text")
+        assert builder.created_at.tzinfo is None  # Naive like the default of DocBlockElement
+
+        block_list, _ = ToDocBlock.parse_md2docblock(TEST_MD * 3, ToDocBlock.ONE_NOTE_MODE)
+        assert len({block.created_at for block in block_list}) == 1
+        assert len({block.id for block in block_list}) == len(block_list)
+        block_list[0].tags.append("x")
+        assert block_list[1].tags == []
+
+
+class TestDocBlockForest(unittest.TestCase):
+    def test_forest(self):
+        block_list, id_list = ToDocBlock.parse_md2docblock(TEST_MD, ToDocBlock.ONE_NOTE_MODE)
+        forest = DocBlockForest.from_blocks(block_list, id_list)
+        assert len(forest.block_ids) == len(block_list)
+        assert len(forest.child_offsets) == len(block_list) + 1
+        assert [forest.block_ids[i] for i in forest.root_indexes] == id_list
+
+        forest = DocBlockForest(**forest.model_dump())  # Same as a round trip through mongo
+        new_block_list, new_id_list = forest.to_blocks()
+        assert new_id_list == id_list
+        for block, new_block in zip(block_list, new_block_list, strict=True):
+            assert (block.id, block.type, block.block_content, block.block_attr, block.children) == (
+                new_block.id,
+                new_block.type,
+                new_block.block_content,
+                new_block.block_attr,
+                new_block.children,
+            )
+
+        # Parsing into and rendering from a forest make no DocBlockElements
+        with patch.object(DocBlockElement, "__init__", side_effect=AssertionError("made a DocBlockElement")):
+            forest = ToDocBlock.parse_md2forest(TEST_MD, ToDocBlock.ONE_NOTE_MODE)
+            rendered = FromDocBlock.render_forest(forest, resource_prefix="hello")
+        assert rendered == FromDocBlock.render_docBlock(block_list, id_list, resource_prefix="hello")
+        packed = DocBlockForest.from_blocks(block_list, id_list)
+        for name in ("block_types", "block_contents", "block_attrs", "child_offsets", "child_indexes", "root_indexes"):
+            assert getattr(forest, name) == getattr(packed, name), name
+
+
+class TestRenderCache(unittest.TestCase):
+    def test_render_cache(self):
+        cache = RenderCache()
+        block_list, id_list = ToDocBlock.parse_md2docblock(TEST_MD, ToDocBlock.ONE_NOTE_MODE)
+        expected = FromDocBlock.render_docBlock(block_list, id_list, resource_prefix="hello")
+        assert FromDocBlock.render_docBlock(block_list, id_list, resource_prefix="hello", cache=cache, per_subtree=True) == expected
+        assert 0 < cache.hits < len(id_list)  # Repeated top level blocks, like blank lines, are rendered once
+        hits = cache.hits
+        assert FromDocBlock.render_docBlock(block_list, id_list, resource_prefix="hello", cache=cache, per_subtree=True) == expected
+        assert cache.hits == hits + 1
+
+        # Same content with new ids hits the page, and pages sharing top level blocks reuse them
+        block_list, id_list = ToDocBlock.parse_md2docblock(TEST_MD, ToDocBlock.ONE_NOTE_MODE)
+        assert FromDocBlock.render_docBlock(block_list, id_list, resource_prefix="hello", cache=cache) == expected
+        assert cache.hits == hits + 2
+        block_list, id_list = ToDocBlock.parse_md2docblock("# A new heading\n\n" + TEST_MD, ToDocBlock.ONE_NOTE_MODE)
+        misses = cache.misses
+        result = FromDocBlock.render_docBlock(block_list, id_list, resource_prefix="hello", cache=cache, per_subtree=True)
+        assert result == FromDocBlock.render_docBlock(block_list, id_list, resource_prefix="hello")
+        assert cache.misses == misses + 2  # The page and its new heading
+
+        # Different settings are different entries
+        assert FromDocBlock.render_docBlock(block_list, id_list, resource_prefix="other", cache=cache)[0] != result[0]
+        md_result = FromDocBlock.render_docBlock(block_list, id_list, MdRenderer, cache=cache, per_subtree=True)
+        assert md_result == FromDocBlock.render_docBlock(block_list, id_list, MdRenderer)
+
+    def test_lru(self):
+        cache = RenderCache(max_size=10)
+        cache.put("a", "1234", [])
+        cache.put("b", "1234", [])
+        assert cache.get("a") == ("1234", [])
+        cache.put("c", "1234", [])  # Evicts b, the least recently used
+        assert cache.get("b") is None
+        assert len(cache) == 2
+        cache.put("d", "a" * 11, [])
+        assert cache.get("d") is None
+
+        collection = mongomock.MongoClient().db.render_cache
+        cache = RenderCache(max_size=10, collection=collection)
+        cache.put("d", "a" * 11, ["res.png"])
+        assert RenderCache(collection=collection).get("d") == ("a" * 11, ["res.png"])
+
+    def test_render_cache_hits(self):
+        pages = [ToDocBlock.parse_md2docblock(TEST_MD) for _ in range(5)]
+        cache = RenderCache()
+        expected = FromDocBlock.render_docBlock(*pages[0], cache=cache)
+
+        for page in pages:
+            assert FromDocBlock.render_docBlock(*page, cache=cache) == expected
+        assert cache.hits == len(pages)
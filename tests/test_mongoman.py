@@ -1,13 +1,22 @@
 import os
+import sys
 import traceback
 import unittest
 from pathlib import Path
 from typing import List
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import mongomock
+import mongomock.gridfs
+from bson import ObjectId
 
 from databasetools.managers.mongo_manager import MongoManager
 from databasetools.models.docblock import DocBlockElement
+from databasetools.models.docblock import DocBlockElementType
 from databasetools.models.docblock import PageElement
 from databasetools.models.docblock import PageTypes
+from databasetools.utils.docBlock.docBlock_utils import ToDocBlock
 from databasetools.utils.log import LoggerArgs
 from databasetools.utils.log import init_logger
 
@@ -27,6 +36,7 @@ CONFLUENCE_TOKEN = os.getenv("CONFLUENCE_API_KEY")
 RESTART = True
 
 init_logger(LoggerArgs(True))
+mongomock.gridfs.enable_gridfs_integration()
 
 
 class TestMongMan(unittest.TestCase):
@@ -105,6 +115,168 @@ class TestMongMan(unittest.TestCase):
         assert len(mongo_man._grids) == 3
         assert len(mongo_man._collections) == 4
 
+    @patch("databasetools.managers.mongo_manager.ConfluenceManager")
+    @patch("databasetools.managers.mongo_manager.MongoClient", new=mongomock.MongoClient)
+    def test_construct_page_single_write(self, mock_con_man):
+        con_ad: MagicMock = mock_con_man.return_value
+        con_ad.make_confluence_page.return_value = {"id": "42", "title": "Page", "space": {"key": "KEY"}}
+
+        mm = MongoManager("mongodb://localhost", "https://confluence.test", "KEY", "user", "token")
+        block_list, id_list = ToDocBlock.parse_md2docblock("# Title\n\nSome *text* and a [link](https://example.com)\n")
+        for block in block_list:
+            mm.upload_to_col(mm.active_db_col, block)
+        page = PageElement(type=PageTypes.PAGE, name="Page", children=id_list)
+
+        page = mm._construct_page(page, "1")
+
+        con_ad.make_confluence_page.assert_called_once()
+        con_ad.update_confluence_page.assert_not_called()
+        content = con_ad.make_confluence_page.call_args.args[1]
+        assert "<h1>Title</h1>" in content
+        assert MongoManager.CONSTRUCTION_MESSAGE not in content
+        assert page.confluence_page_id == "42"
+        assert page.confluence_space_key == "KEY"
+
+        con_ad.reset_mock()
+        mm._construct_page(page, "1", single_write=False)
+        assert con_ad.make_confluence_page.call_args.args[1] == MongoManager.CONSTRUCTION_MESSAGE
+        con_ad.update_confluence_page.assert_called_once()
+
+    @patch("databasetools.managers.mongo_manager.ConfluenceManager")
+    @patch("databasetools.managers.mongo_manager.MongoClient", new=mongomock.MongoClient)
+    def test_construct_page_single_write_attachments(self, mock_con_man):
+        con_ad: MagicMock = mock_con_man.return_value
+        con_ad.make_confluence_page.return_value = {"id": "42", "title": "Page", "space": {"key": "KEY"}}
+        con_ad.add_confluence_attachments.side_effect = [{"type": "attachment", "id": "7"}, {"results": [{"type": "attachment", "id": "8"}]}]
+
+        mm = MongoManager("mongodb://localhost", "https://confluence.test", "KEY", "user", "token")
+        mm.upload_to_grid(mm.active_grid, b"png", name="image.png")
+        mm.upload_to_grid(mm.active_grid, b"notes", name="notes.txt")
+        md = "# Title\n\n![An image](resources/image.png)\n\n[Notes](resources/notes.txt)\n"
+        block_list, id_list = ToDocBlock.parse_md2docblock(md, ToDocBlock.ONE_NOTE_MODE)
+        for block in block_list:
+            mm.upload_to_col(mm.active_db_col, block)
+        page = PageElement(type=PageTypes.PAGE, name="Page", children=id_list)
+
+        page = mm._construct_page(page, "1")
+
+        con_ad.make_confluence_page.assert_called_once()
+        con_ad.update_confluence_page.assert_not_called()
+        assert con_ad.add_confluence_attachments.call_count == 2
+        content = con_ad.make_confluence_page.call_args.args[1]
+        assert """<ri:attachment ri:filename="image.png" />""" in content
+        assert """<ac:link><ri:attachment ri:filename="notes.txt" /><ac:link-body>Notes</ac:link-body></ac:link>""" in content
+        assert page.confluence_page_id == "42"
+        assert mm.find_attachment_ids(["image.png", "notes.txt"]) == {"image.png": "7", "notes.txt": "8"}
+
+    @patch("databasetools.managers.mongo_manager.ConfluenceManager")
+    @patch("databasetools.managers.mongo_manager.MongoClient", new=mongomock.MongoClient)
+    def test_format_final_html(self, mock_con_man):
+        mm = MongoManager("mongodb://localhost", "https://confluence.test", "MY KEY", "user", "token")
+        mm.upload_to_grid(mm.active_grid, b"notes", name="notes.txt", confluence_id="7")
+
+        html = """<p><a href="notes.txt">Notes</a><a href="deck.pptx">Deck</a></p>"""
+        result = mm.format_final_html(html, "A Page", "42")
+        assert """<a href="https://confluence.test/display/MY+KEY/A+Page?preview=/42/7">Notes</a>""" in result
+        assert """<ri:attachment ri:filename="deck.pptx" />""" in result
+
+        result = mm.format_final_html(html, "A Page", "42", {"notes.txt": "8"})
+        assert "?preview=/42/8" in result
+
+    @patch("databasetools.managers.mongo_manager.ConfluenceManager")
+    @patch("databasetools.managers.mongo_manager.MongoClient", new=mongomock.MongoClient)
+    def test_make_page_tree(self, mock_con_man):
+        con_ad: MagicMock = mock_con_man.return_value
+        page_ids = iter(range(100, 200))
+
+        def make_directory(title, parent_id=None):
+            return {"id": str(next(page_ids)), "title": title, "space": {"key": "KEY"}, "parent": parent_id}
+
+        con_ad.make_confluence_page_directory.side_effect = make_directory
+
+        mm = MongoManager("mongodb://localhost", "https://confluence.test", "KEY", "user", "token")
+        export_id = ObjectId()
+        leaves = [PageElement(type=PageTypes.FOLDER, name="Notes", export_id=export_id) for _ in range(3)]
+        middles = [PageElement(type=PageTypes.FOLDER, name=f"Section {i}", export_id=export_id, sub_folders=[leaves[i].id]) for i in range(3)]
+        root = PageElement(type=PageTypes.FOLDER, name="Root", export_id=export_id, sub_folders=[m.id for m in middles])
+        for folder in [root, *middles, *leaves]:
+            mm.upload_to_col(mm.active_page_col, folder)
+
+        mm._make_page_tree(root, "1")
+
+        calls = con_ad.make_confluence_page_directory.call_args_list
+        assert len(calls) == 7
+        assert calls[0].args == ("Root", "1")
+        stored = {folder.id: folder for folder in mm.find_in_col(mm.active_page_col, export_id=export_id)}
+        assert all(folder.confluence_page_id for folder in stored.values())
+        parents = {call.args[0]: call.args[1] for call in calls[1:4]}
+        assert set(parents.values()) == {stored[root.id].confluence_page_id}
+        for middle, leaf in zip(middles, leaves):
+            assert (leaf.name, stored[middle.id].confluence_page_id) in [call.args for call in calls[4:]]
+
+        con_ad.reset_mock()
+        mm._make_page_tree(stored[root.id], "1")  # Everything is already on confluence
+        con_ad.make_confluence_page_directory.assert_not_called()
+
+    @patch("databasetools.managers.mongo_manager.ConfluenceManager")
+    @patch("databasetools.managers.mongo_manager.MongoClient", new=mongomock.MongoClient)
+    def test_get_block_tree(self, mock_con_man):
+        mm = MongoManager("mongodb://localhost", "https://confluence.test", "KEY", "user", "token")
+        block_list, id_list = ToDocBlock.parse_md2docblock("# Title\n\n- one\n  - *two*\n\nSome **text**\n")
+        deep = DocBlockElement(type=DocBlockElementType.TEXT, block_content="deep")
+        chain = [deep]
+        for _ in range(sys.getrecursionlimit() + 100):
+            chain.append(DocBlockElement(type=DocBlockElementType.BLOCK_QUOTE, children=[chain[-1].id]))
+        for block in block_list + chain:
+            mm.upload_to_col(mm.active_db_col, block)
+
+        assert [block.id for block in mm._get_block_tree(id_list)] == [block.id for block in block_list]
+        assert [block.id for block in mm._get_block_tree([chain[-1].id])] == [block.id for block in chain]
+
+    @patch("databasetools.managers.mongo_manager.ConfluenceManager")
+    @patch("databasetools.managers.mongo_manager.MongoClient", new=mongomock.MongoClient)
+    def test_compact_blocks(self, mock_con_man):
+        con_ad: MagicMock = mock_con_man.return_value
+        con_ad.make_confluence_page.return_value = {"id": "42", "title": "Page", "space": {"key": "KEY"}}
+        block_list, id_list = ToDocBlock.parse_md2docblock("# Title\n\n- one\n  - *two*\n\nSome **text**\n")
+        export_id = ObjectId()
+        page = PageElement(type=PageTypes.PAGE, name="Page", children=id_list, export_id=export_id)
+        on_adapter = MagicMock(export_id=export_id)
+        on_adapter.file_page_gen.return_value = [(page, block_list, [])]
+
+        contents = []
+        for compact_blocks in (False, True):
+            mm = MongoManager("mongodb://localhost", "https://confluence.test", "KEY", "user", "token", compact_blocks=compact_blocks)
+            mm._upload_OneNote_files(on_adapter)
+            assert len(mm.find_in_col(mm.active_db_col)) == (0 if compact_blocks else len(block_list))
+            assert (MongoManager.DOC_FORESTS in mm._collections) == compact_blocks
+            if compact_blocks:
+                assert len(mm.find_in_col(MongoManager.DOC_FORESTS, page_id=page.id)) == 1
+            assert [block.id for block in mm._get_page_blocks(page)[0]] == [block.id for block in block_list]
+
+            mm._construct_page(page, "1")
+            contents.append(con_ad.make_confluence_page.call_args.args[1])
+            mm.reset_collections()
+
+        assert contents[0] == contents[1]
+        assert len(mm.find_in_col(MongoManager.DOC_FORESTS)) == 0
+
+    @patch("databasetools.managers.mongo_manager.ConfluenceManager")
+    @patch("databasetools.managers.mongo_manager.MongoClient", new=mongomock.MongoClient)
+    def test_upload_md_blocks(self, mock_con_man):
+        mm = MongoManager("mongodb://localhost", "https://confluence.test", "KEY", "user", "token")
+        md = "# Title\n\n- one\n  - *two*\n\nSome **text**\n\n" * 20
+        page = PageElement(type=PageTypes.PAGE, name="Page", export_id=ObjectId())
+
+        page = mm.upload_md_blocks(md, page, batch_size=10)
+
+        block_list, id_list = ToDocBlock.parse_md2docblock(md)
+        assert len(page.children) == len(id_list)
+        stored = mm._get_block_tree(page.children)
+        assert [(b.type, b.block_content) for b in stored] == [(b.type, b.block_content) for b in block_list]
+        assert all(block.export_id == page.export_id for block in stored)
+        mm.reset_collections()
+
     # Un-underscore this function to run a full upload.
     def _test_full_upload(self):
         mm = MongoManager(MONGO_URI, CONFLUENCE_URL, CONFLUENCE_SPACE_KEY, CONFLUENCE_UNAME, CONFLUENCE_TOKEN, "TEST_2", "TEST_2_Grid")
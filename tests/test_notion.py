@@ -2,13 +2,24 @@
 # path = exporter.export_url(url=url)
 # print(f" * Exported to {path}")
 
+import io
 import json
 import logging
 import os
+import threading
+import time
 from datetime import datetime
 from pathlib import Path
-
+from types import SimpleNamespace
+from typing import Dict
+from typing import List
+from typing import Optional
+from unittest.mock import ANY
+
+import httpx
+import pytest
 import pytz
+from notion_client.helpers import iterate_paginated_api as paginate
 from notion_objects import Checkbox
 from notion_objects import Date
 from notion_objects import MultiSelect
@@ -18,16 +29,26 @@ from notion_objects import Status
 from notion_objects import Text
 from notion_objects import TitleText
 
+from databasetools import JsonToMdConverter
 from databasetools import NotionBlock
 from databasetools import NotionClient
 from databasetools import NotionDatabase
+from databasetools import NotionDownloader
 from databasetools import NotionPage
+from databasetools.adapters.notion import notion
 from databasetools.adapters.notion import utils
+from databasetools.adapters.notion.cache import NotionCache
+from databasetools.adapters.notion.notion import BULK_PRIORITY
+from databasetools.adapters.notion.notion import LastEditedToDateTime
+from databasetools.adapters.notion.notion import NotionIO
+from databasetools.utils.rate_limit import RequestScheduler
+from databasetools.utils.rate_limit import TokenBucket
 
 NOTION_API_KEY = os.getenv("NOTION_API_KEY")
 PAGE_URL = os.getenv("PAGE_URL")
 TEST_DATABASE_ID = os.getenv("TEST_DATABASE_ID")
 PAGE_ID = os.getenv("PAGE_ID")
+FAKE_TOKEN = "offline"  # noqa: S105 Never sent anywhere, the tests replace the transport or the client
 
 # enable all logging
 
@@ -66,6 +87,330 @@ def test_client():
     assert isinstance(database, list)
 
 
+class FakeNotion:
+    """In memory stand in for the parts of notion_client.Client the adapters use. Counts calls and the most requests in flight."""
+
+    def __init__(
+        self,
+        children: Optional[Dict[str, List[dict]]] = None,
+        rows: Optional[Dict[str, List[dict]]] = None,
+        page_size: int = 2,
+        latency: float = 0.005,
+    ):
+        self.children = children or {}
+        self.rows = rows or {}
+        self.page_size = page_size
+        self.latency = latency
+        self.calls: Dict[str, int] = {}
+        self.failing: set = set()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self.blocks = SimpleNamespace(children=SimpleNamespace(list=self._list_children))
+        self.databases = SimpleNamespace(query=self._query)
+        self.pages = SimpleNamespace(retrieve=self._retrieve)
+
+    def _request(self, name: str):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.latency)
+        with self._lock:
+            self.in_flight -= 1
+
+    def _paginate(self, results: List[dict], start_cursor: Optional[str], page_size: Optional[int] = None) -> dict:
+        start = int(start_cursor or 0)
+        end = start + (page_size or self.page_size)
+        has_more = end < len(results)
+        return {"results": [dict(result) for result in results[start:end]], "has_more": has_more, "next_cursor": str(end) if has_more else None}
+
+    def _list_children(self, block_id: str, start_cursor: Optional[str] = None) -> dict:
+        self._request("blocks.children.list")
+        if block_id in self.failing:
+            raise ConnectionError(f"Failed to list {block_id}")
+        return self._paginate(self.children.get(block_id, []), start_cursor)
+
+    def _query(self, database_id: str, start_cursor: Optional[str] = None, filter: Optional[dict] = None, **kwargs) -> dict:
+        self._request("databases.query")
+        rows = self.rows[database_id]
+        if filter is not None:  # Only the last_edited_time filter of incremental syncs
+            since = datetime.fromisoformat(filter["last_edited_time"]["on_or_after"])
+            rows = [row for row in rows if datetime.fromisoformat(row["last_edited_time"]) >= since]
+        return self._paginate(rows, start_cursor, kwargs.get("page_size"))
+
+    def _retrieve(self, page_id: str) -> dict:
+        self._request("pages.retrieve")
+        return next(dict(row) for rows in self.rows.values() for row in rows if row["id"] == page_id)
+
+
+def fake_block(block_id: str, has_children: bool = False) -> dict:
+    return {
+        "object": "block",
+        "id": block_id,
+        "type": "toggle" if has_children else "paragraph",
+        "has_children": has_children,
+        "last_edited_time": "2024-01-01T00:00:00.000Z",
+    }
+
+
+def fake_tree(width: int = 4, depth: int = 3, prefix: str = "root") -> Dict[str, List[dict]]:
+    """Children of every block of a tree where the first width - 1 blocks under each parent have children of their own."""
+    children = {}
+    level = [prefix]
+    for d in range(depth):
+        next_level = []
+        for parent in level:
+            children[parent] = [fake_block(f"{parent}-{i}", d < depth - 1 and i < width - 1) for i in range(width)]
+            next_level.extend(block["id"] for block in children[parent] if block["has_children"])
+        level = next_level
+    return children
+
+
+def get_blocks_depth_first(client: NotionClient, block_id: str) -> List[dict]:
+    blocks = []
+    for child in paginate(client.client.blocks.children.list, block_id=block_id):
+        try:
+            child["children"] = get_blocks_depth_first(client, child["id"]) if child["has_children"] else []
+            blocks.append(child)
+        except ConnectionError:  # Skipped like get_blocks skips blocks it fails to list
+            continue
+    return list(client.transformer.forward(blocks))
+
+
+def test_get_blocks_concurrent():
+    client = NotionClient(token=FAKE_TOKEN, max_workers=3)
+    client.client = FakeNotion(fake_tree(width=5, depth=4))
+    expected = get_blocks_depth_first(client, "root")
+
+    client.client.max_in_flight = 0
+    blocks = client.get_blocks("root")
+    assert blocks == expected
+    assert client.client.max_in_flight == 3
+
+    client.client.failing.add("root-1-2")
+    blocks = client.get_blocks("root")
+    assert [block["id"] for block in blocks[1]["children"]] == ["root10", "root11", "root13", "root14"]
+    assert blocks == get_blocks_depth_first(client, "root")
+
+
+def fake_row(page_id: str, last_edited_time: str = "2024-01-01T00:00:00.000Z") -> dict:
+    return {
+        "object": "page",
+        "id": page_id,
+        "url": f"https://www.notion.so/{page_id}",
+        "last_edited_time": last_edited_time,
+        "parent": {"type": "database_id", "database_id": "db"},
+        "properties": {"Name": {"type": "title", "title": [{"plain_text": page_id}]}},
+    }
+
+
+def test_get_database():
+    client = NotionClient(token=FAKE_TOKEN, max_workers=3)
+    client.client = FakeNotion(rows={"db": [fake_row(f"page-{i}") for i in range(9)]})
+
+    pages = client.get_database("db")
+    assert [page["id"] for page in pages] == [f"page{i}" for i in range(9)]
+    assert client.client.calls == {"databases.query": 5}
+
+    assert client.get_database("db", refresh=True) == pages
+    assert client.client.calls == {"databases.query": 10, "pages.retrieve": 9}
+    assert client.client.max_in_flight == 3
+
+
+def test_throttled_transport():
+    assert NotionClient(token=FAKE_TOKEN).scheduler is NotionClient(token=f"{FAKE_TOKEN}-other").scheduler
+
+    page_id = "cb0163c3-7cca-4984-8345-104644b544d9"
+    responses = [
+        httpx.Response(429, headers={"Retry-After": "0.1"}, json={"object": "error", "status": 429, "code": "rate_limited", "message": ""}),
+        httpx.Response(200, json={"object": "list", "results": [fake_block("block-0")], "has_more": False, "next_cursor": None}),
+    ]
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return responses.pop(0)
+
+    scheduler = RequestScheduler(TokenBucket(rate=100, capacity=1))
+    client = NotionClient(token=FAKE_TOKEN, scheduler=scheduler, transport=httpx.MockTransport(handler))
+    blocks = client.get_blocks(page_id)
+    assert [block["id"] for block in blocks] == ["block0"]
+    assert len(requests) == 2
+    assert requests[0].headers["Authorization"] == f"Bearer {FAKE_TOKEN}"
+
+    stats = client.request_stats["GET /v1/blocks/{id}/children"]
+    assert stats["requests"] == 1
+    assert stats["retries"] == 1
+    assert stats["errors"] == 0
+    assert scheduler.snapshot()["requests"] == {BULK_PRIORITY: 2}
+    assert scheduler.limiter.throttle_time >= 0.09  # Waited out the Retry-After
+
+
+def test_notion_cache(tmp_path):
+    page_id = "cb0163c3-7cca-4984-8345-104644b544d9"
+    versions = {page_id: "2024-01-01T00:00:00.000Z"}
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(f"{request.method} {request.url.path}")
+        if request.method == "POST":
+            return httpx.Response(200, json={"object": "list", "results": [fake_row(page_id, versions[page_id])], "has_more": False})
+        if request.url.path.endswith("/children"):
+            return httpx.Response(200, json={"object": "list", "results": [fake_block("block-0")], "has_more": False, "next_cursor": None})
+        return httpx.Response(200, json=fake_row(page_id, versions[page_id]))
+
+    scheduler = RequestScheduler(TokenBucket(rate=1000))
+    cache = NotionCache(tmp_path / "cache.sqlite")
+    client = NotionClient(token=FAKE_TOKEN, scheduler=scheduler, transport=httpx.MockTransport(handler), cache=cache)
+
+    metadata = client.get_metadata(page_id)
+    assert client.get_metadata(page_id) == metadata
+    assert client.get_blocks(page_id) == client.get_blocks(page_id)
+    assert len(requests) == 2
+    assert scheduler.snapshot()["requests"] == {0: 1, BULK_PRIORITY: 1}  # Hits skip the scheduler
+
+    # A database query reporting a newer last_edited_time makes the entries of the page stale
+    query = {"path": "databases/db/query", "method": "POST"}  # What get_database sends
+    assert client.client.request(**query) == client.client.request(**query)  # Queries are cached too
+    versions[page_id] = "2024-02-01T00:00:00.000Z"
+    since = {**query, "body": {"filter": {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": "2024-01-15"}}}}
+    client.client.request(**since)  # Another body, so not a hit
+    client.client.request(**query)  # Replaying the older cached query does not undo the newer last_edited_time
+    assert client.get_metadata(page_id)["last_edited_time"] > metadata["last_edited_time"]
+    assert client.get_metadata(page_id)["last_edited_time"] > metadata["last_edited_time"]
+    assert requests[2:] == ["POST /v1/databases/db/query", "POST /v1/databases/db/query", f"GET /v1/pages/{page_id}"]
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["stale"], stats["entries"]) == (5, 5, 1, 4)
+
+    # Offline, a new cache on the same file serves every stored entry and nothing else
+    offline = NotionClient(token=FAKE_TOKEN, transport=httpx.MockTransport(handler), cache=NotionCache(cache.path, ttl=0, offline=True))
+    assert offline.get_metadata(page_id) == client.get_metadata(page_id)
+    assert offline.client.request(**since) == client.client.request(**since)
+    with pytest.raises(httpx.ConnectError):
+        offline.client.request(path="databases/other/query", method="POST")
+    assert len(requests) == 5
+
+    # The versions are kept in the file, so a new cache still validates entries by them. Children listings also expire after the ttl,
+    # as their children can change without moving the last_edited_time of the page
+    expired = NotionClient(token=FAKE_TOKEN, transport=httpx.MockTransport(handler), cache=NotionCache(cache.path, ttl=0))
+    assert expired.get_metadata(page_id) == client.get_metadata(page_id)
+    expired.get_blocks(page_id)
+    expired.get_blocks(page_id)
+    assert (expired.cache.stats()["hits"], expired.cache.stats()["stale"]) == (1, 2)
+    assert len(requests) == 7
+
+    # Responses of other credentials are not shared
+    NotionClient(token=f"{FAKE_TOKEN}-other", transport=httpx.MockTransport(handler), cache=cache).get_metadata(page_id)
+    assert len(requests) == 8
+
+    small = NotionCache(tmp_path / "small.sqlite", max_size=2 * len(httpx.Response(200, json=fake_row(page_id)).content))
+    for i in range(3):
+        small.put(f"GET /v1/pages/{i}", 200, httpx.Response(200, json=fake_row(page_id)).content)
+    assert small.get("GET /v1/pages/0") is None
+    assert small.get("GET /v1/pages/2") is not None
+    assert (len(small), small.evictions) == (2, 1)
+
+
+def test_notion_cache_listings(tmp_path):
+    page_id = "cb0163c3-7cca-4984-8345-104644b544d9"
+    database_id = "0d8e5f2a-3b4c-4d5e-8f90-a1b2c3d4e5f6"
+    versions = {page_id: "2024-01-01T00:00:00.000Z", database_id: "2024-01-01T00:00:00.000Z"}
+    children = [fake_block("block-0")]
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(f"{request.method} {request.url.path}")
+        if request.method == "POST":
+            return httpx.Response(200, json={"object": "list", "results": [fake_row(page_id, versions[page_id])], "has_more": False})
+        if request.url.path.endswith("/children"):
+            return httpx.Response(200, json={"object": "list", "results": children, "has_more": False, "next_cursor": None})
+        if database_id in request.url.path:
+            return httpx.Response(200, json={"object": "database", "id": database_id, "last_edited_time": versions[database_id]})
+        return httpx.Response(200, json=fake_row(page_id, versions[page_id]))
+
+    client = NotionClient(token=FAKE_TOKEN, transport=httpx.MockTransport(handler), cache=NotionCache(tmp_path / "cache.sqlite"))
+    client.get_metadata(page_id)
+    blocks = client.get_blocks(page_id)
+    client.client.request(path=f"databases/{database_id}", method="GET")
+    query = {"path": f"databases/{database_id}/query", "method": "POST"}
+    client.client.request(**query)
+
+    # After a restart the listing is still validated by the last_edited_time of the page
+    restarted = NotionClient(token=FAKE_TOKEN, transport=httpx.MockTransport(handler), cache=NotionCache(tmp_path / "cache.sqlite"))
+    assert restarted.get_blocks(page_id) == blocks
+    assert len(requests) == 4
+
+    # Editing the page moves its last_edited_time, which the next query shows, so its cached listing is stale
+    versions[page_id] = "2024-02-01T00:00:00.000Z"
+    children.append(fake_block("block-1"))
+    with restarted.cache.bypass():
+        restarted.client.request(**query)
+    assert [block["id"] for block in restarted.get_blocks(page_id)] == ["block0", "block1"]
+    assert restarted.cache.stats()["stale"] == 1
+    assert requests[4:] == [f"POST /v1/databases/{database_id}/query", f"GET /v1/blocks/{page_id}/children"]
+
+    # A cached query of a database is stale once a response shows a newer last_edited_time of the database
+    assert restarted.client.request(**query)["results"][0]["last_edited_time"] == versions[page_id]
+    restarted.cache.observe(json.dumps({"object": "database", "id": database_id, "last_edited_time": "2024-03-01T00:00:00.000Z"}).encode())
+    restarted.client.request(**query)
+    assert requests[6:] == [f"POST /v1/databases/{database_id}/query"]
+    assert restarted.cache.stats()["stale"] == 2
+
+
+def test_incremental_download_database(tmp_path):
+    downloader = NotionDownloader(token=FAKE_TOKEN)
+    rows = [fake_row(f"page{i}") for i in range(5)]
+    children = {}
+    for row in rows:
+        children.update(fake_tree(width=2, depth=2, prefix=row["id"]))
+    fake = downloader.notion.client = FakeNotion(children, rows={"db": rows})
+
+    assert downloader.download_database("db", tmp_path, delta=True) == {"downloaded": [f"page{i}" for i in range(5)], "deleted": []}
+    assert (tmp_path / "page4.json").exists()
+    assert (tmp_path / NotionDownloader.SYNC_STATE).exists()
+
+    now = datetime.now(pytz.utc).strftime("%Y-%m-%dT%H:%M:00.000Z")  # Notion rounds to the minute
+    rows[1] = fake_row("page1", now)
+    del rows[3]
+    rows.append(fake_row("page5", now))
+    children.update(fake_tree(width=2, depth=2, prefix="page5"))
+    children["page1"][0]["last_edited_time"] = now  # A child was added to the first block
+    children["page1-0"].append(fake_block("page1-0-2"))
+    children["page1"][1]["last_edited_time"] = now  # The second block was edited
+    fake.calls.clear()
+
+    assert downloader.download_database("db", tmp_path, delta=True) == {"downloaded": ["page1", "page5"], "deleted": ["page3"]}
+    # The changes and the ids, 3 requests for page1 and 2 for the new page5
+    assert fake.calls == {"databases.query": 2, "blocks.children.list": 5}
+    patches = [json.loads(line) for line in (tmp_path / f"page1{NotionDownloader.PATCH_LOG_SUFFIX}").read_text().splitlines()]
+    assert [(patch["op"], patch["id"], patch["parent"]) for patch in patches[0]["patches"]] == [
+        ("update", "page10", None),
+        ("add", "page102", "page10"),
+        ("update", "page11", None),
+    ]
+    assert len(downloader.load_blocks(tmp_path / "page1.json")[0]["children"]) == 3
+
+    children["page1"][1]["last_edited_time"] = "2024-01-01T00:00:00.000Z"
+    fake.calls.clear()
+    with pytest.raises(ValueError, match="overwrite=True"):
+        downloader.download_page("page1", tmp_path / "page1.json", False, delta=True)
+    assert fake.calls == {}
+    assert downloader.download_page("page1", tmp_path / "page1.json", False, overwrite=True, delta=True) == [
+        {"op": "update", "id": "page11", "parent": None, "last_edited_time": datetime(2024, 1, 1), "block": ANY}  # noqa: DTZ001 Naive UTC like the transformer
+    ]
+    assert fake.calls == {"blocks.children.list": 1}  # Neither block with children changed
+    assert not (tmp_path / "page3.json").exists()
+    database = json.loads((tmp_path / "database.json").read_text())
+    assert [row["id"] for row in database] == ["page0", "page1", "page2", "page4", "page5"]
+    assert datetime.fromisoformat(database[1]["last_edited_time"]) == datetime.fromisoformat(now)
+
+    fake.calls.clear()
+    result = downloader.download_database("db", tmp_path, incremental=False)
+    assert result == {"downloaded": [], "deleted": []}
+    assert fake.calls == {"databases.query": 3}
+
+
 # exporter = NotionExporter(token=NOTION_API_KEY)
 
 
@@ -113,6 +458,75 @@ TEST_PLANNING_PAGE_URL = "https://www.notion.so/cosgroma/Planning-for-product-de
 #     last_edited_time: datetime = RootProperty()
 
 
+def test_notion_io(tmp_path, monkeypatch):
+    transformer = LastEditedToDateTime()
+    rows = [fake_row(f"page-{i}") | {"title": "Ünïcode"} for i in range(20)]
+    expected = transformer.forward(rows)
+
+    NotionIO(transformer).save(rows, tmp_path / "indented.json")
+    assert (tmp_path / "indented.json").read_text().startswith('[\n    {\n        "object"')
+    NotionIO(transformer, compact=True).save(expected, tmp_path / "orjson.json")
+    monkeypatch.setattr(notion, "orjson", None)
+    NotionIO(transformer, compact=True).save(expected, tmp_path / "compact.json")
+    NotionIO(transformer).save(expected, tmp_path / "rows.ndjson")
+    assert len((tmp_path / "rows.ndjson").read_text().splitlines()) == 20
+    assert (tmp_path / "compact.json").stat().st_size < (tmp_path / "indented.json").stat().st_size / 2
+    for name in ("indented.json", "orjson.json", "compact.json", "rows.ndjson"):
+        assert NotionIO(transformer).load(tmp_path / name) == expected, name
+
+    with Path.open(tmp_path / "indented.json") as f:
+        assert list(utils.iter_json_array(f, chunk_size=7)) == rows
+    with pytest.raises(ValueError, match="Expected ','"):
+        list(utils.iter_json_array(io.StringIO('[{"id": 1} {"id": 2}]')))
+
+    # Switching a download directory to ndjson keeps the rows of database.json
+    downloader = NotionDownloader(token=FAKE_TOKEN, ndjson=True)
+    downloader.notion.client = FakeNotion({**fake_tree(prefix="page0"), **fake_tree(prefix="page1")}, rows={"db": rows[:2]})
+    (tmp_path / "db").mkdir()
+    NotionIO(transformer).save(rows[2:4], tmp_path / "db" / "database.json")
+    downloader.download_database("db", tmp_path / "db", incremental=False, delta=False)
+    assert not (tmp_path / "db" / "database.json").exists()
+    assert [row["id"] for row in NotionIO(transformer).load(tmp_path / "db" / "database.ndjson")] == ["page0", "page1"]
+    text = {"type": "text", "text": {"content": "Text", "link": None}, "annotations": {}, "href": None}
+    for page_id in ("page0", "page1"):
+        paragraph = {**fake_block(f"{page_id}-0"), "paragraph": {"rich_text": [text]}}
+        NotionIO(transformer).save([paragraph], tmp_path / "db" / f"{page_id}.json", overwrite=True)
+    JsonToMdConverter(max_workers=1).convert(tmp_path / "db", tmp_path / "md")
+    assert sorted(path.name for path in (tmp_path / "md").glob("*.md")) == ["page0.md", "page1.md"]
+
+
+def test_json_to_md_converter(tmp_path):
+    json_dir = tmp_path / "json"
+    json_dir.mkdir()
+    page_ids = [f"{i:032x}" for i in range(10)]
+    for page_id in page_ids:
+        text = {"type": "text", "text": {"content": f"Text of {page_id}", "link": None}, "annotations": {}, "href": None}
+        paragraph = {**fake_block(f"{page_id}-0"), "paragraph": {"rich_text": [text]}}
+        (json_dir / f"{page_id}.json").write_text(json.dumps([paragraph]))
+    (json_dir / "database.json").write_text(json.dumps([fake_row(page_id) for page_id in page_ids[1:]]))  # The first was deleted
+
+    serial = JsonToMdConverter(max_workers=1).convert(json_dir, tmp_path / "serial")
+    assert JsonToMdConverter(max_workers=2, chunksize=2).convert(json_dir, tmp_path / "md") == tmp_path / "md"
+    md_paths = sorted((tmp_path / "md").glob("*.md"))
+    assert [path.stem for path in md_paths] == page_ids[1:]
+    assert [path.read_text() for path in md_paths] == [path.read_text() for path in sorted(serial.glob("*.md"))]
+    assert f"Text of {page_ids[1]}" in md_paths[0].read_text()
+    assert list((tmp_path / "md").glob("*.partial")) == []
+
+    # Only pages whose json is newer than their markdown are converted again
+    mtimes = {path: path.stat().st_mtime_ns for path in md_paths}
+    os.utime(md_paths[0], ns=(0, 0))
+    JsonToMdConverter(max_workers=2, chunksize=2).convert(json_dir, tmp_path / "md")
+    assert [path for path in md_paths[1:] if path.stat().st_mtime_ns != mtimes[path]] == []
+    assert md_paths[0].stat().st_mtime_ns > 0
+
+    single = tmp_path / "single"
+    single.mkdir()
+    (single / "database.json").write_text(json.dumps([fake_row(page_ids[1])]))
+    (single / f"{page_ids[1]}.json").write_text((json_dir / f"{page_ids[1]}.json").read_text())
+    assert JsonToMdConverter().convert(single, tmp_path / "single_md") == tmp_path / "single_md" / f"{page_ids[1]}.md"
+
+
 def _test_notion_save_planning_page():
     # Make test directory
     assert NOTION_API_KEY, "NOTION_API_KEY not set, set it in .env file"
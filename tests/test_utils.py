@@ -1,9 +1,18 @@
+import threading
+import time
 from pathlib import Path
 from pprint import pprint
 
+import pytest
+
 from databasetools.adapters.notion import utils
 from databasetools.utils.md import md_utils
 from databasetools.utils.md.md_utils import MarkdownManager
+from databasetools.utils.rate_limit import CircuitBreaker
+from databasetools.utils.rate_limit import CircuitOpenError
+from databasetools.utils.rate_limit import RequestScheduler
+from databasetools.utils.rate_limit import RequestStats
+from databasetools.utils.rate_limit import TokenBucket
 
 USER_HOME = Path.home()
 MD_DIR = Path.home() / ".ngira" / "notebooks" / "pgm Notebook-20240120 15-29" / "pgm Notebook" / "Trade Study" / "Brassboard"
@@ -300,3 +309,73 @@ def test_get_tables_from_text():
 | John | 3/1/2022 | $400 |
 | Jane | 4/2/2022 | $400 |"""
     )
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=50, capacity=5)
+    start = time.monotonic()
+    for _ in range(10):
+        bucket.acquire()
+    elapsed = time.monotonic() - start
+    assert 0.08 <= elapsed < 1  # 5 tokens in the burst, 5 more at 50 per second
+    assert bucket.throttle_time > 0
+
+    bucket.pause(0.1)
+    assert bucket.acquire() >= 0.09
+
+
+def test_request_scheduler():
+    scheduler = RequestScheduler(TokenBucket(rate=100, capacity=1))
+    scheduler.limiter.pause(0.1)
+    order = []
+
+    def request(name, priority):
+        scheduler.acquire(priority)
+        order.append(name)
+
+    threads = []
+    for name, priority in [("bulk0", 1), ("bulk1", 1), ("bulk2", 1), ("metadata0", 0), ("metadata1", 0)]:
+        threads.append(threading.Thread(target=request, args=(name, priority)))
+        threads[-1].start()
+        time.sleep(0.01)  # Queue them in order
+    for thread in threads:
+        thread.join()
+
+    assert order == ["bulk0", "metadata0", "metadata1", "bulk1", "bulk2"]  # bulk0 was already waiting on the paused bucket
+    snapshot = scheduler.snapshot()
+    assert snapshot["queue_depth"] == 0
+    assert snapshot["max_queue_depth"] == 5
+    assert snapshot["requests"] == {0: 2, 1: 3}
+    assert snapshot["throttle_time"] >= 0.09
+    assert snapshot["queue_time"] > snapshot["throttle_time"]
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    breaker.before_request()
+    breaker.record_failure()
+    breaker.before_request()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+    time.sleep(0.06)
+    breaker.before_request()  # Trial request
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_request_stats():
+    stats = RequestStats()
+    stats.record("GET /a", 0.2)
+    stats.record("GET /a", 0.4, retries=2, error=True)
+    snapshot = stats.snapshot()
+    assert snapshot["GET /a"]["requests"] == 2
+    assert snapshot["GET /a"]["retries"] == 2
+    assert snapshot["GET /a"]["errors"] == 1
+    assert snapshot["GET /a"]["max_latency"] == 0.4
+    assert snapshot["GET /a"]["mean_latency"] == pytest.approx(0.3)